@@ -1,16 +1,29 @@
 # HTTP SERVER
 
 import json
+import math
+import os
+import tempfile
 
-from flask import Flask, request
+from flask import Flask, request, send_file
 from flask import Response, stream_with_context
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from simulator import Simulator
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from store import QRangeStore
+from broadcast import LiveRuns, Overrun
+from frames import Encoding, negotiate
+from cache import ResultCache
+from checkpoint import CHECKPOINTS, Checkpointer, load_checkpoint
+from export import EXPORTS, FORMATS as EXPORT_FORMATS, MIMETYPES as EXPORT_MIMETYPES, export, require as require_export
+import metrics
+from metrics import PHASE_SECONDS, SSE_BYTES, SSE_EVENTS, Gauge, Sampler
+from jobs import JobQueue, QueueFull, build_simulator, build_store, simulator_key
+from nbody import pack_members, sample_members, simulate_ensemble
+from sqlalchemy import delete, func, select
+from models import Job, Run, RunChunk, db
+from runs import CHUNK_CYCLES, Downsampler, create_run, decode_chunk, iter_cycles, run_writer
 import logging
 from datetime import datetime
+from simulator import Simulator
+from time import perf_counter
 
 
 import time
@@ -76,33 +89,31 @@ PLAN 2:
         format: "data: <any_data>\n\n"
 
 '''
-class Base(DeclarativeBase):
-    pass
-
-
 ############################## Application Configuration ##############################
 
 app = Flask(__name__)
 CORS(app, origins="*", supports_credentials=True)
 
-db = SQLAlchemy(model_class=Base)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
 db.init_app(app)
 
-logging.basicConfig(level=logging.INFO)
+# NOTE: each run is produced once, in the background; SSE clients subscribe to its ring buffer
+live_runs = LiveRuns()
+# NOTE: finished runs are cached by a hash of the model, initial state and options, see `cache.result_key`
+result_cache = ResultCache()
 
+logging.basicConfig(level=logging.DEBUG if metrics.DEBUG else logging.INFO)
 
 
-############################## Database Models ##############################
-
 
-class Simulation(db.Model):
-    id: Mapped[int] = mapped_column(primary_key=True)
-    data: Mapped[str]
+############################## Database Models ##############################
 
+# NOTE: models live in models.py so background workers can use them without importing the app
 
 with app.app_context():
     db.create_all()
+    # NOTE: job workers are separate processes, so they connect to the same database by URL
+    job_queue = JobQueue(db.engine.url.render_as_string(hide_password=False))
 
 ############################## API Endpoints ##############################
 
@@ -116,9 +127,392 @@ def health():
 
 @app.get("/simulation")
 def get_data():
-    # Get most recent simulation from database
-    simulation: Simulation = Simulation.query.order_by(Simulation.id.desc()).first()
-    return simulation.data if simulation else []
+    """
+    The cycles of the most recent run, as far as it has been persisted, as a JSON list (empty if there are
+    no runs). It is written one chunk at a time; see `/simulation/<id>/cycles` for a window of any run.
+    """
+    run_id = db.session.execute(select(Run.id).order_by(Run.id.desc()).limit(1)).scalar()
+    if run_id is None:
+        return []
+
+    def generate():
+        separator = "["
+        for (_, columns) in run_chunks(run_id):
+            for cycle in iter_cycles(columns):
+                yield separator + json.dumps(cycle)
+                separator = ","
+        yield "[]" if separator == "[" else "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def initial_conditions(args):
+    """Build the initial conditions for a new run from request parameters."""
+    init = {
+        "Body1": {
+            "position": {
+                "x": float(args.get("Body1.position.x", 0)),
+                "y": float(args.get("Body1.position.y", 0)),
+                "z": float(args.get("Body1.position.z", 0))
+            },
+            "velocity": {
+                "x": float(args.get("Body1.velocity.x", 0)),
+                "y": float(args.get("Body1.velocity.y", 0)),
+                "z": float(args.get("Body1.velocity.z", 0))
+            },
+            "mass": float(args.get("Body1.mass", 1))
+        },
+        "Body2": {
+            "position": {
+                "x": float(args.get("Body2.position.x", 0)),
+                "y": float(args.get("Body2.position.y", 0)),
+                "z": float(args.get("Body2.position.z", 0))
+            },
+            "velocity": {
+                "x": float(args.get("Body2.velocity.x", 0)),
+                "y": float(args.get("Body2.velocity.y", 0)),
+                "z": float(args.get("Body2.velocity.z", 0))
+            },
+            "mass": float(args.get("Body2.mass", 1))
+        }
+    }
+
+    logging.info(f"Received initial conditions: {init}")
+
+    # Define time and timeStep for each agent
+    for key in init.keys():
+        init[key]["time"] = 0
+        init[key]["timeStep"] = 0.1
+
+    return init
+
+
+def checkpoint_path(run_id):
+    return os.path.join(CHECKPOINTS, f"run-{run_id}.json")
+
+
+def produce_run(run_id, simulator, iterations, key=None, total=None):
+    """
+    Step `simulator` once for a live run, persisting each cycle as it is produced and yielding it as JSON
+    text, so it is serialized once however many clients subscribe. A run that completes is stored in the
+    result cache under `key`, if given. Statemanager runs are checkpointed whenever a chunk is persisted, so
+    `total` iterations can be resumed after a restart. This generator is consumed on the run's producer
+    thread, so it holds its own app context for the database.
+    """
+    with app.app_context():
+        run = db.session.get(Run, run_id)
+        writer = run_writer(db.session, run)
+        checkpointer = None
+        options = {}
+        if isinstance(simulator, Simulator):
+            # NOTE: checkpoints land right after each chunk is flushed, so one always matches persisted history
+            writer.seq = simulator.iteration // CHUNK_CYCLES
+            checkpointer = Checkpointer(checkpoint_path(run_id), CHUNK_CYCLES, {"run": run_id, "iterations": total or iterations})
+            options["checkpointer"] = checkpointer
+        status = "failed"
+        sample = Sampler()
+        cached = [] if key is not None else None
+        cachedBytes = 0
+        try:
+            for cycle in simulator.simulate(iterations=iterations, **options):
+                writer.append(cycle)
+                if sample():
+                    start = perf_counter()
+                    data = json.dumps(cycle)
+                    PHASE_SECONDS.observe(perf_counter() - start, "serialize")
+                else:
+                    data = json.dumps(cycle)
+                if cached is not None:
+                    cached.append(data)
+                    cachedBytes += len(data) + 1
+                    if cachedBytes > result_cache.entry_bytes:
+                        cached = None  # NOTE: too large to cache, so stop holding it in memory
+                yield data
+            status = "complete"
+            if cached is not None:
+                result_cache.put(key, cached)
+        except GeneratorExit:
+            status = "incomplete"  # NOTE: cancelled, and resumable from its last checkpoint
+            raise
+        finally:
+            writer.flush()
+            run.status = status
+            db.session.commit()
+            if checkpointer is not None:
+                checkpointer.close()
+                if status == "complete" and os.path.exists(checkpointer.path):
+                    os.remove(checkpointer.path)
+
+
+def start_run(init, args):
+    """Create, persist and start producing a new run in the background. Returns the run id."""
+    iterations = int(args.get("iterations", 500))
+    simulator = build_simulator(init, args)
+    run_id = create_run(db.session, init).id
+    live_runs.start(run_id, produce_run(run_id, simulator, iterations, simulator_key(init, iterations, args)))
+    return run_id
+
+
+def resume_run(run, checkpoint, args):
+    """
+    Restart `run` from `checkpoint`: drop any chunks persisted after it, rebuild the Simulator from it, and
+    produce the remaining iterations as a live run numbered on from the checkpoint.
+    """
+    iteration = checkpoint["iteration"]
+    chunks = iteration // CHUNK_CYCLES
+    db.session.execute(delete(RunChunk).where(RunChunk.run_id == run.id, RunChunk.seq >= chunks))
+    (t0, t1) = db.session.execute(select(func.min(RunChunk.t0), func.max(RunChunk.t1)).where(RunChunk.run_id == run.id)).one()
+    (run.cycles, run.chunks, run.t0, run.t1, run.status) = (iteration, chunks, t0, t1, "running")
+    db.session.commit()
+    simulator = Simulator.from_checkpoint(checkpoint, build_store(args))
+    total = checkpoint["history"]["iterations"]
+    live_runs.start(run.id, produce_run(run.id, simulator, total - iteration, total=total), offset=iteration)
+
+
+def replay_run(run_id, offset, interval):
+    """
+    Yield `(offset, cycle)` pairs of a persisted run from `offset` on, skipping whole chunks before it. Each
+    chunk is read whole in its own query, so no read cursor stays open on the database, blocking writers,
+    while its cycles are paced out. Chunks written meanwhile are picked up once the listed ones run out.
+    """
+    (i, last) = (0, -1)
+    while True:
+        sizes = db.session.execute(
+            select(RunChunk.seq, RunChunk.cycles).where(RunChunk.run_id == run_id, RunChunk.seq > last).order_by(RunChunk.seq)
+        ).all()
+        if not sizes:
+            return
+        for (seq, cycles) in sizes:
+            last = seq
+            if i + cycles <= offset:
+                i += cycles
+                continue
+            data = db.session.execute(select(RunChunk.data).where(RunChunk.run_id == run_id, RunChunk.seq == seq)).scalar_one()
+            for cycle in iter_cycles(decode_chunk(data)):
+                if i >= offset:
+                    yield (i, json.dumps(cycle))
+                    time.sleep(interval)
+                i += 1
+
+
+def replay_cached(cycles, offset, interval):
+    """Yield `(offset, cycle)` pairs of a cached run from `offset` on."""
+    for i in range(offset, len(cycles)):
+        yield (i, cycles[i])
+        if interval:
+            time.sleep(interval)
+
+
+def cached_interval(args, interval):
+    """The pacing of a result cache hit: none, unless the request asks for `interval` with `pace=1`."""
+    return interval if args.get("pace", "0").lower() in ("1", "true", "yes") else 0
+
+
+def run_cycles(live, run_id, offset, interval):
+    """
+    Yield `(offset, cycle)` pairs for one subscriber, from the run's ring buffer while it is live and from its
+    persisted chunks otherwise. `(None, None)` is yielded while waiting on a live run.
+    """
+    if live is None:
+        yield from replay_run(run_id, offset, interval)
+        return
+    while True:
+        try:
+            for (i, cycle) in live.subscribe(offset, interval):
+                if i is not None:
+                    offset = i + 1
+                yield (i, cycle)
+            return
+        except Overrun:
+            # NOTE: a subscriber that falls out of the ring buffer catches up from the persisted chunks rather
+            # than holding the producer back, and is only dropped if those have not been written yet
+            start = offset
+            for (i, cycle) in replay_run(run_id, offset, interval):
+                offset = i + 1
+                yield (i, cycle)
+            if offset == start:
+                raise
+
+
+def count_events(events, sent):
+    """Add to the SSE event and byte counters, returning the counts left to publish."""
+    SSE_EVENTS.inc(amount=events)
+    SSE_BYTES.inc(amount=sent)
+    return (0, 0)
+
+
+class SubscriberEvents:
+    """
+    What one subscriber is sent, one step at a time, shared by `cycle_events` and its event loop twin
+    `asgi.cycle_events_async`, which only differ in how they wait for cycles. Each step returns the texts
+    to send, in the `encoding` the subscriber negotiated (by default, one JSON SSE event per cycle; see
+    `frames.py`), and keeps the SSE counters.
+    """
+
+    def __init__(self, first, live=None, encoding=None):
+        self.first = first
+        self.live = live
+        self.sample = Sampler()
+        self.encoder = (encoding or Encoding()).encoder()
+        # NOTE: counts are published on sampled events and at the end rather than taking a lock every cycle
+        (self.events, self.sent) = (0, 0)
+
+    def opening(self):
+        #Initial heartbeat
+        return [self.encoder.control(self.first)]
+
+    def cycle(self, i, cycle):
+        """
+        The texts for an `(offset, cycle)` pair, and whether writing the first should be timed (as a sampled
+        `network_write`). A `(None, None)` pair, while the producer catches up, sends a heartbeat.
+        """
+        if cycle is None:
+            # Keep idle connections open while the producer catches up, sending any partial batch first
+            return (self.flush() + [self.encoder.control({'heartbeat': True})], False)
+        self.events += 1
+        text = self.encoder.cycle(i, cycle)
+        if text is None:
+            return ([], False)
+        self.sent += len(text)
+        timed = self.sample()
+        if timed:
+            (self.events, self.sent) = count_events(self.events, self.sent)
+        # Sending hearbeat every 10 cycles
+        if self.encoder.heartbeats and i % 10 == 0:
+            return ([text, self.encoder.control({'heartbeat': True})], timed)
+        return ([text], timed)
+
+    def flush(self):
+        rest = self.encoder.flush()
+        if rest is None:
+            return []
+        self.sent += len(rest)
+        return [rest]
+
+    def ending(self):
+        return self.flush() + [self.encoder.control(closing(self.live))]
+
+    def failed(self, e):
+        """The message ending a stream that raised `e`: a slow subscriber is dropped, anything else reported."""
+        if isinstance(e, Overrun):
+            logging.warning(f"Dropping slow subscriber of {self.first}: {e}")
+            return [self.encoder.control({'error': f"Subscriber fell behind: {e}", 'dropped': True})]
+        logging.error(f"Error in event stream: {str(e)}")
+        return [self.encoder.control({'error': str(e)})]
+
+    def count(self):
+        count_events(self.events, self.sent)
+
+    def finish(self):
+        end = self.encoder.finish()
+        return [] if end is None else [end]
+
+
+def cycle_events(cycles, first, live=None, encoding=None):
+    """
+    The events for one subscriber: the `first` heartbeat, then `(offset, cycle)` pairs from `cycles`; see
+    `SubscriberEvents`.
+    """
+    stream = SubscriberEvents(first, live, encoding)
+    try:
+        yield from stream.opening()
+        for (i, cycle) in cycles:
+            (texts, timed) = stream.cycle(i, cycle)
+            for text in texts:
+                if timed:
+                    # NOTE: the generator resumes once the server has written the event to the client
+                    start = perf_counter()
+                    yield text
+                    PHASE_SECONDS.observe(perf_counter() - start, "network_write")
+                    timed = False
+                else:
+                    yield text
+        yield from stream.ending()
+    except Exception as e:
+        yield from stream.failed(e)
+    finally:
+        stream.count()
+    yield from stream.finish()
+
+
+def closing(live=None):
+    """The last message of a stream: the run's error, if producing it failed, or completion."""
+    if live is not None and live.error is not None:
+        return {'error': live.error}
+    # Final messge for completion
+    return {'complete': True}
+
+
+def subscription(headers, args):
+    """
+    Return the `(offset, interval)` a request subscribes with: it resumes after its `Last-Event-ID` header
+    or parameter, if given, and is paced by its `speed`.
+    """
+    lastEventId = headers.get("Last-Event-ID", args.get("lastEventId"))
+    offset = 0 if lastEventId in (None, "") else int(lastEventId) + 1
+    # Speed parameter (higher = faster simulation)
+    speed = float(args.get("speed", 1.0))
+    # Faster simulation with minimal delay, paced per subscriber so the producer never waits
+    return (offset, max(0.01, 0.05 / speed))
+
+
+# MC: No idea what these do but adding them fixed the error
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type",
+    "Content-Type": "text/event-stream"
+}
+
+
+def event_stream_response(events, encoding=None):
+    headers = {**STREAM_HEADERS, **(encoding.headers if encoding is not None else {})}
+    response = Response(stream_with_context(events), mimetype=headers["Content-Type"], headers=headers)
+    # NOTE: stream_with_context only closes `events` once they have started, so close them with the response
+    response.call_on_close(events.close)
+    return response
+
+
+def run_events(run_id, offset, interval, encoding=None, owner=False):
+    """
+    The SSE events of a run from `offset` on. While a live run is streamed the client counts as its
+    subscriber, and if `owner` the run is cancelled once its last subscriber disconnects.
+    """
+    live = live_runs.get(run_id)
+    events = cycle_events(run_cycles(live, run_id, offset, interval), {'heartbeat': True, 'run': run_id}, live, encoding)
+    return events if live is None else Subscription(live, events, owner)
+
+
+class Subscription:
+    """
+    The `events` of a live run, streamed by a subscriber attached from the start. It detaches once the
+    events end or it is closed, even if the client went before the first event, and if `owner` the run is
+    cancelled when its last subscriber has detached.
+    """
+
+    def __init__(self, live, events, owner=False):
+        live.attach()
+        live.cancel_when_idle |= owner
+        self.live = live
+        self.events = events
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.events)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if self.live is not None:
+            (live, self.live) = (self.live, None)
+            self.events.close()
+            live.detach()
 
 
 # Replace the blocking POST route with a new GET endpoint
@@ -129,97 +523,33 @@ def get_data():
 
 #         format: "data: <any_data>\n\n"
 
+def open_stream(args):
+    """
+    Resolve a `/simulation/stream` request to `(cycles, run_id)`: the run's cycles if it is in the result
+    cache, so no simulator is built and there is no run id, or else the id of a newly started run.
+    """
+    init = initial_conditions(args)
+    cycles = result_cache.get(simulator_key(init, int(args.get("iterations", 500)), args))
+    if cycles is not None:
+        return (cycles, None)
+    return (None, start_run(init, args))
+
+
 @app.get("/simulation/stream")
 def stream_simulation():
+    """
+    Start a new run and subscribe to it. The run is cancelled once this client and any other subscribers
+    have disconnected; start it with `POST /simulation/runs` to keep it going unwatched. Runs already in
+    the result cache are streamed from it without building a simulator, and carry no run id. They are sent
+    as fast as the client reads them, unless it asks with `pace=1` for them to be paced like a live run.
+    """
     try:
-        # Get initial conditions from query parameters
-        init = {
-            "Body1": {
-                "position": {
-                    "x": float(request.args.get("Body1.position.x", 0)),
-                    "y": float(request.args.get("Body1.position.y", 0)),
-                    "z": float(request.args.get("Body1.position.z", 0))
-                },
-                "velocity": {
-                    "x": float(request.args.get("Body1.velocity.x", 0)),
-                    "y": float(request.args.get("Body1.velocity.y", 0)),
-                    "z": float(request.args.get("Body1.velocity.z", 0))
-                },
-                "mass": float(request.args.get("Body1.mass", 1))
-            },
-            "Body2": {
-                "position": {
-                    "x": float(request.args.get("Body2.position.x", 0)),
-                    "y": float(request.args.get("Body2.position.y", 0)),
-                    "z": float(request.args.get("Body2.position.z", 0))
-                },
-                "velocity": {
-                    "x": float(request.args.get("Body2.velocity.x", 0)),
-                    "y": float(request.args.get("Body2.velocity.y", 0)),
-                    "z": float(request.args.get("Body2.velocity.z", 0))
-                },
-                "mass": float(request.args.get("Body2.mass", 1))
-            }
-        }
-
-        logging.info(f"Received initial conditions: {init}")
-
-        # Define time and timeStep for each agent
-        for key in init.keys():
-            init[key]["time"] = 0
-            init[key]["timeStep"] = 0.1  
-
-        # Create store and simulator
-        t = datetime.now()
-        store = QRangeStore()
-        simulator = Simulator(store=store, init=init)
-        logging.info(f"Time to Build: {datetime.now() - t}")
-
-        def event_stream():
-            try:
-                #Initial heartbeat
-                yield f"data: {json.dumps({'heartbeat': True})}\n\n"
-                
-                # Speed parameter (higher = faster simulation)
-                speed = float(request.args.get("speed", 1.0))
-                
-                for i, cycle in enumerate(simulator.simulate(iterations=500)):
-                    try:
-                        logging.info(f"Sending cycle {i}: {cycle}")
-                        yield f"data: {json.dumps(cycle)}\n\n"
-                        
-                        # Sending hearbeat every 10 cycles
-                        if i % 10 == 0:
-                            yield f"data: {json.dumps({'heartbeat': True})}\n\n"
-                            
-                        # Faster simulation with minimal delay
-                        time.sleep(max(0.01, 0.05 / speed))  # Reduced minimum delay and added speed control
-                    except Exception as e:
-                        logging.error(f"Error in cycle {i}: {str(e)}")
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                        continue
-                        
-                # Final messge for completion
-                yield f"data: {json.dumps({'complete': True})}\n\n"
-                
-            except Exception as e:
-                logging.error(f"Error in event stream: {str(e)}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-
-        return Response(
-            stream_with_context(event_stream()),
-            mimetype="text/event-stream",
-
-            # MC: No idea what these do but adding them fixed the error
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type",
-                "Content-Type": "text/event-stream"
-            }
-        )
+        (offset, interval) = subscription(request.headers, request.args)
+        encoding = negotiate(request.headers, request.args)
+        (cycles, run_id) = open_stream(request.args)
+        if cycles is not None:
+            return event_stream_response(cycle_events(replay_cached(cycles, offset, cached_interval(request.args, interval)), {'heartbeat': True, 'cached': True}, None, encoding), encoding)
+        return event_stream_response(run_events(run_id, offset, interval, encoding, owner=True), encoding)
     
     #Error handling
     except Exception as e:
@@ -230,6 +560,288 @@ def stream_simulation():
             mimetype="text/plain"
         )
 
+
+@app.post("/simulation/runs")
+def post_run():
+    """Start a new run from the same parameters as `/simulation/stream`, without subscribing to it."""
+    try:
+        run_id = start_run(initial_conditions(request.args), request.args)
+    except (KeyError, ValueError) as e:
+        return Response(f"Invalid run request: {e!r}", status=400, mimetype="text/plain")
+    return {"run": run_id}, 202
+
+
+@app.get("/simulation/<int:run_id>/stream")
+def stream_run(run_id):
+    """Subscribe to a live or persisted run. Any number of clients can follow the same run."""
+    if live_runs.get(run_id) is None and db.session.get(Run, run_id) is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    try:
+        (offset, interval) = subscription(request.headers, request.args)
+        encoding = negotiate(request.headers, request.args)
+    except ValueError as e:
+        return Response(f"Invalid stream request: {e}", status=400, mimetype="text/plain")
+    return event_stream_response(run_events(run_id, offset, interval, encoding), encoding)
+
+
+@app.post("/simulation/<int:run_id>/resume")
+def post_resume(run_id):
+    """Resume a run that stopped before completing (e.g. the server restarted) from its last checkpoint."""
+    run = db.session.get(Run, run_id)
+    if run is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    live = live_runs.get(run_id)
+    if (live is not None and not live.finished) or run.status == "complete":
+        return Response(f"Run {run_id} is {'still running' if run.status != 'complete' else 'complete'}", status=409, mimetype="text/plain")
+    checkpoint = load_checkpoint(checkpoint_path(run_id))
+    if checkpoint is None:
+        return Response(f"Run {run_id} has no checkpoint", status=404, mimetype="text/plain")
+    try:
+        resume_run(run, checkpoint, request.args)
+    except (KeyError, ValueError) as e:
+        return Response(f"Invalid resume request: {e!r}", status=400, mimetype="text/plain")
+    return {"run": run_id, "cycle": checkpoint["iteration"]}, 202
+
+
+@app.get("/simulation/cache")
+def cache_stats():
+    """Result cache hit, miss and eviction counters and current sizes, for sizing the cache."""
+    return result_cache.stats()
+
+
+def live_run_counts():
+    runs = list(live_runs.runs.values())
+    finished = sum(run.finished for run in runs)
+    return {("producing",): len(runs) - finished, ("finished",): finished}
+
+
+Gauge("sedaro_result_cache_events_total", "Result cache hits, misses, stores and evictions.",
+      lambda: {(event,): count for (event, count) in result_cache.counters.items()}, ("event",), kind="counter")
+Gauge("sedaro_result_cache_memory_bytes", "Bytes held by the result cache memory tier.", lambda: result_cache.memory_size)
+Gauge("sedaro_live_runs", "Runs held for subscribers, by whether they are still producing.", live_run_counts, ("state",))
+Gauge("sedaro_jobs_pending", "Jobs submitted by this server that are queued or running.", lambda: job_queue.pending())
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Counters, histograms and gauges in the Prometheus text format. See `metrics.py` for sampling."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def iter_chunks(run_id, t0=None, t1=None):
+    """
+    Yield the decoded chunks of a run that may hold times in [t0, t1), in order, using the chunk time
+    index. Chunks are fetched a few at a time, so memory stays bounded however long the run is.
+    """
+    query = select(RunChunk.data).where(RunChunk.run_id == run_id).order_by(RunChunk.seq)
+    if t0 is not None:
+        query = query.where(RunChunk.t1 >= t0)
+    if t1 is not None:
+        query = query.where(RunChunk.t0 < t1)
+    for data in db.session.execute(query.execution_options(yield_per=4)).scalars():
+        yield decode_chunk(data)
+
+
+def optional_float(name):
+    value = request.args.get(name)
+    return None if value in (None, "") else float(value)
+
+
+@app.get("/simulation/runs")
+def list_runs():
+    runs = db.session.execute(select(Run).order_by(Run.id.desc()).limit(50)).scalars()
+    return [run.header() for run in runs]
+
+
+@app.get("/simulation/<int:run_id>")
+def get_run(run_id):
+    run = db.session.get(Run, run_id)
+    if run is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    return run.header()
+
+
+@app.get("/simulation/<int:run_id>/cycles")
+def get_run_cycles(run_id):
+    """Stream a run's cycles with times in [`t0`, `t1`) as newline-delimited JSON, one chunk at a time."""
+    if db.session.get(Run, run_id) is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    try:
+        (t0, t1) = (optional_float("t0"), optional_float("t1"))
+    except ValueError as e:
+        return Response(f"Invalid time window: {e}", status=400, mimetype="text/plain")
+
+    def generate():
+        for columns in iter_chunks(run_id, t0, t1):
+            for cycle in iter_cycles(columns, t0, t1):
+                yield json.dumps(cycle) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def run_chunks(run_id):
+    """Yield `(cycles, columns)` for every persisted chunk of a run, in order, fetching a few at a time."""
+    query = select(RunChunk.cycles, RunChunk.data).where(RunChunk.run_id == run_id).order_by(RunChunk.seq)
+    for (cycles, data) in db.session.execute(query.execution_options(yield_per=4)):
+        yield (cycles, decode_chunk(data))
+
+
+@app.get("/simulation/<int:run_id>/export")
+def get_run_export(run_id):
+    """
+    Download a run as an Arrow IPC file, Parquet or NPZ (`format`, default `npz`; see `export.py`), written
+    from its persisted chunks one at a time. Exports of complete runs are kept and served again.
+    """
+    run = db.session.get(Run, run_id)
+    if run is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    format = request.args.get("format", "npz")
+    try:
+        require_export(format)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+    except RuntimeError as e:
+        return Response(str(e), status=501, mimetype="text/plain")
+    name = f"run-{run_id}{EXPORT_FORMATS[format]}"
+    os.makedirs(EXPORTS, exist_ok=True)
+    keep = run.status == "complete"
+    if keep:
+        path = os.path.join(EXPORTS, name)
+    else:
+        # NOTE: a run still being written is exported as far as it goes, just for this request
+        (fd, path) = tempfile.mkstemp(EXPORT_FORMATS[format], f"run-{run_id}-", EXPORTS)
+        os.close(fd)
+    if not (keep and os.path.exists(path)):
+        export(run_chunks(run_id), json.loads(run.agents), format, path)
+    if keep:
+        return send_file(path, mimetype=EXPORT_MIMETYPES[format], as_attachment=True, download_name=name)
+    # NOTE: the open file outlives its name, so nothing is left behind however the download ends
+    file = open(path, "rb")
+    os.remove(path)
+    return send_file(file, mimetype=EXPORT_MIMETYPES[format], as_attachment=True, download_name=name)
+
+
+@app.get("/simulation/<int:run_id>/range")
+def get_run_range(run_id):
+    """
+    Return a run's samples for the window [`t0`, `t1`) (defaulting to the whole run), column-wise per agent.
+    `agents` and `fields` (e.g. `time,position.x,velocity`) are comma-separated filters. `stride=N` keeps
+    every Nth sample; `buckets=B` instead returns each field's min and max over B equal time buckets.
+    Only the chunks overlapping the window are read, via the chunk time index.
+    """
+    run = db.session.get(Run, run_id)
+    if run is None:
+        return Response(f"Run {run_id} not found", status=404, mimetype="text/plain")
+    try:
+        t0 = optional_float("t0")
+        t1 = optional_float("t1")
+        t0 = (run.t0 or 0.0) if t0 is None else t0
+        t1 = math.nextafter(run.t1 or t0, math.inf) if t1 is None else t1
+        agents = request.args.get("agents")
+        sampler = Downsampler(
+            t0,
+            t1,
+            fields=request.args.get("fields", "time,position,velocity").split(","),
+            agents=None if agents is None else set(agents.split(",")),
+            stride=int(request.args.get("stride", 1)),
+            buckets=None if request.args.get("buckets") is None else int(request.args["buckets"]),
+        )
+    except ValueError as e:
+        return Response(f"Invalid range request: {e}", status=400, mimetype="text/plain")
+    for columns in iter_chunks(run_id, t0, t1):
+        sampler.add(columns)
+    return {"run": run_id, **sampler.result()}
+
+
+def jsonable(value):
+    """Convert NumPy arrays (possibly nested in dicts) to lists for `json.dumps`."""
+    if isinstance(value, dict):
+        return {k: jsonable(v) for (k, v) in value.items()}
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return value
+
+
+@app.post("/simulation/ensemble")
+def ensemble_simulation():
+    """
+    Propagate an ensemble of initial conditions together. The JSON body holds `iterations`, an optional
+    `stride` for recorded trajectories and `trajectories: false` to return only statistics, plus either:
+    - `members`: a list of initial states, in the same form the simulator takes, or
+    - `base`, `samples`, `perturb` and `seed`: a base state and the noise to draw members with (see
+      `nbody.sample_members`).
+    """
+    try:
+        spec = request.get_json()
+        iterations = int(spec.get("iterations", 500))
+        stride = int(spec.get("stride", 1))
+        if "members" in spec:
+            (ids, arrays) = pack_members(spec["members"])
+        else:
+            (ids, arrays) = sample_members(spec["base"], int(spec["samples"]), spec.get("perturb", {}), int(spec.get("seed", 0)))
+        t = datetime.now()
+        result = simulate_ensemble(ids, arrays, iterations=iterations, stride=stride)
+        logging.info(f"Time to simulate ensemble of {len(arrays['mass'])} members: {datetime.now() - t}")
+        if not spec.get("trajectories", True):
+            for field in ("time", "position", "velocity"):
+                del result[field]
+        return Response(json.dumps(jsonable(result)), mimetype="application/json")
+    except (KeyError, TypeError, ValueError) as e:
+        return Response(f"Invalid ensemble request: {e!r}", status=400, mimetype="text/plain")
+
+@app.post("/jobs")
+def submit_job():
+    """
+    Queue a simulation to run in a worker process. The JSON body takes the same parameters as
+    `/simulation/stream` (e.g. `Body1.position.x`, `engine`, `store`) plus `iterations`.
+    """
+    spec = request.get_json(silent=True) or request.args
+    try:
+        init = initial_conditions(spec)
+        iterations = int(spec.get("iterations", 500))
+        options = {key: spec[key] for key in ("store", "engine", "integrator", "adaptive") if key in spec}
+    except (TypeError, ValueError) as e:
+        return Response(f"Invalid job request: {e!r}", status=400, mimetype="text/plain")
+    if job_queue.full():
+        return Response("The job queue is full", status=503, mimetype="text/plain", headers={"Retry-After": "10"})
+    job = Job(init=json.dumps(init), options=json.dumps(options), iterations=iterations)
+    db.session.add(job)
+    db.session.commit()
+    try:
+        job_queue.submit(job.id)
+    except QueueFull as e:
+        db.session.delete(job)
+        db.session.commit()
+        return Response(str(e), status=503, mimetype="text/plain", headers={"Retry-After": "10"})
+    return job.header(), 202
+
+
+@app.get("/jobs")
+def list_jobs():
+    jobs = db.session.execute(select(Job).order_by(Job.id.desc()).limit(50)).scalars()
+    return [job.header() for job in jobs]
+
+
+@app.get("/jobs/<int:job_id>")
+def get_job(job_id):
+    """
+    Report a job's status, progress and throughput, and its final state once complete. Its cycles are
+    persisted as run `run`, which can be read from `/simulation/<run>/cycles` while the job is running.
+    """
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return Response(f"Job {job_id} not found", status=404, mimetype="text/plain")
+    return job.header()
+
+
+@app.post("/jobs/<int:job_id>/cancel")
+def cancel_job(job_id):
+    if db.session.get(Job, job_id) is None:
+        return Response(f"Job {job_id} not found", status=404, mimetype="text/plain")
+    if not job_queue.cancel(db.session, job_id):
+        return Response(f"Job {job_id} has already finished", status=409, mimetype="text/plain")
+    return db.session.get(Job, job_id).header()
+
 ############################## Running the Server ##############################
 
 if __name__ == '__main__':
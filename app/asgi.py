@@ -0,0 +1,293 @@
+# ASGI SERVER
+
+"""
+The same app served from an event loop: `uvicorn asgi:app --host 0.0.0.0 --port 8000`. SSE streams
+(`/simulation/stream` and `/simulation/<id>/stream`) are coroutines, so an idle connection costs a task
+rather than a thread. Database and simulation work runs off the loop in the default executor, and
+every other route is the Flask app, called through a small WSGI bridge in that executor. Responses are
+the same as `flask run`'s: as there, a run started by `/simulation/stream` is cancelled once its last
+subscriber disconnects, and can be resumed from its checkpoint; runs started with `POST /simulation/runs`
+keep going.
+
+A request to `app`, with `receive` and `send` standing in for the server, gets the same bytes as Flask:
+
+>>> import json
+>>> cycles = [json.dumps({'A': {'time': t / 10, 'position': {'x': t, 'y': 0.5, 'z': 0}, 'velocity': {'x': 1, 'y': 0, 'z': 0}}})
+...           for t in range(12)]
+>>> live_runs.start(10**9, cycles).thread.join()
+>>> async def get(path, query=b''):
+...     (response, request) = ({'body': b''}, [{'type': 'http.request', 'body': b'', 'more_body': False}])
+...     async def receive():
+...         return request.pop() if request else await asyncio.Event().wait()
+...     async def send(message):
+...         if message['type'] == 'http.response.start':
+...             response['status'] = message['status']
+...         else:
+...             response['body'] += message.get('body', b'')
+...     await app({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': []}, receive, send)
+...     return response
+>>> response = asyncio.run(get(f'/simulation/{10**9}/stream', b'speed=1000'))
+>>> (response['status'], response['body'] == flask_app.test_client().get(f'/simulation/{10**9}/stream?speed=1000').data)
+(200, True)
+>>> response['body'].decode().splitlines()[:4]
+['data: {"heartbeat": true, "run": 1000000000}', '', 'id: 0', 'data: {"A": {"time": 0.0, "position": {"x": 0, "y": 0.5, "z": 0}, "velocity": {"x": 1, "y": 0, "z": 0}}}']
+>>> response['body'].decode().splitlines()[-2:]
+['data: {"complete": true}', '']
+>>> asyncio.run(get('/simulation/999999999/stream'))
+{'body': b'Run 999999999 not found', 'status': 404}
+"""
+
+import asyncio
+import contextvars
+import io
+import itertools
+import logging
+import re
+import sys
+from time import perf_counter
+from urllib.parse import parse_qsl, unquote
+
+from werkzeug.datastructures import Headers, MultiDict
+
+from app import app as flask_app
+from app import STREAM_HEADERS, SubscriberEvents, cached_interval, live_runs, open_stream, replay_run, subscription
+from broadcast import Overrun
+from frames import negotiate
+from metrics import PHASE_SECONDS
+from models import Run, db
+
+STREAM_PATH = re.compile(r"^/simulation/(?:stream|(\d+)/stream)$")
+REPLAY_BATCH = 256  # persisted cycles read per executor call
+
+
+def in_app_context(function, *args):
+    with flask_app.app_context():
+        return function(*args)
+
+
+async def off_loop(function, *args):
+    """Run `function(*args)` in the default executor, inside the Flask app context."""
+    return await asyncio.get_running_loop().run_in_executor(None, in_app_context, function, *args)
+
+
+def read_persisted(run_id, offset, limit):
+    """Up to `limit` `(offset, cycle)` pairs of a persisted run from `offset` on."""
+    return list(itertools.islice(replay_run(run_id, offset, 0), limit))
+
+
+def run_exists(run_id):
+    return db.session.get(Run, run_id) is not None
+
+
+async def replay_async(run_id, offset, interval):
+    """`app.replay_run` for an event loop: batches are read in the executor and paced on the loop."""
+    while True:
+        batch = await off_loop(read_persisted, run_id, offset, REPLAY_BATCH)
+        for (i, cycle) in batch:
+            yield (i, cycle)
+            offset = i + 1
+            await asyncio.sleep(interval)
+        if len(batch) < REPLAY_BATCH:
+            return
+
+
+async def cached_async(cycles, offset, interval):
+    for i in range(offset, len(cycles)):
+        yield (i, cycles[i])
+        await asyncio.sleep(interval)
+
+
+async def run_cycles_async(live, run_id, offset, interval):
+    """`app.run_cycles` for an event loop."""
+    if live is None:
+        async for pair in replay_async(run_id, offset, interval):
+            yield pair
+        return
+    while True:
+        try:
+            async for (i, cycle) in live.subscribe_async(offset, interval):
+                if i is not None:
+                    offset = i + 1
+                yield (i, cycle)
+            return
+        except Overrun:
+            start = offset
+            async for (i, cycle) in replay_async(run_id, offset, interval):
+                offset = i + 1
+                yield (i, cycle)
+            if offset == start:
+                raise
+
+
+async def cycle_events_async(cycles, first, live=None, encoding=None):
+    """`app.cycle_events` for an event loop, with `cycles` an async iterator."""
+    stream = SubscriberEvents(first, live, encoding)
+    try:
+        for text in stream.opening():
+            yield text
+        async for (i, cycle) in cycles:
+            (texts, timed) = stream.cycle(i, cycle)
+            for text in texts:
+                if timed:
+                    # NOTE: the generator resumes once the event has been handed to the server
+                    start = perf_counter()
+                    yield text
+                    PHASE_SECONDS.observe(perf_counter() - start, "network_write")
+                    timed = False
+                else:
+                    yield text
+        for text in stream.ending():
+            yield text
+    except Exception as e:
+        for text in stream.failed(e):
+            yield text
+    finally:
+        stream.count()
+    for text in stream.finish():
+        yield text
+
+
+async def plain_response(send, status, text):
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+    await send({"type": "http.response.body", "body": text.encode()})
+
+
+async def disconnected(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def stream(scope, receive, send, run_id=None):
+    """Serve an SSE route: `/simulation/stream` if `run_id` is None, else `/simulation/<run_id>/stream`."""
+    args = MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+    headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for (key, value) in scope["headers"]])
+    cycles = None
+    if run_id is None:
+        try:
+            (offset, interval) = subscription(headers, args)
+            encoding = negotiate(headers, args)
+            (cycles, run_id) = await off_loop(open_stream, args)
+        except Exception as e:
+            logging.error(f"Error in stream_simulation: {str(e)}")
+            return await plain_response(send, 500, f"Error: {str(e)}")
+        first = {'heartbeat': True, 'cached': True} if cycles is not None else {'heartbeat': True, 'run': run_id}
+        owner = True
+    else:
+        if live_runs.get(run_id) is None and not await off_loop(run_exists, run_id):
+            return await plain_response(send, 404, f"Run {run_id} not found")
+        try:
+            (offset, interval) = subscription(headers, args)
+            encoding = negotiate(headers, args)
+        except ValueError as e:
+            return await plain_response(send, 400, f"Invalid stream request: {e}")
+        first = {'heartbeat': True, 'run': run_id}
+        owner = False
+    if cycles is not None:
+        return await send_events(send, receive, cycle_events_async(cached_async(cycles, offset, cached_interval(args, interval)), first, None, encoding), encoding)
+    live = live_runs.get(run_id)
+    if live is None:
+        return await send_events(send, receive, cycle_events_async(run_cycles_async(None, run_id, offset, interval), first, None, encoding), encoding)
+    live.attach()
+    live.cancel_when_idle |= owner
+    try:
+        await send_events(send, receive, cycle_events_async(run_cycles_async(live, run_id, offset, interval), first, live, encoding), encoding)
+    finally:
+        live.detach()
+
+
+async def send_events(send, receive, events, encoding):
+    """Send the SSE `events` until they end or the client disconnects, whichever is first."""
+    headers = {**STREAM_HEADERS, **encoding.headers}
+    await send({"type": "http.response.start", "status": 200, "headers": [(key.lower().encode(), value.encode()) for (key, value) in headers.items()]})
+    # NOTE: events are sent from this task, which a watcher on `receive` cancels when the client disconnects
+    current = asyncio.current_task()
+    watcher = asyncio.ensure_future(disconnected(receive))
+    watcher.add_done_callback(lambda watcher: watcher.cancelled() or current.cancel())
+    try:
+        async for text in events:
+            await send({"type": "http.response.body", "body": text if isinstance(text, bytes) else text.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    except asyncio.CancelledError:
+        if not watcher.done() or watcher.cancelled():
+            raise
+        current.uncancel()
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": unquote(scope["path"], "latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 8000))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 8000))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for (key, value) in scope["headers"]:
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def wsgi(scope, receive, send):
+    """Serve a request with the Flask app in the executor, streaming its body chunk by chunk."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(key.lower().encode("latin-1"), value.encode("latin-1")) for (key, value) in headers]
+
+    # NOTE: streamed bodies push the app context in one executor call and pop it in a later one, so all the
+    # calls for a request share one context, whichever threads they land on
+    context = contextvars.copy_context()
+    result = await loop.run_in_executor(None, context.run, flask_app, wsgi_environ(scope, bytes(body)), start_response)
+    chunks = iter(result)
+    try:
+        chunk = await loop.run_in_executor(None, context.run, next, chunks, None)
+        await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+        while chunk is not None:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(None, context.run, next, chunks, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(None, context.run, result.close)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                return await send({"type": "lifespan.shutdown.complete"})
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported ASGI scope {scope['type']!r}")
+    match = STREAM_PATH.match(scope["path"]) if scope["method"] == "GET" else None
+    if match is None:
+        return await wsgi(scope, receive, send)
+    return await stream(scope, receive, send, None if match.group(1) is None else int(match.group(1)))
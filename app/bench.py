@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+
+"""
+NOTE: Micro-benchmarks for the simulation runtime. Run from the `app` directory, e.g.
+`python bench.py store --sizes 10000 100000`. To check a change for regressions, run the suite before
+and after it and compare: `python bench.py suite --output base.json`, then
+`python bench.py suite --output new.json && python bench.py compare base.json new.json`.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import threading
+import tracemalloc
+from copy import deepcopy
+from datetime import datetime
+from time import perf_counter
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+import gravity
+import modsim
+from broadcast import event
+from compiler import compile_getter
+from frames import cycle_rows, negotiate
+from modsim import data
+from nbody import NBodyEngine, sample_members, simulate_ensemble
+from simulator import Simulator, query_cache
+from store import STORES, QRangeStore
+
+
+def timed(fn, repeat=1):
+    """Return the best wall time of `repeat` calls to `fn`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def measure_store(size, lookups=1000, repeat=3):
+    """
+    Insert `size` simulator-shaped records (two agents, consecutive ranges) into a QRangeStore, then time
+    point and window lookups. Returns seconds per record or lookup.
+    """
+    store = QRangeStore()
+    step = 0.1
+
+    def insert():
+        for i in range(size // 2):
+            t = i * step
+            store[t, t + step] = {"Body1": i}
+            store[t, t + step] = {"Body2": i}
+
+    insert_s = timed(insert)
+    keys = [(i * (size // 2) // lookups) * step + step / 2 for i in range(lookups)]
+    point_s = timed(lambda: [store[k] for k in keys], repeat=repeat)
+    window_s = timed(lambda: [store.overlapping(k, k + 10 * step) for k in keys], repeat=repeat)
+    return {"insert": insert_s / size, "point": point_s / lookups, "window": window_s / lookups}
+
+
+def bench_store(sizes, lookups=1000):
+    for size in sizes:
+        seconds = measure_store(size, lookups)
+        print(f"store n={size:>8}: insert {seconds['insert'] * 1e6:8.2f} us/record, "
+              f"point {seconds['point'] * 1e6:8.2f} us/lookup, "
+              f"window {seconds['window'] * 1e6:8.2f} us/lookup")
+
+
+def bench_memory(modes, iterations, window=None, spill=False):
+    """
+    Report traced heap growth per simulation step for each store mode on the default 2-body model. With
+    `window`, the records store only keeps that many time units of records in memory, spilling the rest
+    to a temporary file if `spill` is set, so growth should stay flat however long the run.
+    """
+    for mode in modes:
+        tracemalloc.start()
+        store = QRangeStore(window=window, spill=spill) if window is not None and mode == "records" else STORES[mode]()
+        sim = Simulator(store, deepcopy(data))
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in sim.simulate(iterations):
+            pass
+        grown = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f"memory {mode:>8}: {grown / iterations:8.0f} B/step, {grown / 1e6:8.1f} MB total over {iterations} steps")
+
+
+def bench_queries(repeat=20_000):
+    """Evaluate every consumed query of `modsim.agents` with the interpreter and with compiled closures."""
+    sim = Simulator(QRangeStore(), deepcopy(data))
+    universe = sim.read(0.0)
+    newState = {}
+    for agentId in sim.init:
+        newState |= sim.step(agentId, universe)
+    sms = [(agentId, sm) for (agentId, agent) in sim.sim_graph.items() for sm in agent]
+
+    def interpreted():
+        return [[sim.find(agentId, q, universe, newState) for q in sm["consumed"]] for (agentId, sm) in sms]
+
+    def compiled():
+        return [sm["inputs"](universe, newState) for (_, sm) in sms]
+
+    if interpreted() != compiled():
+        raise AssertionError("Compiled queries disagree with the interpreter.")
+    lookups = sum(len(sm["consumed"]) for (_, sm) in sms)
+    interpreted_s = timed(lambda: [interpreted() for _ in range(repeat)])
+    compiled_s = timed(lambda: [compiled() for _ in range(repeat)])
+    print(f"queries interpreted: {interpreted_s / repeat / lookups * 1e9:8.0f} ns/lookup")
+    print(f"queries compiled:    {compiled_s / repeat / lookups * 1e9:8.0f} ns/lookup "
+          f"({interpreted_s / compiled_s:.1f}x, {lookups} lookups/step, results identical)")
+
+
+def random_bodies(n, seed=0):
+    """A reproducible universe of `n` bodies scattered in a cube, in the initial-state form `Simulator` takes."""
+    rng = np.random.default_rng(seed)
+    position = rng.uniform(-100, 100, (n, 3))
+    velocity = rng.uniform(-0.1, 0.1, (n, 3))
+    mass = rng.uniform(0.1, 1, n)
+    return {
+        f"Body{i + 1}": {
+            'time': 0.0,
+            'timeStep': 0.1,
+            'position': dict(zip('xyz', position[i].tolist())),
+            'velocity': dict(zip('xyz', velocity[i].tolist())),
+            'mass': float(mass[i]),
+        }
+        for i in range(n)
+    }
+
+
+def bench_nbody(bodies, steps):
+    """Compare the vectorized engine with the Simulator on the 2-body model, then scale up the body count."""
+    reference = list(Simulator(QRangeStore(), deepcopy(data)).simulate(steps))
+    simulator_s = timed(lambda: list(Simulator(QRangeStore(), deepcopy(data)).simulate(steps)))
+    engine = NBodyEngine(deepcopy(data))
+    vectorized = list(engine.simulate(steps))
+    error = max(
+        abs(vectorized[i][agentId][field][k] - reference[i][agentId][field][k])
+        for i in range(steps) for agentId in data for field in ('position', 'velocity') for k in 'xyz'
+    )
+    print(f"nbody simulator  n={2:>5}: {steps / simulator_s:10.0f} steps/s")
+    print(f"nbody vectorized n={2:>5}: {steps / timed(lambda: list(NBodyEngine(deepcopy(data)).simulate(steps))):10.0f} "
+          f"steps/s (max deviation from simulator {error:.1e})")
+    for n in bodies:
+        engine = NBodyEngine(random_bodies(n))
+        def run():
+            for _ in range(steps):
+                engine.step()
+        print(f"nbody kernel     n={n:>5}: {steps / timed(run):10.0f} steps/s")
+
+
+def numpy_work(timeStep, position, velocity, other_position, m_other):
+    """`propagate_velocity` plus ~1 ms of NumPy linear algebra, which releases the GIL."""
+    np.linalg.eigvalsh(np.eye(150) + abs(position['x']))
+    return modsim.propagate_velocity(timeStep, position, velocity, other_position, m_other)
+
+
+def python_work(timeStep, position, velocity, other_position, m_other):
+    """`propagate_velocity` plus ~1 ms of pure-Python arithmetic, which holds the GIL."""
+    sum(i * i for i in range(20_000))
+    return modsim.propagate_velocity(timeStep, position, velocity, other_position, m_other)
+
+
+def ring_model(n, velocity_manager):
+    """The `modsim.agents` model for `n` bodies, each attracted by the next one, with a custom velocity statemanager."""
+    model = {}
+    for i in range(n):
+        other = f"Body{(i + 1) % n + 1}"
+        sms = deepcopy(modsim.agents["Body1"])
+        sms[0]["consumed"] = sms[0]["consumed"].replace("Body2", other)
+        sms[0]["function"] = velocity_manager
+        model[f"Body{i + 1}"] = sms
+    return model
+
+
+def bench_parallel(agents, iterations, workers):
+    """Compare serial, thread-pool and process-pool stepping on ring models with expensive statemanagers."""
+    init = random_bodies(agents)
+    for (work, velocity_manager) in (("numpy", numpy_work), ("python", python_work)):
+        model = ring_model(agents, velocity_manager)
+        results = {}
+        serial_s = None
+        for parallel in (None, "thread", "process"):
+            def run():
+                sim = Simulator(QRangeStore(), deepcopy(init), model)
+                results[parallel] = list(sim.simulate(iterations, parallel=parallel, workers=workers))
+            seconds = timed(run)
+            serial_s = serial_s or seconds
+            same = "identical" if results[parallel] == results[None] else "DIFFERENT"
+            print(f"parallel {work:>6} {parallel or 'serial':>7}: {agents * iterations / seconds:8.0f} agent-steps/s "
+                  f"({serial_s / seconds:.1f}x, {same})")
+
+
+def bench_gravity(bodies, theta, iterations=3):
+    """
+    Compare the direct sum and the Barnes-Hut octree on random bodies: the time to compute every body's
+    acceleration and the octree's relative error, then whole Simulator iterations of `modsim.gravity_model`.
+    """
+    for n in bodies:
+        init = random_bodies(n)
+        positions = np.array([[state["position"][k] for k in "xyz"] for state in init.values()])
+        masses = np.array([state["mass"] for state in init.values()])
+        direct = gravity.direct_accelerations(positions, masses)
+        tree = gravity.Octree(positions, masses).accelerations(theta)
+        error = np.linalg.norm(tree - direct, axis=1) / np.linalg.norm(direct, axis=1)
+        direct_s = timed(lambda: gravity.direct_accelerations(positions, masses), 3)
+        tree_s = timed(lambda: gravity.Octree(positions, masses).accelerations(theta), 3)
+        print(f"gravity n={n:>6}: direct {direct_s * 1e3:9.2f} ms, barnes-hut {tree_s * 1e3:9.2f} ms "
+              f"({direct_s / tree_s:.1f}x, theta={theta}, median error {np.median(error):.1e}, max {error.max():.1e})")
+        sim = Simulator(QRangeStore(), deepcopy(init), modsim.gravity_model(init, theta))
+        seconds = timed(lambda: list(sim.simulate(iterations)))
+        print(f"gravity n={n:>6}: {n * iterations / seconds:9.0f} agent-steps/s over {iterations} simulator iterations")
+
+
+def resident_bytes():
+    """This process's resident memory, which unlike `tracemalloc` includes thread stacks (Linux only)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def bench_sse(connections):
+    """
+    Compare the memory held by idle SSE subscribers of one stalled live run: `asgi.app` connections, all on
+    one event loop, against the thread per connection that the WSGI server needs for `app.run_events`.
+    """
+    # NOTE: imported here since importing the app opens its database
+    import asgi
+    from app import live_runs, run_events
+
+    release = threading.Event()
+    run_id = 10**9  # NOTE: live only, so no persisted run is needed
+
+    def stalled():
+        release.wait()
+        yield from ()
+
+    def report(mode, heap, resident):
+        print(f"sse {mode:>5}: {connections} idle connections, {heap / connections:8.0f} B/connection traced heap, "
+              f"{resident / connections:8.0f} B/connection resident")
+
+    async def idle_async():
+        scope = {"type": "http", "method": "GET", "path": f"/simulation/{run_id}/stream", "query_string": b"", "headers": []}
+        (opened, gone) = (asyncio.Semaphore(0), asyncio.Event())
+
+        async def receive():
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                opened.release()
+
+        heap = tracemalloc.get_traced_memory()[0]
+        resident = resident_bytes()
+        tasks = [asyncio.ensure_future(asgi.app(scope, receive, send)) for _ in range(connections)]
+        for _ in range(connections):
+            await opened.acquire()
+        report("async", tracemalloc.get_traced_memory()[0] - heap, resident_bytes() - resident)
+        gone.set()
+        await asyncio.gather(*tasks)
+
+    def idle_threads():
+        opened = threading.Semaphore(0)
+
+        def subscriber():
+            for _ in run_events(run_id, 0, 0.0):
+                opened.release()
+
+        heap = tracemalloc.get_traced_memory()[0]
+        resident = resident_bytes()
+        threads = [threading.Thread(target=subscriber, daemon=True) for _ in range(connections)]
+        for thread in threads:
+            thread.start()
+        for _ in range(connections):
+            opened.acquire()
+        report("sync", tracemalloc.get_traced_memory()[0] - heap, resident_bytes() - resident)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    live_runs.start(run_id, stalled())
+    tracemalloc.start()
+    asyncio.run(idle_async())
+    idle_threads()
+    tracemalloc.stop()
+
+
+STREAM_MODES = [
+    "", "gzip=1", "batch=50", "batch=50&gzip=1",
+    "format=columnar", "format=columnar&dtype=f32", "format=columnar&dtype=f32&delta=1&batch=50",
+    "format=binary&dtype=f32&batch=50", "format=binary&dtype=f32&delta=1&batch=50", "format=binary&dtype=f32&delta=1&batch=50&gzip=1",
+]
+
+
+def bench_frames(bodies, cycles, subscribers=(1, 10), modes=STREAM_MODES):
+    """
+    Report the bytes and the server CPU time per cycle and subscriber of each stream encoding (see
+    `frames.py`), given as its query string, with `subscribers` following the same run in step. Cycles
+    arrive as the JSON text every subscriber shares, so serializing them is reported once, separately.
+    """
+    for n in bodies:
+        produced = list(NBodyEngine(deepcopy(data) if n == 2 else random_bodies(n)).simulate(cycles))
+        texts = [json.dumps(cycle) for cycle in produced]
+        print(f"frames n={n:>5} {'(shared json.dumps)':<60} {timed(lambda: [json.dumps(cycle) for cycle in produced], 3) / cycles * 1e6:9.1f} us/cycle")
+        for mode in modes:
+            encoding = negotiate({"Accept-Encoding": "gzip"}, dict(parse_qsl(mode)))
+            for count in subscribers:
+
+                def stream():
+                    cycle_rows.cache_clear()
+                    encoders = [encoding.encoder() for _ in range(count)]
+                    out = [encoder.control({'heartbeat': True, 'run': 1}) for encoder in encoders]
+                    for (i, text) in enumerate(texts):
+                        for encoder in encoders:
+                            out.append(encoder.cycle(i, text))
+                            if encoder.heartbeats and i % 10 == 0:
+                                out.append(encoder.control({'heartbeat': True}))
+                    for encoder in encoders:
+                        out += [encoder.flush(), encoder.control({'complete': True}), encoder.finish()]
+                    return sum(len(part) for part in out if part is not None) / count
+
+                size = stream()
+                seconds = timed(stream, 3) / count
+                print(f"frames n={n:>5} {mode or 'json (default)':<50} x{count:<3} {size / cycles:9.1f} B/cycle "
+                      f"{seconds / cycles * 1e6:9.1f} us/cycle")
+
+
+def bench_ensemble(members, iterations, sequential=10):
+    """Time one batched ensemble of `members` against `sequential` separate Simulator builds and runs."""
+    def run_sequential():
+        for _ in range(sequential):
+            list(Simulator(QRangeStore(), deepcopy(data)).simulate(iterations))
+    sequential_s = timed(run_sequential)
+    (ids, arrays) = sample_members(data, members, {'Body2.position.x': 0.5, 'Body2.velocity.y': 0.01})
+    ensemble_s = timed(lambda: simulate_ensemble(ids, arrays, iterations, stride=10))
+    print(f"ensemble {sequential:>6} sequential runs: {sequential_s:6.2f} s")
+    print(f"ensemble {members:>6} batched members: {ensemble_s:6.2f} s ({ensemble_s / sequential_s:.1f}x the sequential time)")
+
+
+def energy_drift(engine, duration):
+    """Run `engine` for `duration` time units, returning (steps, max relative energy error, wall seconds)."""
+    initial = engine.energy()
+    (steps, drift, seconds) = (0, 0.0, 0.0)
+    while engine.time[0] < duration:
+        start = perf_counter()
+        engine.step()
+        seconds += perf_counter() - start
+        steps += 1
+        drift = max(drift, abs(engine.energy() - initial) / abs(initial))
+    return (steps, drift, seconds)
+
+
+def bench_integrators(target, duration, body2_vy=None):
+    """
+    Find the coarsest setting of each integrator that holds energy drift under `target` on the default orbit,
+    or on a more eccentric one if Body2's initial y velocity is overridden.
+    """
+    configs = [
+        ("euler", False, "timeStep", [0.1 / 2**i for i in range(4)]),
+        ("leapfrog", False, "timeStep", [3.2 / 2**i for i in range(10)]),
+        ("leapfrog", True, "eta", [0.032 / 2**i for i in range(8)]),
+        ("rk45", False, "tolerance", [10.0**-i for i in range(4, 14)]),
+    ]
+    for (integrator, adaptive, knob, values) in configs:
+        label = f"{integrator}{' adaptive' if adaptive else ''}"
+        for value in values:
+            init = deepcopy(data)
+            if body2_vy is not None:
+                init["Body2"]["velocity"]["y"] = body2_vy
+            options = {"integrator": integrator, "adaptive": adaptive}
+            if knob == "timeStep":
+                for state in init.values():
+                    state["timeStep"] = value
+            else:
+                options[knob] = value
+            (steps, drift, seconds) = energy_drift(NBodyEngine(init, **options), duration)
+            if drift <= target:
+                print(f"integrator {label:>17}: {steps:8} steps, {seconds:7.3f} s ({knob}={value:.3g}, drift {drift:.1e})")
+                break
+        else:
+            print(f"integrator {label:>17}: drift target {target:.0e} not reached (best {drift:.1e} at {knob}={value:.3g})")
+
+
+# NOTE: one query of each kind, as the Body1 statemanagers would write it
+QUERY_KINDS = {
+    "Base": "velocity",
+    "Prev": "prev!(position)",
+    "Root": "root!",
+    "Agent": "agent!(Body2)",
+    "Access": "agent!(Body2).position",
+    "Tuple": "(prev!(timeStep), prev!(position), velocity, agent!(Body2).mass)",
+}
+
+
+def run_suite(quick=False, repeat=5):
+    """
+    Run the reproducible benchmark workloads and return `{name: {"value", "unit", "better"}}`. Every
+    measurement is the best of `repeat` runs; `quick` shrinks the workloads for a fast smoke check.
+    """
+    results = {}
+
+    def record(name, seconds, per, scale=1e6, unit="us"):
+        results[name] = {"value": seconds * scale, "unit": f"{unit}/{per}", "better": "lower"}
+
+    # QRangeStore insert and lookup at growing sizes
+    for size in ([1_000, 10_000] if quick else [1_000, 10_000, 100_000]):
+        seconds = measure_store(size, repeat=repeat)
+        record(f"store.insert[n={size}]", seconds["insert"], "record")
+        record(f"store.point[n={size}]", seconds["point"], "lookup")
+        record(f"store.window[n={size}]", seconds["window"], "lookup")
+
+    # Simulator.find (the interpreter) and compiled getters, per query kind
+    sim = Simulator(QRangeStore(), deepcopy(data))
+    universe = sim.read(0.0)
+    newState = {}
+    for agentId in sim.init:
+        newState |= sim.step(agentId, universe)
+    lookups = 2_000 if quick else 20_000
+    for (kind, query) in zip(QUERY_KINDS, query_cache.parse(list(QUERY_KINDS.values()))):
+        getter = compile_getter("Body1", query)
+        interpreted_s = timed(lambda: [sim.find("Body1", query, universe, newState) for _ in range(lookups)], repeat)
+        compiled_s = timed(lambda: [getter(universe, newState) for _ in range(lookups)], repeat)
+        record(f"find.interpreted[{kind}]", interpreted_s / lookups, "lookup", 1e9, "ns")
+        record(f"find.compiled[{kind}]", compiled_s / lookups, "lookup", 1e9, "ns")
+
+    # Simulator.step per agent
+    steps = 500 if quick else 5_000
+    for agentId in sim.init:
+        record(f"step[{agentId}]", timed(lambda: [sim.step(agentId, universe) for _ in range(steps)], repeat) / steps, "step")
+
+    # Simulator.simulate scaling with iterations (the store grows as it runs) and with agent count
+    for iterations in ([100, 1_000] if quick else [100, 1_000, 10_000]):
+        seconds = timed(lambda: list(Simulator(QRangeStore(), deepcopy(data)).simulate(iterations)), repeat)
+        record(f"simulate.iterations[n={iterations}]", seconds / iterations, "iteration")
+    iterations = 50 if quick else 300
+    for agents in ([2, 8] if quick else [2, 8, 32]):
+        init = random_bodies(agents)
+        model = ring_model(agents, modsim.propagate_velocity)
+        seconds = timed(lambda: list(Simulator(QRangeStore(), deepcopy(init), model).simulate(iterations)), repeat)
+        record(f"simulate.agents[n={agents}]", seconds / (agents * iterations), "agent-step")
+
+    # SSE serialization of cycles, as the producer and subscribers format them
+    for agents in (2, 32):
+        init = random_bodies(agents)
+        cycles = list(NBodyEngine(init).simulate(100))
+        record(f"sse.serialize[agents={agents}]", timed(lambda: [event(cycle, i) for (i, cycle) in enumerate(cycles)], repeat) / len(cycles), "event")
+    return results
+
+
+def calibrate(repeat=5):
+    """Time a fixed pure-Python workload, so results from machines or runs at different speeds can be compared."""
+    return timed(lambda: sum(i * i for i in range(200_000)), repeat)
+
+
+def write_suite(path, results, calibration):
+    meta = {
+        "calibration": calibration,
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+    for (name, result) in sorted(results.items()):
+        print(f"{name:<32} {result['value']:12.3f} {result['unit']}")
+    print(f"wrote {len(results)} results to {path}")
+
+
+def compare(baseline_path, current_path, threshold, normalize=False):
+    """
+    Compare two suite results files and return the names of benchmarks that got worse by more than
+    `threshold` (a fraction, e.g. 0.1 for 10%). With `normalize`, current results are first scaled by the
+    ratio of the two runs' calibration times, which cancels out a machine that is faster or slower overall.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    scale = 1.0
+    if normalize:
+        scale = baseline["meta"]["calibration"] / current["meta"]["calibration"]
+        print(f"normalizing current results by {scale:.3f} (calibration {current['meta']['calibration'] * 1e3:.2f} ms "
+              f"vs {baseline['meta']['calibration'] * 1e3:.2f} ms)")
+    (baseline, current) = (baseline["results"], current["results"])
+    regressions = []
+    for name in sorted(baseline.keys() | current.keys()):
+        if name not in current or name not in baseline:
+            print(f"{name:<32} {'only in ' + ('baseline' if name in baseline else 'current'):>40}")
+            continue
+        (before, after) = (baseline[name]["value"], current[name]["value"] * scale)
+        change = after / before - 1 if before else 0.0
+        worse = change if baseline[name]["better"] == "lower" else -change
+        status = "REGRESSION" if worse > threshold else "improved" if worse < -threshold else ""
+        if status == "REGRESSION":
+            regressions.append(name)
+        print(f"{name:<32} {before:12.3f} -> {after:12.3f} {current[name]['unit']:<14} {change:+7.1%} {status}")
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    store_parser = sub.add_parser("store", help="QRangeStore insert and lookup")
+    store_parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    memory_parser = sub.add_parser("memory", help="store memory per simulation step")
+    memory_parser.add_argument("--modes", nargs="+", default=list(STORES), choices=list(STORES))
+    memory_parser.add_argument("--iterations", type=int, default=100_000)
+    memory_parser.add_argument("--window", type=float, help="retention window of the records store, in time units")
+    memory_parser.add_argument("--spill", action="store_true", help="spill records outside the window to disk")
+    sub.add_parser("queries", help="interpreted vs compiled query evaluation")
+    nbody_parser = sub.add_parser("nbody", help="vectorized N-body engine throughput")
+    nbody_parser.add_argument("--bodies", type=int, nargs="+", default=[2, 10, 100, 500])
+    nbody_parser.add_argument("--steps", type=int, default=1000)
+    parallel_parser = sub.add_parser("parallel", help="serial vs thread/process agent stepping")
+    parallel_parser.add_argument("--agents", type=int, default=16)
+    parallel_parser.add_argument("--iterations", type=int, default=20)
+    parallel_parser.add_argument("--workers", type=int, default=4)
+    gravity_parser = sub.add_parser("gravity", help="direct sum vs Barnes-Hut accelerations for all-agent gravity")
+    gravity_parser.add_argument("--bodies", type=int, nargs="+", default=[10, 1000, 10_000])
+    gravity_parser.add_argument("--theta", type=float, default=gravity.THETA)
+    frames_parser = sub.add_parser("frames", help="bytes and CPU per cycle of each stream encoding")
+    frames_parser.add_argument("--bodies", type=int, nargs="+", default=[2, 100])
+    frames_parser.add_argument("--cycles", type=int, default=500)
+    sse_parser = sub.add_parser("sse", help="memory per idle SSE connection, async vs thread per connection")
+    sse_parser.add_argument("--connections", type=int, default=1000)
+    ensemble_parser = sub.add_parser("ensemble", help="batched ensemble vs sequential runs")
+    ensemble_parser.add_argument("--members", type=int, default=10_000)
+    ensemble_parser.add_argument("--iterations", type=int, default=500)
+    integrators_parser = sub.add_parser("integrators", help="steps and time to hold an energy drift bound")
+    integrators_parser.add_argument("--target", type=float, default=1e-6)
+    integrators_parser.add_argument("--duration", type=float, default=3000.0)
+    integrators_parser.add_argument("--body2-vy", type=float, help="e.g. 0.03 for an eccentric orbit")
+    suite_parser = sub.add_parser("suite", help="run every reproducible workload and write the results as JSON")
+    suite_parser.add_argument("--output", default="bench.json")
+    suite_parser.add_argument("--repeat", type=int, default=5)
+    suite_parser.add_argument("--quick", action="store_true", help="smaller workloads, for a smoke check")
+    compare_parser = sub.add_parser("compare", help="flag regressions between two suite results files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="tolerated slowdown, as a fraction")
+    compare_parser.add_argument("--normalize", action="store_true", help="scale by the calibration times, e.g. across machines")
+    args = parser.parse_args()
+
+    if args.bench == "store":
+        bench_store(args.sizes)
+    elif args.bench == "memory":
+        bench_memory(args.modes, args.iterations, args.window, args.spill)
+    elif args.bench == "queries":
+        bench_queries()
+    elif args.bench == "nbody":
+        bench_nbody(args.bodies, args.steps)
+    elif args.bench == "parallel":
+        bench_parallel(args.agents, args.iterations, args.workers)
+    elif args.bench == "gravity":
+        bench_gravity(args.bodies, args.theta)
+    elif args.bench == "frames":
+        bench_frames(args.bodies, args.cycles)
+    elif args.bench == "sse":
+        bench_sse(args.connections)
+    elif args.bench == "ensemble":
+        bench_ensemble(args.members, args.iterations)
+    elif args.bench == "integrators":
+        bench_integrators(args.target, args.duration, args.body2_vy)
+    elif args.bench == "suite":
+        before = calibrate(args.repeat)
+        results = run_suite(args.quick, args.repeat)
+        write_suite(args.output, results, min(before, calibrate(args.repeat)))
+    elif args.bench == "compare":
+        sys.exit(1 if compare(args.baseline, args.current, args.threshold, args.normalize) else 0)
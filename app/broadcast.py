@@ -0,0 +1,280 @@
+# LIVE RUNS
+
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Overrun(Exception):
+    """Raised to a subscriber whose next event has already been evicted from the ring buffer."""
+
+
+class RingBuffer:
+    """
+    A bounded, thread-safe buffer of the most recent `capacity` events, addressed by absolute offset.
+    The writer never waits: when the buffer is full the oldest event is evicted, and a reader still
+    positioned on it gets `Overrun` instead of stalling the writer.
+
+    >>> buffer = RingBuffer(capacity=3)
+    >>> for event in 'abcd':
+    ...     buffer.append(event)
+    >>> (buffer.start, buffer.end, buffer.read(1), buffer.read(3, limit=1))
+    (1, 4, ['b', 'c', 'd'], ['d'])
+    >>> buffer.read(0)
+    Traceback (most recent call last):
+    broadcast.Overrun: Offset 0 was evicted; the oldest buffered offset is 1
+    >>> buffer.read(4, timeout=0)
+    []
+    >>> buffer.close()
+    >>> buffer.read(4) is None
+    True
+    """
+
+    def __init__(self, capacity: int = 4096, start: int = 0):
+        self.capacity = capacity
+        self.events = deque(maxlen=capacity)
+        self.start = start  # offset of events[0]
+        self.closed = False
+        self.condition = threading.Condition()
+        self.waiters = set()  # callbacks run once, on the next append or close
+
+    @property
+    def end(self):
+        return self.start + len(self.events)
+
+    def append(self, event):
+        with self.condition:
+            if len(self.events) == self.capacity:
+                self.start += 1
+            self.events.append(event)
+            self.condition.notify_all()
+            (waiters, self.waiters) = (self.waiters, set())
+        for callback in waiters:
+            callback()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            (waiters, self.waiters) = (self.waiters, set())
+        for callback in waiters:
+            callback()
+
+    def when_ready(self, offset: int, callback):
+        """
+        Call `callback` (from the writer's thread) once an event at `offset` is available or the buffer is
+        closed. Returns False without registering it if that is already the case.
+        """
+        with self.condition:
+            if offset < self.end or self.closed:
+                return False
+            self.waiters.add(callback)
+            return True
+
+    def forget(self, callback):
+        with self.condition:
+            self.waiters.discard(callback)
+
+    def read(self, offset: int, limit: int = 64, timeout: float = None):
+        """
+        Return up to `limit` events starting at `offset`, blocking until at least one is available.
+        Returns an empty list if `timeout` passes first, or None once the buffer is closed and drained.
+        """
+        with self.condition:
+            while offset >= self.end and not self.closed:
+                if not self.condition.wait(timeout):
+                    return []
+            if offset < self.start:
+                raise Overrun(f"Offset {offset} was evicted; the oldest buffered offset is {self.start}")
+            if offset >= self.end:
+                return None
+            i = offset - self.start
+            return list(itertools.islice(self.events, i, i + limit))
+
+
+def event(data, id=None):
+    """
+    Format one SSE event from a JSON-serializable value or already serialized JSON text. Events with an
+    `id` can be resumed after with `Last-Event-ID`.
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    if id is None:
+        return f"data: {data}\n\n"
+    return f"id: {id}\ndata: {data}\n\n"
+
+
+class LiveRun:
+    """
+    A simulation run that is produced once, on a background thread, into a ring buffer that any number of
+    subscribers read from at their own pace.
+
+    A subscriber resuming after `Last-Event-ID` 6 starts at offset 7, and one that falls further behind
+    than the buffer holds is dropped with `Overrun`:
+
+    >>> run = LiveRun(1, range(10), capacity=4).start()
+    >>> run.thread.join()
+    >>> list(run.subscribe(7))
+    [(7, 7), (8, 8), (9, 9)]
+    >>> async def collect(pairs):
+    ...     return [pair async for pair in pairs]
+    >>> asyncio.run(collect(run.subscribe_async(7)))
+    [(7, 7), (8, 8), (9, 9)]
+    >>> list(run.subscribe(0))
+    Traceback (most recent call last):
+    broadcast.Overrun: Offset 0 was evicted; the oldest buffered offset is 6
+
+    A run that is `cancel_when_idle` keeps going while any subscriber is attached, and is cancelled, closing
+    its cycles, once the last one detaches:
+
+    >>> closed = threading.Event()
+    >>> def cycles():
+    ...     try:
+    ...         for i in itertools.count():
+    ...             yield i
+    ...             time.sleep(0.001)
+    ...     finally:
+    ...         closed.set()
+    >>> run = LiveRun(2, cycles()).start()
+    >>> run.cancel_when_idle = True
+    >>> (run.attach(), run.attach(), next(run.subscribe(0)), run.detach())
+    (None, None, (0, 0), None)
+    >>> (run.cancelled, run.finished)
+    (False, False)
+    >>> run.detach()
+    >>> run.thread.join(5)
+    >>> (run.cancelled, run.finished, closed.is_set())
+    (True, True, True)
+    """
+
+    def __init__(self, run_id, cycles, capacity: int = 4096, offset: int = 0):
+        self.id = run_id
+        self.buffer = RingBuffer(capacity, offset)
+        self.error = None
+        self.cancelled = False
+        self.subscribers = 0
+        self.cancel_when_idle = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.produce, args=(cycles,), daemon=True, name=f"run-{run_id}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    @property
+    def finished(self):
+        return self.buffer.closed
+
+    def produce(self, cycles):
+        cycles = iter(cycles)
+        try:
+            for cycle in cycles:
+                if self.cancelled:
+                    break
+                self.buffer.append(cycle)
+        except Exception as e:
+            logging.error(f"Error producing run {self.id}: {e}")
+            self.error = str(e)
+        finally:
+            if self.cancelled and hasattr(cycles, "close"):
+                cycles.close()
+            self.buffer.close()
+
+    def cancel(self):
+        """Stop producing after the current cycle."""
+        self.cancelled = True
+
+    def attach(self):
+        with self.lock:
+            self.subscribers += 1
+
+    def detach(self):
+        """Unsubscribe, cancelling the run if it is `cancel_when_idle` and this was its last subscriber."""
+        with self.lock:
+            self.subscribers -= 1
+            idle = self.subscribers == 0
+        if idle and self.cancel_when_idle and not self.finished:
+            logging.info(f"Cancelling run {self.id}: its last subscriber disconnected")
+            self.cancel()
+
+    def subscribe(self, offset: int = 0, interval: float = 0.0, keepalive: float = 15.0):
+        """
+        Yield `(offset, cycle)` pairs from `offset` on, at most one per `interval` seconds. Yields
+        `(None, None)` after `keepalive` seconds without new cycles. Raises `Overrun` if the subscriber
+        falls further behind than the buffer holds.
+        """
+        while True:
+            events = self.buffer.read(offset, timeout=keepalive)
+            if events is None:
+                return
+            if not events:
+                yield (None, None)
+                continue
+            for event in events:
+                yield (offset, event)
+                offset += 1
+                if interval:
+                    time.sleep(interval)
+
+    async def subscribe_async(self, offset: int = 0, interval: float = 0.0, keepalive: float = 15.0):
+        """`subscribe` for an event loop: waiting for cycles or pacing them holds no thread."""
+        loop = asyncio.get_running_loop()
+        while True:
+            events = self.buffer.read(offset, timeout=0)
+            if events is None:
+                return
+            if not events:
+                ready = loop.create_future()
+                callback = lambda: loop.call_soon_threadsafe(_resolve, ready, True)
+                if not self.buffer.when_ready(offset, callback):
+                    continue
+                timer = loop.call_later(keepalive, _resolve, ready, False)
+                try:
+                    woken = await ready
+                finally:
+                    timer.cancel()
+                    self.buffer.forget(callback)
+                if not woken:
+                    yield (None, None)
+                continue
+            for event in events:
+                yield (offset, event)
+                offset += 1
+                if interval:
+                    await asyncio.sleep(interval)
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+class LiveRuns:
+    """A registry of live runs. The `keep` most recently started finished runs stay available for replay."""
+
+    def __init__(self, capacity: int = 4096, keep: int = 16):
+        self.capacity = capacity
+        self.keep = keep
+        self.runs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, run_id, cycles, offset: int = 0):
+        """
+        Start producing `cycles` (an iterable, consumed on a background thread) as run `run_id`, numbering
+        them from `offset`, e.g. the cycles already persisted when a run is resumed.
+        """
+        run = LiveRun(run_id, cycles, self.capacity, offset)
+        with self.lock:
+            self.runs[run_id] = run
+            finished = [key for (key, other) in self.runs.items() if other.finished]
+            for key in finished[:max(0, len(finished) - self.keep)]:
+                del self.runs[key]
+        return run.start()
+
+    def get(self, run_id):
+        with self.lock:
+            return self.runs.get(run_id)
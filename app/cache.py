@@ -0,0 +1,276 @@
+# RESULT CACHE
+
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import types
+from collections import OrderedDict
+
+RESULT_CACHE = os.environ.get("SEDARO_RESULT_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "result_cache"))
+
+
+APP = os.path.dirname(os.path.abspath(__file__))
+CONSTANTS = (bool, int, float, str, tuple)
+
+
+def _in_app(module) -> bool:
+    """Whether `module` is one of the app's own modules, rather than the standard library or a dependency."""
+    path = getattr(module, "__file__", None)
+    return path is not None and os.path.dirname(os.path.abspath(path)) == APP
+
+
+def _names(code):
+    """The global and attribute names `code` and the functions and lambdas nested in it read."""
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _names(const)
+
+
+def _function_sources(func, seen):
+    """
+    Yield the source of `func` and of what it calls, each once: module-level functions called by name, and
+    the functions and classes of the app's own modules called through them, e.g. `gravity.accelerations`.
+    Default arguments and the module-level constants it reads, e.g. `gravity.THETA`, are included too.
+    """
+    if func in seen:
+        return
+    seen.add(func)
+    if isinstance(func, functools.partial):
+        yield repr((func.args, sorted(func.keywords.items())))
+        yield from _function_sources(func.func, seen)
+        return
+    if isinstance(func, type):
+        yield inspect.getsource(func)
+        for member in vars(func).values():
+            if isinstance(member, types.FunctionType):
+                yield from _function_sources(member, seen)
+        return
+    try:
+        yield inspect.getsource(func)
+    except (OSError, TypeError):
+        yield func.__code__.co_code.hex()
+    yield repr((func.__defaults__, func.__kwdefaults__))
+    names = list(dict.fromkeys(_names(func.__code__)))
+    for name in names:
+        other = func.__globals__.get(name)
+        if isinstance(other, CONSTANTS):
+            yield f"{name} = {other!r}"
+        elif isinstance(other, types.FunctionType):
+            yield from _function_sources(other, seen)
+        elif isinstance(other, type) and _in_app(inspect.getmodule(other)):
+            yield from _function_sources(other, seen)
+        elif isinstance(other, types.ModuleType) and _in_app(other):
+            # NOTE: attribute names aren't tied to their module in bytecode, so every name read is tried on it
+            for attr in names:
+                value = getattr(other, attr, None)
+                if isinstance(value, CONSTANTS):
+                    yield f"{other.__name__}.{attr} = {value!r}"
+                elif isinstance(value, (types.FunctionType, type)) and _in_app(inspect.getmodule(value)):
+                    yield from _function_sources(value, seen)
+
+
+@functools.lru_cache(maxsize=None)
+def module_fingerprint(module) -> str:
+    """
+    Hash the source of `module` and of the app's own modules it uses, whether imported whole or by name,
+    so editing any of them invalidates results cached for an engine defined there.
+    """
+    modules = {module}
+    for value in vars(module).values():
+        other = value if isinstance(value, types.ModuleType) else inspect.getmodule(value)
+        if other is not None and _in_app(other):
+            modules.add(other)
+    digest = hashlib.sha256()
+    for other in sorted(modules, key=lambda m: m.__name__):
+        digest.update(inspect.getsource(other).encode())
+    return digest.hexdigest()
+
+
+def model_fingerprint(model: dict) -> str:
+    """
+    Hash a model definition: each agent's queries and the source of its functions (and of the functions
+    they call), so editing any of them invalidates results cached for the old model.
+    """
+    seen = set()
+    canonical = {
+        agentId: [
+            {"consumed": sm["consumed"], "produced": sm["produced"], "function": list(_function_sources(sm["function"], seen))}
+            for sm in sms
+        ]
+        for (agentId, sms) in model.items()
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def result_key(model: dict, init: dict, iterations: int, options: dict, engine=None) -> str:
+    """
+    The cache key of a run: a hash of the model, the initial state, the iteration count and the simulator
+    options that change results. `engine` is the module that runs the model, by default `simulator`, whose
+    source (see `module_fingerprint`) also determines results.
+
+    Editing a function the model calls, directly or through an app module, changes the key:
+
+    >>> import gravity
+    >>> def offset(x):
+    ...     return x + 1
+    >>> def step(x):
+    ...     return offset(x) * gravity.THETA
+    >>> (model, init) = ({'A': [{'consumed': '(prev!(x),)', 'produced': 'x', 'function': step}]}, {'A': {'x': 0}})
+    >>> key = result_key(model, init, 10, {})
+    >>> def offset(x):
+    ...     return x + 2
+    >>> result_key(model, init, 10, {}) == key
+    False
+    >>> (theta, gravity.THETA) = (gravity.THETA, 0.25)
+    >>> result_key(model, init, 10, {}) == key
+    False
+    >>> gravity.THETA = theta
+
+    So does the engine, or a change to its source:
+
+    >>> import importlib.util, tempfile
+    >>> import nbody
+    >>> result_key(model, init, 10, {}, engine=nbody) == result_key(model, init, 10, {})
+    False
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> def engine(version):
+    ...     path = os.path.join(directory.name, f"engine{version}.py")
+    ...     with open(path, "w") as f:
+    ...         print("def simulate():", file=f)
+    ...         print(f"    return {version}", file=f)
+    ...     spec = importlib.util.spec_from_file_location(f"engine{version}", path)
+    ...     module = importlib.util.module_from_spec(spec)
+    ...     spec.loader.exec_module(module)
+    ...     return module
+    >>> result_key(model, init, 10, {}, engine=engine(1)) == result_key(model, init, 10, {}, engine=engine(2))
+    False
+    >>> directory.cleanup()
+    """
+    if engine is None:
+        import simulator as engine  # NOTE: imported here, as the simulator's own imports are heavy
+    canonical = {
+        "model": model_fingerprint(model),
+        "engine": module_fingerprint(engine),
+        "init": init,
+        "iterations": iterations,
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    A two-tier cache of finished runs, keyed by `result_key`. Each entry is a run's cycles as JSON lines.
+    The memory tier holds up to `memory_bytes` and the disk tier (files under `path`) up to `disk_bytes`,
+    each evicting the least recently used entries first. Disk hits are promoted to memory.
+    Entries larger than `entry_bytes` are not cached.
+
+    >>> import tempfile
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> cache = ResultCache(directory.name, memory_bytes=25, disk_bytes=25)
+    >>> for key in "abc":
+    ...     cache.put(key, ["01234", "5678"])
+    >>> (list(cache.memory), sorted(os.listdir(directory.name)))
+    (['b', 'c'], ['b.ndjson', 'c.ndjson'])
+    >>> (cache.get("a"), cache.get("b"))
+    (None, ['01234', '5678'])
+    >>> cache.put("d", ["0123456789"])
+    >>> list(cache.memory)  # 'b' was read more recently than 'c'
+    ['b', 'd']
+    >>> {name: cache.stats()[name] for name in ("memory_evictions", "disk_evictions", "misses")}
+    {'memory_evictions': 2, 'disk_evictions': 2, 'misses': 1}
+    >>> other = ResultCache(directory.name)
+    >>> (other.get("d"), other.stats()["disk_hits"], list(other.memory))
+    (['0123456789'], 1, ['d'])
+    >>> directory.cleanup()
+    """
+
+    def __init__(self, path=RESULT_CACHE, memory_bytes=64 << 20, disk_bytes=1 << 30, entry_bytes=16 << 20):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.entry_bytes = entry_bytes
+        self.memory = OrderedDict()  # key -> bytes, least recently used first
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "memory_evictions": 0, "disk_evictions": 0}
+
+    def file(self, key):
+        return os.path.join(self.path, f"{key}.ndjson")
+
+    def get(self, key):
+        """Return the cached cycles of run `key` as a list of JSON strings, or None."""
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return data.decode().splitlines()
+            try:
+                with open(self.file(key), "rb") as f:
+                    data = f.read()
+                os.utime(self.file(key))  # NOTE: mtime orders the disk tier for eviction
+            except OSError:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self.remember(key, data)
+            return data.decode().splitlines()
+
+    def put(self, key, cycles):
+        """Cache the cycles of run `key`, given as a list of JSON strings."""
+        data = "\n".join(cycles).encode()
+        if len(data) > self.entry_bytes:
+            return
+        with self.lock:
+            self.counters["stores"] += 1
+            self.remember(key, data)
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with open(self.file(key) + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(self.file(key) + ".tmp", self.file(key))
+                self.trim_disk()
+            except OSError as e:
+                logging.warning(f"Could not write result cache entry {key}: {e}")
+
+    def remember(self, key, data):
+        """Add an entry to the memory tier, evicting the least recently used entries over the cap."""
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_size -= len(previous)
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes:
+            (_, evicted) = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+            self.counters["memory_evictions"] += 1
+
+    def trim_disk(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".ndjson"):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for (_, entrySize, name) in sorted(entries):
+            if size <= self.disk_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            size -= entrySize
+            self.counters["disk_evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_size,
+                "memory_limit": self.memory_bytes,
+                "disk_limit": self.disk_bytes,
+            }
@@ -0,0 +1,107 @@
+# CHECKPOINTS
+
+"""
+Checkpoints let a long run resume where it stopped. A run resumed from one produces the same cycles as
+if it had never stopped, here with `Body2` picking its steps from its last four positions through
+`history!`, so the agents fall out of step and are due at different times:
+
+>>> import tempfile
+>>> from modsim import agents, data
+>>> from simulator import Simulator
+>>> from store import QRangeStore
+>>> def paced(ys):
+...     return 0.1 + (ys[-1] - ys[0]) / 100
+>>> model = {**agents, 'Body2': [*agents['Body2'][:-1], {'consumed': '(history!(position.y, 4),)', 'produced': 'timeStep', 'function': paced}]}
+>>> uninterrupted = list(Simulator(QRangeStore(), data, model).simulate(400))
+>>> directory = tempfile.TemporaryDirectory()
+>>> checkpointer = Checkpointer(os.path.join(directory.name, 'run.json'), every=200, history={'run': 1})
+>>> first = list(Simulator(QRangeStore(), data, model).simulate(200, checkpointer=checkpointer))
+>>> checkpointer.close()
+>>> checkpoint = load_checkpoint(checkpointer.path)
+>>> (checkpoint['iteration'], checkpoint['history'], [agentId for (agentId, *_) in checkpoint['records']])
+(200, {'run': 1}, ['Body1', 'Body1', 'Body2', 'Body2', 'Body2', 'Body2'])
+>>> resumed = list(Simulator.from_checkpoint(checkpoint, model=model).simulate(200))
+>>> (first + resumed == uninterrupted, {len(cycle) for cycle in uninterrupted})
+(True, {1, 2})
+
+Every record kept matters: without `Body2`'s oldest, its `history!` is cut short and the run goes differently:
+
+>>> oldest = [agentId for (agentId, *_) in checkpoint['records']].index('Body2')
+>>> checkpoint['records'].pop(oldest)[0]
+'Body2'
+>>> list(Simulator.from_checkpoint(checkpoint, model=model).simulate(200)) == resumed
+False
+>>> directory.cleanup()
+"""
+
+import json
+import logging
+import os
+import threading
+
+CHECKPOINTS = os.environ.get("SEDARO_CHECKPOINTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "checkpoints"))
+
+
+def load_checkpoint(path):
+    """Read a checkpoint written by `Checkpointer`, or return None if there is none at `path`."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class Checkpointer:
+    """
+    Writes `Simulator.checkpoint()` snapshots to `path` on a background thread, replacing the file atomically,
+    so the stepping thread only pays for taking the snapshot. If a write is still in progress when the next
+    snapshot arrives, the pending one is replaced: only the latest checkpoint matters.
+
+    Args:
+        path (str): The checkpoint file.
+        every (int): Checkpoint after every `every` iterations of `Simulator.simulate`.
+        history (dict): Extra fields saved with every checkpoint, e.g. the persisted run it belongs to.
+    """
+
+    def __init__(self, path, every: int = 1000, history: dict = None):
+        self.path = path
+        self.every = every
+        self.history = history or {}
+        self.pending = None
+        self.written = None  # the iteration of the last checkpoint written
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"checkpoint-{os.path.basename(path)}")
+        self.thread.start()
+
+    def submit(self, snapshot):
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                (snapshot, self.pending) = (self.pending, None)
+            try:
+                self.write({**snapshot, "history": self.history})
+                self.written = snapshot["iteration"]
+            except (OSError, TypeError, ValueError) as e:
+                logging.error(f"Could not write checkpoint {self.path}: {e}")
+
+    def write(self, checkpoint):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(checkpoint, f, separators=(",", ":"))
+        os.replace(self.path + ".tmp", self.path)
+
+    def close(self):
+        """Write any pending checkpoint and stop the writer thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,279 @@
+# QUERY COMPILER
+
+"""
+Turns parsed queries (the JSON produced by `sedaro-nano-queries`) into specialised Python closures,
+once, when a Simulator is built. A compiled getter has the signature `getter(universe, newState)` and
+a compiled setter `setter(universe, newState, data)`; they behave exactly like `Simulator.find` and
+`Simulator.put`, but the query tree is resolved ahead of time, so a lookup is a fixed sequence of
+dictionary reads with no `match` on `kind` and no recursion.
+
+`history!` and `at!` read past states through the universe (see `simulator.Universe`), which keeps a
+bounded tail of each agent's committed states, so their cost does not grow with the length of a run.
+
+Compiled getters return what the reference interpreter does, with `prev!` hoisted from either side of
+an access, and None propagated when data is not ready yet:
+
+>>> from simulator import Simulator
+>>> sim = Simulator.__new__(Simulator)
+>>> B = lambda name: {'kind': 'Base', 'content': name}
+>>> A = lambda base, field: {'kind': 'Access', 'content': {'base': base, 'field': field}}
+>>> P = lambda query: {'kind': 'Prev', 'content': query}
+>>> T = lambda *queries: {'kind': 'Tuple', 'content': list(queries)}
+>>> universe = {'A': {'time': 0, 'position': {'x': 1, 'y': {'z': 4}}}, 'B': {'mass': 2}}
+>>> newState = {'A': {'velocity': {'x': 3}}}
+>>> queries = [
+...     A(P(B('position')), 'x'), P(A(B('position'), 'x')), A(A(P(B('position')), 'y'), 'z'),
+...     A(B('velocity'), 'x'), A(B('missing'), 'x'), A({'kind': 'Agent', 'content': 'B'}, 'mass'),
+...     T(P(B('time')), B('velocity')), T(P(B('time')), B('missing')), P(T(B('time'), A(B('position'), 'x'))),
+... ]
+>>> [compile_getter('A', q)(universe, newState) for q in queries]
+[1, 1, 4, 3, None, 2, [0, {'x': 3}], None, [0, 1]]
+>>> [sim.find('A', q, universe, newState) for q in queries]
+[1, 1, 4, 3, None, 2, [0, {'x': 3}], None, [0, 1]]
+>>> compile_getter('A', B('velocity'))(universe, {})
+
+Compiled setters build the same new state as `Simulator.put`, creating the dictionaries an access needs:
+
+>>> produced = [
+...     (A(B('position'), 'x'), 5), (A(A(B('orbit'), 'apsis'), 'r'), 7), (B('mass'), 1), (A(B('position'), 'y'), 6),
+... ]
+>>> (compiled, interpreted) = ({}, {})
+>>> for (q, data) in produced:
+...     compile_setter('A', q)(universe, compiled, data)
+...     sim.put('A', q, universe, interpreted, data)
+>>> compiled
+{'A': {'position': {'x': 5, 'y': 6}, 'orbit': {'apsis': {'r': 7}}, 'mass': 1}}
+>>> compiled == interpreted
+True
+>>> compile_setter('A', P(B('time')))
+Traceback (most recent call last):
+Exception: Cannot produce prev query {'kind': 'Prev', 'content': {'kind': 'Base', 'content': 'time'}}
+"""
+
+
+def _flatten(query):
+    """
+    Split a query into its source node, whether it reads the previous step, and the chain of fields
+    accessed on it. `prev!` only ever switches lookups beneath it to the previous step, so the flag can
+    be hoisted: `prev!(a.b).c` and `prev!(a).b.c` compile to the same lookup.
+    """
+    fields = []
+    prev = False
+    while True:
+        match query["kind"]:
+            case "Access":
+                fields.append(query["content"]["field"])
+                query = query["content"]["base"]
+            case "Prev":
+                prev = True
+                query = query["content"]
+            case _:
+                fields.reverse()
+                return (query, prev, tuple(fields))
+
+
+def _compile_source(agentId, query, prev):
+    """Compile a query node that is not an `Access` or `Prev`."""
+    match query["kind"]:
+        case "Base":
+            name = query["content"]
+            if prev:
+                return lambda universe, newState: universe[agentId][name]
+
+            def base(universe, newState):
+                agentState = newState.get(agentId)
+                if agentState is None:
+                    return None
+                return agentState.get(name)
+            return base
+        case "Root":
+            if prev:
+                return lambda universe, newState: universe[agentId]
+            return lambda universe, newState: newState
+        case "Agent":
+            # agent always gets the previous state
+            other = query["content"]
+            return lambda universe, newState: universe[other]
+        case "Agents":
+            # every agent's previous state, as the read-only universe itself
+            return lambda universe, newState: universe
+        case "Tuple":
+            return compile_inputs(agentId, query["content"], prev)
+        case "History":
+            # the inner query, as of each of the agent's last `n` committed states, oldest first
+            get = compile_getter(agentId, _own_history(query), prev=True)
+            n = query["content"]["n"]
+
+            def history(universe, newState):
+                values = []
+                for past in universe.history(agentId, n):
+                    value = get(past, newState)
+                    if value is None:
+                        return None
+                    values.append(value)
+                return values
+            return history
+        case "At":
+            # the inner query against the universe `dt` before the agent's previous state
+            get = compile_getter(agentId, query["content"]["query"], prev=True)
+            dt = query["content"]["dt"]
+            return lambda universe, newState: get(universe.past(universe[agentId]["time"] - dt), newState)
+        case _:
+            return lambda universe, newState: None
+
+
+def _own_history(query):
+    """The query a `history!` node evaluates, which may only read the agent's own states."""
+    inner = query["content"]["query"]
+    if any(node["kind"] in ("Agent", "Agents", "History", "At") for node in _nodes(inner)):
+        raise Exception(f"history! can only read the agent's own state, use at! for other agents: {query}")
+    return inner
+
+
+def _nodes(query):
+    """Every node of a query tree, parents first."""
+    yield query
+    match query["kind"]:
+        case "Prev":
+            yield from _nodes(query["content"])
+        case "Access":
+            yield from _nodes(query["content"]["base"])
+        case "Tuple":
+            for q in query["content"]:
+                yield from _nodes(q)
+        case "History" | "At":
+            yield from _nodes(query["content"]["query"])
+
+
+def past_reads(query):
+    """
+    How far back a query reads, as `(n, dt)`: the most states any `history!` in it takes, and the
+    furthest any `at!` looks back, or None if it has neither.
+    """
+    nodes = [node["content"] for node in _nodes(query) if node["kind"] in ("History", "At")]
+    if not nodes:
+        return None
+    return (max(node.get("n", 0) for node in nodes), max(node.get("dt", 0.0) for node in nodes))
+
+
+def compile_getter(agentId, query, prev=False):
+    """Compile a query into a `getter(universe, newState)` that returns None if data is not ready yet."""
+    (source, prevQuery, fields) = _flatten(query)
+    prev = prev or prevQuery
+    get = _compile_source(agentId, source, prev)
+    if not fields:
+        return get
+    if source["kind"] == "Base" and not prev and len(fields) == 1:
+        # NOTE: the most common current-step form, `field.sub`, is inlined into a single closure
+        name = source["content"]
+        (field,) = fields
+
+        def base_access(universe, newState):
+            agentState = newState.get(agentId)
+            if agentState is None:
+                return None
+            value = agentState.get(name)
+            if value is None:
+                return None
+            return value.get(field)
+        return base_access
+    if len(fields) == 1:
+        (field,) = fields
+
+        def access(universe, newState):
+            value = get(universe, newState)
+            if value is None:
+                return None
+            return value.get(field)
+        return access
+
+    def access_chain(universe, newState):
+        value = get(universe, newState)
+        for field in fields:
+            if value is None:
+                return None
+            value = value.get(field)
+        return value
+    return access_chain
+
+
+def compile_inputs(agentId, queries, prev=False):
+    """Compile the members of a consumed tuple into a getter returning the argument list, or None."""
+    getters = tuple(compile_getter(agentId, q, prev) for q in queries)
+
+    def inputs(universe, newState):
+        args = []
+        for get in getters:
+            found = get(universe, newState)
+            if found is None:
+                return None
+            args.append(found)
+        return args
+    return inputs
+
+
+def compile_setter(agentId, query):
+    """Compile a produced query into a `setter(universe, newState, data)`."""
+    match query["kind"]:
+        case "Base":
+            name = query["content"]
+
+            def base(universe, newState, data):
+                agentState = newState.get(agentId)
+                if agentState is None:
+                    agentState = {}
+                    newState[agentId] = agentState
+                agentState[name] = data
+            return base
+        case "Prev" | "History" | "At":
+            raise Exception(f"Cannot produce prev query {query}")
+        case "Root" | "Agent" | "Agents":
+            return lambda universe, newState, data: None
+        case "Access":
+            baseQuery = query["content"]["base"]
+            field = query["content"]["field"]
+            get = compile_getter(agentId, baseQuery)
+            put = compile_setter(agentId, baseQuery)
+
+            def access(universe, newState, data):
+                base = get(universe, newState)
+                if base is None:
+                    base = {}
+                    put(universe, newState, base)
+                base[field] = data
+            return access
+        case "Tuple":
+            raise Exception(f"Tuple production not yet implemented")
+        case _:
+            return lambda universe, newState, data: None
+
+
+def consumed_fields(query, prev=False):
+    """
+    Return the set of the agent's current-step fields that a query reads, which is what orders its
+    State Manager after others. `None` in the set stands for `root!`, which reads the whole new state.
+    """
+    match query["kind"]:
+        case "Base":
+            return set() if prev else {query["content"]}
+        case "Root":
+            return set() if prev else {None}
+        case "Prev":
+            return consumed_fields(query["content"], True)
+        case "Access":
+            return consumed_fields(query["content"]["base"], prev)
+        case "Tuple":
+            return set().union(*(consumed_fields(q, prev) for q in query["content"]))
+        case _:
+            return set()
+
+
+def produced_field(query):
+    """Return the top-level field of the agent's new state that a produced query writes, if any."""
+    match query["kind"]:
+        case "Base":
+            return query["content"]
+        case "Access":
+            return produced_field(query["content"]["base"])
+        case _:
+            return None
@@ -0,0 +1,297 @@
+# EXPORT
+
+"""
+Columnar exports of runs for offline analysis. A run is written one chunk at a time, as one row per
+agent per cycle, ordered by cycle then agent, with columns:
+- `agent`: the agent's index into the run's agent ids (in Arrow and Parquet, a dictionary column of the ids,
+  and in NPZ, a separate `agents` array).
+- `cycle`: the cycle's index in the run.
+- `time`, `position.x`, `position.y`, `position.z`, `velocity.x`, `velocity.y` and `velocity.z`.
+
+The formats are:
+- `arrow`: an Arrow IPC file with a record batch per chunk.
+- `parquet`: a Parquet file with a row group per chunk.
+- `npz`: an uncompressed NumPy `.npz` with a member per column. Columns are spooled to disk, so memory
+  stays bounded. Members are aligned so they can be memory mapped.
+
+`load` opens an Arrow or NPZ export memory mapped, so columns are read from the page cache without
+copying. Parquet is decoded into memory. Arrow and Parquet need `pyarrow`, which is optional.
+
+An NPZ export holds every row, with each member's data aligned so `load_npz` maps it in place, and reads
+back the same as `np.load`:
+
+>>> cycles = [{f'A{k}': {'time': t / 10, 'position': {'x': t + k / 7, 'y': k / 3, 'z': -t},
+...                      'velocity': {'x': 1.0, 'y': k, 'z': t / 7}} for k in range(3 if t % 3 else 2)}
+...           for t in range(7)]
+>>> directory = tempfile.TemporaryDirectory()
+>>> path = os.path.join(directory.name, 'run.npz')
+>>> export(cycle_chunks(cycles, size=3), ['A0', 'A1', 'A2'], 'npz', path)
+18
+>>> columns = load_npz(path)
+>>> [(name, column.offset % ALIGN) for (name, column) in columns.items() if column.offset % ALIGN]
+[]
+>>> reference = np.load(path)
+>>> sorted(reference.files) == sorted(columns) == sorted(['agents', *COLUMNS])
+True
+>>> all(np.array_equal(columns[name], reference[name]) for name in reference.files)
+True
+>>> rows = [(int(agentId[1:]), t, state['time'], *state['position'].values(), *state['velocity'].values())
+...         for (t, cycle) in enumerate(cycles) for (agentId, state) in cycle.items()]
+>>> list(zip(*(columns[name].tolist() for name in COLUMNS))) == rows
+True
+
+Arrow and Parquet exports hold the same rows, with agent ids in place of indices. This needs `pyarrow`,
+which the shipped requirements leave out, so the check is skipped; run it by hand where it is installed:
+
+>>> def same(format):
+...     path = os.path.join(directory.name, 'run' + FORMATS[format])
+...     export(cycle_chunks(cycles, size=3), ['A0', 'A1', 'A2'], format, path)
+...     table = load(path)
+...     return (table.column('agent').to_pylist() == [str(columns['agents'][i]) for i in columns['agent']]
+...             and all(table.column(name).to_pylist() == columns[name].tolist() for name in list(COLUMNS)[1:]))
+>>> [same(format) for format in ('arrow', 'parquet')]  # doctest: +SKIP
+[True, True]
+>>> directory.cleanup()
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+from runs import CHUNK_CYCLES, cycle_columns
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # NOTE: only the Arrow and Parquet formats need it
+    pa = pq = None
+
+EXPORTS = os.environ.get("SEDARO_EXPORTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "exports"))
+FORMATS = {"arrow": ".arrow", "parquet": ".parquet", "npz": ".npz"}
+MIMETYPES = {"arrow": "application/vnd.apache.arrow.file", "parquet": "application/vnd.apache.parquet", "npz": "application/octet-stream"}
+COLUMNS = {
+    "agent": np.int32, "cycle": np.int64, "time": np.float64,
+    **{f"{field}.{k}": np.float64 for field in ("position", "velocity") for k in "xyz"},
+}
+ALIGN = 64  # NPZ member data alignment
+ALIGN_EXTRA = 0xD935  # the zip extra field id zipalign pads with
+
+
+def chunk_rows(agents: list, start: int, columns: dict) -> dict:
+    """
+    The rows of a decoded chunk (see `runs.decode_chunk`) whose first cycle is `start` in the run, as
+    `COLUMNS` arrays. Agents not yet in `agents` are appended to it.
+    """
+    index = {agentId: i for (i, agentId) in enumerate(agents)}
+    for agentId in columns:
+        if agentId not in index:
+            index[agentId] = len(agents)
+            agents.append(agentId)
+    parts = {name: [] for name in COLUMNS}
+    for (agentId, agent) in columns.items():
+        n = len(agent["time"])
+        parts["agent"].append(np.full(n, index[agentId], dtype=np.int32))
+        parts["cycle"].append(agent["cycle"].astype(np.int64) + start)
+        parts["time"].append(agent["time"])
+        for field in ("position", "velocity"):
+            for (axis, k) in enumerate("xyz"):
+                parts[f"{field}.{k}"].append(agent[field][:, axis])
+    rows = {name: np.concatenate(part).astype(COLUMNS[name], copy=False) if part else np.empty(0, COLUMNS[name]) for (name, part) in parts.items()}
+    order = np.lexsort((rows["agent"], rows["cycle"]))
+    return {name: column[order] for (name, column) in rows.items()}
+
+
+def cycle_chunks(cycles, size: int = CHUNK_CYCLES):
+    """
+    Group cycles as the simulator yields them, e.g. from `Simulator.simulate` or a store, into the
+    `(count, columns)` chunks `export` takes, without holding more than one chunk.
+    """
+    rows = []
+    for cycle in cycles:
+        rows.append(cycle)
+        if len(rows) == size:
+            yield (len(rows), cycle_columns(rows))
+            rows = []
+    if rows:
+        yield (len(rows), cycle_columns(rows))
+
+
+def require(format: str):
+    """Raise ValueError for an unknown format, or RuntimeError if it needs pyarrow and that is not installed."""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {', '.join(FORMATS)}")
+    if format != "npz" and pa is None:
+        raise RuntimeError(f"Exporting {format} needs pyarrow, which is not installed")
+
+
+def export(chunks, agents, format: str, path: str) -> int:
+    """
+    Write `(count, columns)` chunks (of `count` cycles each) to `path` in `format`, one chunk at a time,
+    and return the number of rows. `agents` are the run's agent ids, in the order `agent` indexes them;
+    Arrow files can't add agents part way, so it should list them all. The file is written next to `path`
+    and moved into place once it is complete.
+    """
+    require(format)
+    agents = list(agents)
+    (fd, partial) = tempfile.mkstemp(".partial", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    writer = {"arrow": ArrowWriter, "parquet": ParquetWriter, "npz": NpzWriter}[format](partial)
+    total = 0
+    start = 0
+    try:
+        for (count, columns) in chunks:
+            rows = chunk_rows(agents, start, columns)
+            writer.write(rows, agents)
+            start += count
+            total += len(rows["cycle"])
+        writer.close(agents)
+    except BaseException:
+        writer.abort()
+        raise
+    os.replace(partial, path)
+    return total
+
+
+class ArrowWriter:
+    """Writes chunks as record batches of an Arrow IPC file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def batch(self, rows, agents):
+        dictionary = pa.array(agents, pa.string())
+        arrays = [pa.DictionaryArray.from_arrays(pa.array(rows["agent"]), dictionary)]
+        arrays += [pa.array(rows[name]) for name in list(COLUMNS)[1:]]
+        return pa.RecordBatch.from_arrays(arrays, names=list(COLUMNS))
+
+    def open(self, schema):
+        return pa.ipc.new_file(self.path, schema)
+
+    def put(self, batch):
+        self.writer.write_batch(batch)
+
+    def write(self, rows, agents):
+        batch = self.batch(rows, agents)
+        if self.writer is None:
+            self.writer = self.open(batch.schema)
+        self.put(batch)
+
+    def close(self, agents):
+        if self.writer is None:
+            self.write({name: np.empty(0, dtype) for (name, dtype) in COLUMNS.items()}, agents)
+        self.writer.close()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ParquetWriter(ArrowWriter):
+    """Writes chunks as row groups of a Parquet file."""
+
+    def open(self, schema):
+        return pq.ParquetWriter(self.path, schema)
+
+    def put(self, batch):
+        self.writer.write_table(pa.Table.from_batches([batch]))
+
+
+class NpzWriter:
+    """
+    Writes chunks to an uncompressed `.npz`. Each column is appended to a spool file as chunks arrive,
+    since a `.npy` header needs the final length, and the spools are copied into the archive at the end.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.spool = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+        self.files = {name: open(os.path.join(self.spool.name, name), "wb") for name in COLUMNS}
+
+    def write(self, rows, agents):
+        for (name, column) in rows.items():
+            self.files[name].write(np.ascontiguousarray(column).tobytes())
+
+    def close(self, agents):
+        for file in self.files.values():
+            file.close()
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_STORED) as archive:
+            self.member(archive, "agents", np.array(agents, dtype=str), None)
+            for (name, dtype) in COLUMNS.items():
+                self.member(archive, name, np.empty(0, dtype), self.files[name].name)
+        self.spool.cleanup()
+
+    def member(self, archive, name, array, spooled):
+        """Add `name.npy`, with its data aligned to `ALIGN` bytes: `array`, or `spooled` data of its dtype."""
+        shape = (os.path.getsize(spooled) // array.itemsize,) if spooled else array.shape
+        header = _npy_header(array.dtype, shape)
+        info = zipfile.ZipInfo(f"{name}.npy", (1980, 1, 1, 0, 0, 0))
+        info.file_size = len(header) + (os.path.getsize(spooled) if spooled else array.nbytes)
+        # NOTE: a local header is 30 bytes, the name, and the extra field, which with zip64 gains 20 bytes
+        start = archive.fp.tell() + 30 + len(info.filename.encode()) + 4 + 20 + len(header)
+        info.extra = struct.pack("<HH", ALIGN_EXTRA, -start % ALIGN) + bytes(-start % ALIGN)
+        with archive.open(info, "w", force_zip64=True) as member:
+            member.write(header)
+            if spooled:
+                with open(spooled, "rb") as f:
+                    shutil.copyfileobj(f, member, 1 << 20)
+            else:
+                member.write(array.tobytes())
+
+    def abort(self):
+        for file in self.files.values():
+            file.close()
+        self.spool.cleanup()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _npy_header(dtype, shape) -> bytes:
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": tuple(shape)}
+    text = repr(header).encode("latin1")
+    # NOTE: the magic string, version and length take 10 bytes; pad the header to a multiple of 64
+    text += b" " * (-(10 + len(text) + 1) % 64) + b"\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(text)) + text
+
+
+def load(path: str):
+    """
+    Open an export. Arrow files are memory mapped as a `pyarrow.Table`, and NPZ exports as a dict of
+    read-only `np.memmap` columns (plus the `agents` ids). Parquet is read into memory as a Table.
+    """
+    if path.endswith(FORMATS["npz"]):
+        return load_npz(path)
+    if pa is None:
+        raise RuntimeError("Loading Arrow or Parquet exports needs pyarrow, which is not installed")
+    if path.endswith(FORMATS["parquet"]):
+        return pq.read_table(path, memory_map=True)
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+def load_npz(path: str) -> dict:
+    """Memory map every member of an uncompressed `.npz`, e.g. one written by `export`, without copying."""
+    columns = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} in {path} is compressed, so it can't be memory mapped")
+            f.seek(info.header_offset)
+            (nameLength, extraLength) = struct.unpack("<26xHH", f.read(30))
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            (shape, fortran, dtype) = read_header(f)
+            name = info.filename.removesuffix(".npy")
+            if dtype.hasobject:
+                raise ValueError(f"{info.filename} in {path} holds Python objects, so it can't be memory mapped")
+            if not np.prod(shape):
+                columns[name] = np.empty(shape, dtype)
+            else:
+                columns[name] = np.memmap(path, dtype, "r", f.tell(), shape, "F" if fortran else "C")
+    return columns
@@ -0,0 +1,300 @@
+# STREAM FRAMES
+
+"""
+Negotiable encodings for the cycle stream. The default is one SSE event of JSON text per cycle, with a
+heartbeat every 10 cycles, exactly as before. A subscriber can instead ask for:
+- `batch=N`: N cycles per event, ending with the last cycle's id, so `Last-Event-ID` still resumes.
+- `format=columnar`: each batch as arrays, base64 encoded in a JSON event: `time` (float64) and `state`
+  (position then velocity, `dtype` float32 or float64) per row, where rows are every agent present in
+  each cycle, in cycle order, indexed by the `cycle` and `agent` arrays (uint16, or uint32 as the
+  header's `index` says when a batch has more agents than uint16 counts; left out if `dense`, when every
+  cycle has every agent in the same order, so rows are simply cycle-major).
+- `format=binary`: the same batches in an `application/octet-stream` body instead of SSE, as frames of
+  a `<IB` length and kind, then the payload: kind 0 is a JSON control message (heartbeat, completion or
+  error), kind 1 a `<I`-length-prefixed JSON header followed by the raw arrays. See `decode_frames`.
+- `delta=1` (columnar or binary): each row holds its difference from the same agent's previous row on
+  this stream. Differences are taken from the values the client has reconstructed rather than the
+  exact previous ones, so float32 rounding does not accumulate over a long stream.
+- `gzip=1`: the whole response is gzip content-encoded, flushed after every event, if the client
+  accepts gzip.
+
+Every encoding decodes back to the cycles it was given, to within its dtype (`roundtrip` decodes a
+whole response the way a client would):
+
+>>> def state(t, k):
+...     return {'time': t / 10, 'position': {'x': t + k / 7, 'y': 0.5, 'z': -1e3 * k},
+...             'velocity': {'x': 1.0, 'y': k / 3, 'z': t * 1e-5}}
+>>> cycles = [json.dumps({f'A{k}': state(t, k) for k in range(3 if t % 4 else 2)}) for t in range(10)]
+>>> def roundtrip(encoding, cycles=cycles):
+...     encoder = encoding.encoder()
+...     parts = [encoder.control({'heartbeat': True}), *(encoder.cycle(i, c) for (i, c) in enumerate(cycles))]
+...     parts += [encoder.flush(), encoder.control({'done': True}), encoder.finish()]
+...     data = b''.join(part if isinstance(part, bytes) else part.encode() for part in parts if part is not None)
+...     if encoding.gzip:
+...         data = zlib.decompress(data, wbits=31)
+...     if encoding.format == 'binary':
+...         return [cycle for message in decode_frames(data) if isinstance(message, tuple) for cycle in message[1]]
+...     (decoded, last) = ([], {})
+...     for line in data.decode().splitlines():
+...         message = json.loads(line[6:]) if line.startswith('data: ') else {'heartbeat': True}
+...         if 'heartbeat' in message or 'done' in message:
+...             continue
+...         decoded += decode_event(line[6:], last)[1] if encoding.format == 'columnar' else message.get('cycles', [message])
+...     return decoded
+>>> def same(decoded, cycles, tolerance):
+...     flat = lambda c: [(a, s['time'], *s['position'].values(), *s['velocity'].values()) for (a, s) in c.items()]
+...     return len(decoded) == len(cycles) and all(
+...         x[0] == y[0] and np.allclose(x[1:], y[1:], rtol=tolerance, atol=0)
+...         for (d, c) in zip(decoded, cycles) for (x, y) in zip(flat(d), flat(json.loads(c)), strict=True))
+>>> [same(roundtrip(Encoding(format, batch, dtype, delta, gzip)), cycles, 1e-6 if dtype == 'f32' else 1e-12)
+...  for format in FORMATS for batch in (1, 4) for dtype in DTYPES for delta in (False, True) for gzip in (False, True)
+...  if not (delta and format == 'json')].count(False)
+0
+
+Batches with more agents than uint16 indices count switch to uint32 indices:
+
+>>> wide = [json.dumps({f'A{k}': state(0, k) for k in range(70_000)}), json.dumps({'A1': state(1, 1)})]
+>>> same(roundtrip(Encoding('binary', batch=2), wide), wide, 1e-12)
+True
+>>> Encoding('binary', batch=2).encoder().columns(list(enumerate(wide)))[0]['index']
+'u4'
+"""
+
+import base64
+import io
+import json
+import struct
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+from broadcast import event
+
+FORMATS = ("json", "columnar", "binary")
+DTYPES = {"f32": np.float32, "f64": np.float64}
+MAX_BATCH = 4096
+SHARED_CYCLES = 256  # parsed cycles kept for other subscribers to the same run
+CONTROL = 0
+BATCH = 1
+FRAME = struct.Struct("<IB")
+HEADER = struct.Struct("<I")
+
+
+class Encoding:
+    """A stream encoding a subscriber negotiated; `encoder()` makes the per-subscriber state for it."""
+
+    def __init__(self, format: str = "json", batch: int = 1, dtype: str = "f64", delta: bool = False, gzip: bool = False):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown stream format {format!r}, expected one of {', '.join(FORMATS)}")
+        if not 1 <= batch <= MAX_BATCH:
+            raise ValueError(f"batch must be between 1 and {MAX_BATCH}")
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+        if delta and format == "json":
+            raise ValueError("delta needs the columnar or binary format")
+        self.format = format
+        self.batch = batch
+        self.dtype = dtype
+        self.delta = delta
+        self.gzip = gzip
+
+    @property
+    def default(self):
+        return self.format == "json" and self.batch == 1 and not self.gzip
+
+    @property
+    def headers(self):
+        """Response headers that differ from a default SSE stream's."""
+        headers = {}
+        if self.format == "binary":
+            headers["Content-Type"] = "application/octet-stream"
+        if self.gzip:
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        return headers
+
+    def encoder(self):
+        return Encoder(self)
+
+
+def negotiate(headers, args):
+    """The `Encoding` a stream request asks for with its `format`, `batch`, `dtype`, `delta` and `gzip` parameters."""
+    flag = lambda name: args.get(name, "0").lower() in ("1", "true", "yes")
+    return Encoding(
+        format=args.get("format", "json"),
+        batch=int(args.get("batch", 1)),
+        dtype=args.get("dtype", "f64"),
+        delta=flag("delta"),
+        gzip=flag("gzip") and "gzip" in headers.get("Accept-Encoding", ""),
+    )
+
+
+class Encoder:
+    """
+    Encodes one subscriber's stream. `cycle` takes each cycle (as JSON text) and returns its event, or None
+    while a batch is still filling; `flush` returns the partial batch, if any; `control` encodes messages
+    such as heartbeats; `finish` returns whatever ends the response. Default streams return `str`, the
+    others `bytes`.
+    """
+
+    def __init__(self, encoding: Encoding):
+        self.encoding = encoding
+        self.heartbeats = encoding.format == "json" and encoding.batch == 1
+        self.pending = []  # (offset, cycle) pairs of the batch being filled
+        self.agents = {}  # agentId -> index into `last`
+        self.last = np.zeros((0, 7))  # NOTE: per agent, the time and state the client last reconstructed
+        self.compressor = zlib.compressobj(wbits=31) if encoding.gzip else None
+
+    def control(self, data):
+        if self.encoding.format == "binary":
+            return self.output(frame(CONTROL, json.dumps(data).encode()))
+        return self.output(event(data))
+
+    def cycle(self, offset, cycle):
+        if self.encoding.default:
+            return event(cycle, offset)
+        self.pending.append((offset, cycle))
+        if len(self.pending) < self.encoding.batch:
+            return None
+        return self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return None
+        (pending, self.pending) = (self.pending, [])
+        last = pending[-1][0]
+        if self.encoding.format == "json":
+            if self.encoding.batch == 1:
+                return self.output(event(pending[0][1], last))
+            return self.output(event(f'{{"offset": {pending[0][0]}, "cycles": [{", ".join(cycle for (_, cycle) in pending)}]}}', last))
+        (header, arrays) = self.columns(pending)
+        if self.encoding.format == "columnar":
+            header.update((name, base64.b64encode(array.tobytes()).decode()) for (name, array) in arrays.items())
+            return self.output(event(header, last))
+        data = json.dumps(header).encode()
+        return self.output(frame(BATCH, b"".join([HEADER.pack(len(data)), data, *(array.tobytes() for array in arrays.values())])))
+
+    def finish(self):
+        if self.compressor is None:
+            return None
+        return self.compressor.flush(zlib.Z_FINISH)
+
+    def output(self, text):
+        if self.compressor is None:
+            return text
+        data = text.encode() if isinstance(text, str) else text
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def columns(self, pending):
+        """The JSON header and arrays, in wire order, of a batch of `(offset, cycle)` pairs."""
+        parsed = [cycle_rows(cycle) for (_, cycle) in pending]
+        names = list(dict.fromkeys(agentId for (agentIds, _) in parsed for agentId in agentIds))
+        for agentId in names:
+            if agentId not in self.agents:
+                self.agents[agentId] = len(self.agents)
+        if len(self.last) < len(self.agents):
+            self.last = np.vstack([self.last, np.zeros((len(self.agents) - len(self.last), 7))])
+        # NOTE: rows are dense, i.e. cycle-major over `names`, when every cycle has every agent in the same order
+        dense = all(agentIds == parsed[0][0] for (agentIds, _) in parsed) and len(parsed[0][0]) == len(names)
+        values = np.concatenate([rows for (_, rows) in parsed])
+        if dense:
+            (cycleIndex, agentIndex) = (np.repeat(np.arange(len(parsed)), len(names)), np.tile(np.arange(len(names)), len(parsed)))
+        else:
+            column = {agentId: i for (i, agentId) in enumerate(names)}
+            cycleIndex = np.repeat(np.arange(len(parsed)), [len(agentIds) for (agentIds, _) in parsed])
+            agentIndex = np.array([column[agentId] for (agentIds, _) in parsed for agentId in agentIds], dtype=np.int64)
+        dtype = DTYPES[self.encoding.dtype]
+        index = "u2" if len(names) <= 0xFFFF else "u4"  # NOTE: cycles per batch are capped by MAX_BATCH
+        if self.encoding.delta:
+            (time, state) = self.differences(cycleIndex, np.array([self.agents[agentId] for agentId in names])[agentIndex], values, dtype)
+        else:
+            (time, state) = (values[:, 0], values[:, 1:].astype(dtype))
+        header = {
+            "offset": pending[0][0], "count": len(pending), "agents": names, "rows": len(values), "dense": dense,
+            "index": index, "dtype": self.encoding.dtype, "delta": self.encoding.delta,
+        }
+        arrays = {}
+        if not dense:
+            arrays["cycle"] = cycleIndex.astype(f"<{index}")
+            arrays["agent"] = agentIndex.astype(f"<{index}")
+        arrays["time"] = time.astype("<f8")
+        arrays["state"] = state.astype(np.dtype(dtype).newbyteorder("<"))
+        return (header, arrays)
+
+    def differences(self, cycleIndex, rows, values, dtype):
+        """Delta-encode `values` row by row against `last`, advancing it as the client will."""
+        (time, state) = (np.empty(len(values)), np.empty((len(values), 6), dtype=dtype))
+        # NOTE: one vectorized step per cycle of the batch, over every agent present in it
+        bounds = np.flatnonzero(np.r_[True, cycleIndex[1:] != cycleIndex[:-1], True])
+        for (start, end) in zip(bounds[:-1], bounds[1:]):
+            agents = rows[start:end]
+            diff = values[start:end] - self.last[agents]
+            time[start:end] = diff[:, 0]
+            state[start:end] = diff[:, 1:]
+            self.last[agents, 0] += time[start:end]
+            self.last[agents, 1:] += state[start:end]
+        return (time, state)
+
+
+@lru_cache(maxsize=SHARED_CYCLES)
+def cycle_rows(cycle: str):
+    """
+    The agent ids and `[time, position, velocity]` rows of a cycle's JSON text. Subscribers to a live run
+    share each cycle's text, so while they keep roughly in step they parse it once between them.
+    """
+    states = json.loads(cycle)
+    rows = [(state["time"], *(state["position"][k] for k in "xyz"), *(state["velocity"][k] for k in "xyz")) for state in states.values()]
+    return (tuple(states), np.array(rows, dtype=float).reshape(-1, 7))
+
+
+def frame(kind, payload):
+    return FRAME.pack(len(payload), kind) + payload
+
+
+def decode_frames(data: bytes):
+    """
+    Decode a complete binary stream back into messages: control messages as their JSON value, batches as
+    `(offset, cycles)` with cycles in the form the simulator yields them. Deltas are undone along the way.
+    """
+    last = {}
+    view = memoryview(data)
+    i = 0
+    while i < len(view):
+        (length, kind) = FRAME.unpack_from(view, i)
+        payload = view[i + FRAME.size:i + FRAME.size + length]
+        i += FRAME.size + length
+        if kind == CONTROL:
+            yield json.loads(bytes(payload))
+            continue
+        (size,) = HEADER.unpack_from(payload)
+        header = json.loads(bytes(payload[HEADER.size:HEADER.size + size]))
+        stream = io.BytesIO(payload[HEADER.size + size:])
+        yield decode_batch(header, lambda name, dtype, count: np.frombuffer(stream.read(count * np.dtype(dtype).itemsize), dtype=dtype), last)
+
+
+def decode_event(data: str, last: dict):
+    """Decode one columnar SSE event's data into `(offset, cycles)`; `last` holds the deltas' state."""
+    header = json.loads(data)
+    return decode_batch(header, lambda name, dtype, count: np.frombuffer(base64.b64decode(header[name]), dtype=dtype), last)
+
+
+def decode_batch(header, read, last):
+    """Rebuild `(offset, cycles)` from a batch `header` and its arrays, given by `read(name, dtype, count)`."""
+    (rows, names) = (header["rows"], header["agents"])
+    if header["dense"]:
+        (cycleIndex, agentIndex) = (np.repeat(np.arange(header["count"]), len(names)), np.tile(np.arange(len(names)), header["count"]))
+    else:
+        index = f"<{header.get('index', 'u2')}"
+        (cycleIndex, agentIndex) = (read("cycle", index, rows), read("agent", index, rows))
+    time = read("time", "<f8", rows)
+    state = read("state", np.dtype(DTYPES[header["dtype"]]).newbyteorder("<"), rows * 6).reshape(rows, 6).astype(float)
+    cycles = [{} for _ in range(header["count"])]
+    for (k, a, t, s) in zip(cycleIndex.tolist(), agentIndex.tolist(), time.tolist(), state.tolist()):
+        agentId = names[a]
+        if header["delta"]:
+            previous = last.get(agentId, [0.0] * 7)
+            (t, s) = (previous[0] + t, [p + d for (p, d) in zip(previous[1:], s)])
+            last[agentId] = [t, *s]
+        cycles[k][agentId] = {"time": t, "position": dict(zip("xyz", s[:3])), "velocity": dict(zip("xyz", s[3:]))}
+    return (header["offset"], cycles)
@@ -0,0 +1,172 @@
+# GRAVITY
+
+"""
+Gravitational accelerations of many bodies at once, for State Managers that consume `agents!`.
+`accelerations` sums every pair exactly for up to `DIRECT_MAX` bodies, and otherwise walks a Barnes-Hut
+octree, which approximates each distant group of bodies by its centre of mass: a group of width `s` at
+distance `d` is used whole when `s / d < theta`, the opening angle. Smaller angles are more accurate and
+slower; `theta=0` opens every group, which is the direct sum again. Both follow `modsim.propagate_velocity`:
+`a_i = sum_j -m_j (r_i - r_j) / |r_i - r_j|**3`, without softening, skipping coincident bodies.
+
+The octree's error (relative to each body's exact acceleration) shrinks with the opening angle:
+
+>>> rng = np.random.default_rng(0)
+>>> (positions, masses) = (rng.normal(size=(500, 3)), rng.uniform(0.5, 2.0, 500))
+>>> exact = direct_accelerations(positions, masses)
+>>> def error(theta):
+...     approx = Octree(positions, masses).accelerations(theta)
+...     return float(np.max(np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)))
+>>> (error(0.0) < 1e-12, error(0.1) < 1e-4, error(0.1) < error(0.5) < 0.05)
+(True, True, True)
+>>> np.array_equal(accelerations(positions[:DIRECT_MAX], masses[:DIRECT_MAX]), direct_accelerations(positions[:DIRECT_MAX], masses[:DIRECT_MAX]))
+True
+
+`universe_accelerations` computes once per version of a universe and angle, then serves the cached result:
+
+>>> from simulator import Universe, _versions
+>>> universe = Universe()
+>>> dict.update(universe, {f'B{i}': {'position': dict(zip('xyz', p)), 'mass': m}
+...                        for (i, (p, m)) in enumerate(zip(positions.tolist(), masses.tolist()))})
+>>> (rows, acc) = universe_accelerations(universe)
+>>> np.array_equal(acc[rows['B7']], accelerations(positions, masses)[7])
+True
+>>> (universe_accelerations(universe)[1] is acc, universe_accelerations(universe, 0.1)[1] is acc)
+(True, False)
+>>> universe.version = next(_versions)  # as the Simulator does when it commits a step
+>>> universe_accelerations(universe)[1] is acc
+False
+"""
+
+import numpy as np
+
+THETA = 0.5
+DIRECT_MAX = 64
+DEPTH = 16  # octree levels: bodies closer than 2**-DEPTH of the bounding cube share a leaf
+BLOCK = 1 << 20  # direct sum pairs computed at once, which bounds its memory
+
+
+def direct_accelerations(positions, masses):
+    """The exact accelerations of bodies at `positions` ([N, 3]) with `masses` ([N]), in blocks of rows."""
+    n = len(positions)
+    acc = np.zeros((n, 3))
+    rows = max(1, BLOCK // max(n, 1))
+    for start in range(0, n, rows):
+        r = positions[start:start + rows, None, :] - positions[None, :, :]
+        d2 = np.einsum("ijk,ijk->ij", r, r)
+        with np.errstate(divide="ignore"):
+            w = np.where(d2 > 0, masses / (d2 * np.sqrt(d2)), 0.0)
+        acc[start:start + rows] = -np.einsum("ij,ijk->ik", w, r)
+    return acc
+
+
+def _morton(cells, depth):
+    """Interleave the bits of integer cell coordinates ([N, 3]) into one Morton code per body."""
+    codes = np.zeros(len(cells), dtype=np.int64)
+    for bit in range(depth):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return codes
+
+
+class Octree:
+    """
+    A Barnes-Hut octree over bodies at `positions` with `masses`. Bodies are sorted by Morton code, so
+    every node is a contiguous run of sorted bodies, and each level's nodes, masses and centres of mass
+    are found with a few array operations rather than by inserting bodies one at a time.
+    """
+
+    def __init__(self, positions, masses, depth: int = DEPTH):
+        self.n = n = len(positions)
+        self.depth = depth
+        low = positions.min(axis=0)
+        size = float((positions.max(axis=0) - low).max()) or 1.0
+        cells = np.minimum(((positions - low) / size * (1 << depth)).astype(np.int64), (1 << depth) - 1)
+        codes = _morton(cells, depth)
+        self.order = np.argsort(codes, kind="stable")
+        codes = codes[self.order]
+        self.positions = positions[self.order]
+        self.masses = masses[self.order]
+        weighted = self.positions * self.masses[:, None]
+        # NOTE: per level: node starts and ends (in sorted order), masses, centres of mass and width
+        self.levels = []
+        for level in range(depth + 1):
+            prefix = codes >> (3 * (depth - level))
+            starts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+            ends = np.r_[starts[1:], n]
+            mass = np.add.reduceat(self.masses, starts)
+            com = np.add.reduceat(weighted, starts) / np.where(mass > 0, mass, 1.0)[:, None]
+            self.levels.append((starts, ends, mass, com, size / (1 << level)))
+
+    def accelerations(self, theta: float = THETA):
+        """The acceleration of every body, in the order given, with opening angle `theta`."""
+        n = self.n
+        acc = np.zeros((n, 3))
+        # NOTE: the frontier holds (body, node) pairs still to resolve at this level, starting at the root
+        targets = np.arange(n)
+        nodes = np.zeros(n, dtype=np.int64)
+        for (level, (starts, ends, mass, com, size)) in enumerate(self.levels):
+            if not len(targets):
+                break
+            (first, last) = (starts[nodes], ends[nodes])
+            single = last - first == 1
+            inside = (first <= targets) & (targets < last)
+            r = self.positions[targets] - com[nodes]
+            d2 = np.einsum("ij,ij->i", r, r)
+            accept = ~inside & (d2 > 0) & (single | (size * size < theta * theta * d2))
+            self._add(acc, targets[accept], mass[nodes[accept]], r[accept], d2[accept])
+            opened = ~accept & ~single
+            (targets, nodes) = (targets[opened], nodes[opened])
+            if level < self.depth:
+                (childStarts, _, _, _, _) = self.levels[level + 1]
+                (lo, hi) = (np.searchsorted(childStarts, first[opened]), np.searchsorted(childStarts, last[opened]))
+                (targets, nodes) = _expand(targets, lo, hi)
+            else:
+                # NOTE: bodies sharing a deepest leaf are summed exactly
+                (targets, bodies) = _expand(targets, first[opened], last[opened])
+                r = self.positions[targets] - self.positions[bodies]
+                d2 = np.einsum("ij,ij->i", r, r)
+                keep = (targets != bodies) & (d2 > 0)
+                self._add(acc, targets[keep], self.masses[bodies[keep]], r[keep], d2[keep])
+        out = np.empty_like(acc)
+        out[self.order] = acc
+        return out
+
+    def _add(self, acc, targets, mass, r, d2):
+        w = mass / (d2 * np.sqrt(d2))
+        for axis in range(3):
+            acc[:, axis] -= np.bincount(targets, weights=w * r[:, axis], minlength=self.n)
+
+
+def _expand(targets, lo, hi):
+    """Pair each target with every index in its range [lo, hi)."""
+    counts = hi - lo
+    total = int(counts.sum())
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return (np.repeat(targets, counts), np.repeat(lo, counts) + np.arange(total) - offsets)
+
+
+def accelerations(positions, masses, theta: float = None, direct_max: int = DIRECT_MAX):
+    """The acceleration of every body: a direct sum for at most `direct_max` bodies, else Barnes-Hut."""
+    if len(positions) <= direct_max:
+        return direct_accelerations(positions, masses)
+    return Octree(positions, masses).accelerations(THETA if theta is None else theta)
+
+
+def universe_accelerations(universe, theta: float = THETA):
+    """
+    The accelerations of every agent in `universe` with a `position` and a `mass`, as `(rows, acc)` where
+    `rows` maps each agentId to its row of `acc`. The result is cached on the universe (see
+    `simulator.Universe.cached`) until it next changes, so all the agents stepped from one universe share
+    one octree. Other mappings, e.g. the copies sent to process pool workers, are computed every time.
+    """
+    cached = getattr(universe, "cached", None)
+    if cached is None:
+        return _universe_accelerations(universe, theta)
+    return cached(("accelerations", theta), lambda: _universe_accelerations(universe, theta))
+
+
+def _universe_accelerations(universe, theta):
+    agents = [(agentId, state) for (agentId, state) in universe.items() if "position" in state and "mass" in state]
+    positions = np.array([[state["position"][k] for k in "xyz"] for (_, state) in agents], dtype=float).reshape(-1, 3)
+    masses = np.array([state["mass"] for (_, state) in agents], dtype=float)
+    return ({agentId: i for (i, (agentId, _)) in enumerate(agents)}, accelerations(positions, masses, theta))
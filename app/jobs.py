@@ -0,0 +1,231 @@
+# JOB QUEUE
+
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import create_engine, update
+from sqlalchemy.orm import Session
+
+import nbody
+from cache import result_key
+from models import Job
+from modsim import agents
+from nbody import NBodyEngine
+from runs import CHUNK_CYCLES, create_run, run_writer
+from simulator import Simulator
+from store import STORES, QRangeStore
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue already holds its maximum depth."""
+
+
+class Cancelled(Exception):
+    pass
+
+
+def build_store(options):
+    """
+    Build the store for a run from request-style `options`: `store` is `records` (default) or `columnar`.
+    A records store can keep only the records ending within `window` time units of the latest one in
+    memory, dropping older ones: the simulator never reads them, and runs are persisted separately.
+    """
+    kind = options.get("store", "records")
+    if options.get("window") in (None, ""):
+        return STORES[kind]()
+    if kind != "records":
+        raise ValueError(f"A retention window is not supported by the {kind} store")
+    return QRangeStore(window=float(options["window"]))
+
+
+def build_simulator(init, options):
+    """
+    Build the simulator for a run. `options` holds request-style strings:
+    - `store` and `window`: see `build_store`
+    - `engine`: `vectorized` to step all bodies with packed NumPy arrays instead of statemanagers,
+      optionally with `integrator` (`euler`, `leapfrog` or `rk45`) and `adaptive`
+    """
+    t = datetime.now()
+    store = build_store(options)
+    if options.get("engine") == "vectorized":
+        simulator = NBodyEngine(
+            init=init,
+            store=store,
+            integrator=options.get("integrator", "euler"),
+            adaptive=str(options.get("adaptive", "false")).lower() == "true",
+        )
+    else:
+        simulator = Simulator(store=store, init=init)
+    logging.info(f"Time to Build: {datetime.now() - t}")
+    return simulator
+
+
+def simulator_key(init, iterations, options):
+    """The result cache key of a run built by `build_simulator(init, options)` and run for `iterations`."""
+    if options.get("engine") != "vectorized":
+        return result_key(agents, init, iterations, {})
+    engineOptions = {
+        "integrator": options.get("integrator", "euler"),
+        "adaptive": str(options.get("adaptive", "false")).lower() == "true",
+    }
+    return result_key(agents, init, iterations, engineOptions, engine=nbody)
+
+
+def run_job(job_id, database):
+    """
+    Run job `job_id` in a worker process, against the database at the SQLAlchemy URL `database`.
+    Progress is committed once per persisted chunk, which is also when a cancellation request is seen.
+
+    >>> import tempfile
+    >>> from models import Run, db
+    >>> from modsim import data
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> database = f"sqlite:///{directory.name}/jobs.db"
+    >>> engine = create_engine(database)
+    >>> db.metadata.create_all(engine)
+    >>> def submit(status='queued', **options):
+    ...     with Session(engine) as session:
+    ...         job = Job(init=json.dumps(data), options=json.dumps(options), iterations=600, status=status)
+    ...         session.add(job)
+    ...         session.commit()
+    ...         return job.id
+    >>> def outcome(job_id):
+    ...     run_job(job_id, database)
+    ...     with Session(engine) as session:
+    ...         job = session.get(Job, job_id)
+    ...         run = None if job.run_id is None else session.get(Run, job.run_id)
+    ...         return (job.status, job.cycles, run and (run.status, run.cycles), job.error)
+    >>> outcome(submit())
+    ('complete', 600, ('complete', 600), None)
+
+    A job cancelled while queued is never claimed, and one that fails marks its run failed:
+
+    >>> outcome(submit(status='cancelled'))
+    ('cancelled', 0, None, None)
+    >>> outcome(submit(store='unknown'))
+    ('failed', 0, ('failed', 0), "'unknown'")
+
+    A job cancelled while running stops at its next chunk, leaving its run incomplete (here a trigger
+    asks for that as soon as the first chunk is committed):
+
+    >>> with engine.begin() as connection:
+    ...     _ = connection.exec_driver_sql(
+    ...         "CREATE TRIGGER cancel AFTER UPDATE OF cycles ON job WHEN new.cycles > 0 "
+    ...         "BEGIN UPDATE job SET status = 'cancelling' WHERE id = new.id; END")
+    >>> outcome(submit()) == ('cancelled', CHUNK_CYCLES, ('incomplete', CHUNK_CYCLES), None)
+    True
+    >>> engine.dispose()
+    >>> directory.cleanup()
+    """
+    engine = create_engine(database)
+    with Session(engine) as session:
+        # NOTE: claimed with a conditional update, so a job cancelled while queued never starts
+        claimed = session.execute(
+            update(Job).where(Job.id == job_id, Job.status == "queued").values(status="running", started=datetime.now())
+        ).rowcount
+        session.commit()
+        if not claimed:
+            return
+        job = session.get(Job, job_id)
+        run = None
+        try:
+            init = json.loads(job.init)
+            run = create_run(session, init)
+            job.run_id = run.id
+            session.commit()
+            simulator = build_simulator(init, json.loads(job.options))
+            writer = run_writer(session, run)
+            try:
+                cycle = None
+                for (i, cycle) in enumerate(simulator.simulate(iterations=job.iterations)):
+                    writer.append(cycle)
+                    if (i + 1) % CHUNK_CYCLES == 0:
+                        job.cycles = i + 1
+                        session.commit()
+                        if job.status == "cancelling":
+                            raise Cancelled()
+            finally:
+                writer.flush()
+            job.cycles = run.cycles
+            job.result = json.dumps(cycle)
+            (job.status, run.status) = ("complete", "complete")
+        except Cancelled:
+            job.cycles = run.cycles
+            (job.status, run.status) = ("cancelled", "incomplete")
+        except Exception as e:
+            logging.error(f"Error in job {job_id}: {e}")
+            session.rollback()
+            (job.status, job.error) = ("failed", str(e))
+            if run is not None:
+                run.status = "failed"
+        job.finished = datetime.now()
+        session.commit()
+    engine.dispose()
+
+
+class JobQueue:
+    """
+    Submits jobs to a local pool of worker processes. At most `workers + depth` jobs are queued or running
+    at once; further submissions raise `QueueFull`. The pool is started on the first submission.
+    """
+
+    def __init__(self, database, workers: int = None, depth: int = 16):
+        self.database = database
+        self.workers = workers or max(1, (multiprocessing.cpu_count() or 2) - 1)
+        self.depth = depth
+        self.executor = None
+        self.futures = {}  # job id -> Future
+        self.lock = threading.Lock()
+
+    def _pending(self):
+        self.futures = {key: future for (key, future) in self.futures.items() if not future.done()}
+        return len(self.futures)
+
+    def pending(self):
+        """The number of submitted jobs that have not finished."""
+        with self.lock:
+            return self._pending()
+
+    def full(self):
+        return self.pending() >= self.workers + self.depth
+
+    def submit(self, job_id):
+        # NOTE: checked under the same lock as the insert, so concurrent submissions can't both take the last slot
+        with self.lock:
+            if self._pending() >= self.workers + self.depth:
+                raise QueueFull(f"The job queue is full ({self.workers + self.depth} jobs queued or running)")
+            if self.executor is None:
+                # NOTE: spawned rather than forked, as the server process runs producer threads
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            future = self.executor.submit(run_job, job_id, self.database)
+            future.add_done_callback(_log_failure)
+            self.futures[job_id] = future
+
+    def cancel(self, session, job_id):
+        """
+        Cancel a job. A queued job is cancelled immediately; a running one is marked `cancelling` and stops
+        when its worker next commits progress. Returns False if the job had already finished.
+        """
+        cancelled = session.execute(
+            update(Job).where(Job.id == job_id, Job.status == "queued").values(status="cancelled", finished=datetime.now())
+        ).rowcount
+        if cancelled:
+            with self.lock:
+                future = self.futures.pop(job_id, None)
+            if future is not None:
+                future.cancel()
+        else:
+            cancelled = session.execute(
+                update(Job).where(Job.id == job_id, Job.status == "running").values(status="cancelling")
+            ).rowcount
+        session.commit()
+        return bool(cancelled)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Job worker failed: {future.exception()}")
@@ -0,0 +1,173 @@
+# INSTRUMENTATION
+
+"""
+Low-overhead counters and histograms for the simulator and server, rendered in the Prometheus text format
+by `render` (served at `GET /metrics`).
+
+Counters are always kept. Phase timings are only taken on sampled iterations, one in every
+`SEDARO_METRICS_SAMPLE` (default 64), so the clock is not read around every state manager call.
+`SEDARO_METRICS=0` turns timing off entirely. `SEDARO_DEBUG=1` is the explicit debug mode: every
+iteration is timed and each agent's new state is logged at DEBUG level.
+"""
+
+import logging
+import os
+import threading
+from bisect import bisect_left
+
+ENABLED = os.environ.get("SEDARO_METRICS", "1") != "0"
+DEBUG = os.environ.get("SEDARO_DEBUG", "0") == "1"
+SAMPLE_EVERY = 1 if DEBUG else max(1, int(os.environ.get("SEDARO_METRICS_SAMPLE", 64)))
+
+TIME_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+REGISTRY = []
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count per combination of label values."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = list(self.values.items())
+        for (labels, value) in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    """Observations counted into fixed buckets, per combination of label values, with their sum."""
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [per-bucket counts (last is +Inf), sum]
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = [(labels, list(counts), total) for (labels, (counts, total)) in self.series.items()]
+        for (labels, counts, total) in series:
+            cumulative = 0
+            for (bound, count) in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels, labels, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge:
+    """A value read when metrics are rendered, from `collect()`: a number, or a dict of label values to numbers."""
+
+    def __init__(self, name, help, collect, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = labels
+        self.kind = kind
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for (labels, value) in values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Sampler:
+    """Decides which iterations are timed: one in every `every`, or none when timing is disabled."""
+
+    def __init__(self, every=SAMPLE_EVERY, enabled=ENABLED):
+        self.every = every
+        self.enabled = enabled
+        self.n = 0
+
+    def __call__(self):
+        if not self.enabled:
+            return False
+        self.n += 1
+        return self.n % self.every == 0
+
+
+def render(metrics=REGISTRY):
+    """
+    Render `metrics` (by default, every registered one) in the Prometheus text exposition format. Histogram
+    buckets are cumulative, and each counts the observations less than or equal to its bound:
+
+    >>> requests = Counter("demo_requests_total", "Requests served.", ("route", "status"))
+    >>> (requests.inc("/metrics", 200), requests.inc("/metrics", 200, amount=2), requests.inc("/jobs", 503))
+    (None, None, None)
+    >>> latency = Histogram("demo_seconds", "Request latency.", buckets=(0.1, 1.0))
+    >>> for seconds in (0.05, 0.1, 0.5, 4.0):
+    ...     latency.observe(seconds)
+    >>> print(render([requests, latency]), end="")
+    # HELP demo_requests_total Requests served.
+    # TYPE demo_requests_total counter
+    demo_requests_total{route="/metrics",status="200"} 3
+    demo_requests_total{route="/jobs",status="503"} 1
+    # HELP demo_seconds Request latency.
+    # TYPE demo_seconds histogram
+    demo_seconds_bucket{le="0.1"} 2
+    demo_seconds_bucket{le="1.0"} 3
+    demo_seconds_bucket{le="+Inf"} 4
+    demo_seconds_sum 4.65
+    demo_seconds_count 4
+    >>> del REGISTRY[-2:]
+    """
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+def debug(message, *args):
+    """Log at DEBUG level in debug mode only, formatting `message % args` only if it is emitted."""
+    if DEBUG:
+        logging.debug(message, *args)
+
+
+PHASE_SECONDS = Histogram("sedaro_phase_seconds", "Time spent per phase on sampled iterations.", ("phase",))
+STATE_MANAGER_SECONDS = Histogram("sedaro_state_manager_seconds", "Time per state manager call on sampled iterations.", ("agent", "function"))
+ITERATIONS = Counter("sedaro_iterations_total", "Simulation iterations completed.", ("engine",))
+AGENT_STEPS = Counter("sedaro_agent_steps_total", "Agent steps committed to the store.", ("engine",))
+INVALID_STATES = Counter("sedaro_invalid_states_total", "Agent steps dropped for a missing or malformed state.")
+SSE_EVENTS = Counter("sedaro_sse_cycle_events_total", "Cycle events streamed to SSE clients.")
+SSE_BYTES = Counter("sedaro_sse_cycle_bytes_total", "Bytes of cycle events streamed to SSE clients.")
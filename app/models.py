@@ -0,0 +1,88 @@
+# DATABASE MODELS
+
+import json
+from datetime import datetime
+from typing import Optional
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+db = SQLAlchemy(model_class=Base)
+
+
+class Run(db.Model):
+    """The header of a persisted simulation run. Its cycles are stored in `RunChunk`s."""
+    id: Mapped[int] = mapped_column(primary_key=True)
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
+    status: Mapped[str] = mapped_column(default="running")  # running | complete | incomplete | failed
+    agents: Mapped[str]  # JSON list of agent ids
+    init: Mapped[str]  # JSON initial state
+    cycles: Mapped[int] = mapped_column(default=0)
+    chunks: Mapped[int] = mapped_column(default=0)
+    t0: Mapped[Optional[float]]
+    t1: Mapped[Optional[float]]
+
+    def header(self):
+        return {
+            "id": self.id,
+            "created": self.created.isoformat(),
+            "status": self.status,
+            "agents": json.loads(self.agents),
+            "init": json.loads(self.init),
+            "cycles": self.cycles,
+            "chunks": self.chunks,
+            "t0": self.t0,
+            "t1": self.t1,
+        }
+
+
+class RunChunk(db.Model):
+    """A consecutive block of a run's cycles, encoded column-wise by `runs.encode_chunk`."""
+    run_id: Mapped[int] = mapped_column(ForeignKey("run.id"), primary_key=True)
+    seq: Mapped[int] = mapped_column(primary_key=True)
+    t0: Mapped[float]  # earliest agent time in the chunk
+    t1: Mapped[float]  # latest agent time in the chunk
+    cycles: Mapped[int]
+    data: Mapped[bytes]
+
+    __table_args__ = (Index("ix_run_chunk_time", "run_id", "t0", "t1"),)
+
+
+class Job(db.Model):
+    """A simulation submitted to the job queue. A worker process runs it, persisting its cycles as a `Run`."""
+    id: Mapped[int] = mapped_column(primary_key=True)
+    created: Mapped[datetime] = mapped_column(default=datetime.now)
+    status: Mapped[str] = mapped_column(default="queued")  # queued | running | cancelling | cancelled | complete | failed
+    init: Mapped[str]  # JSON initial state
+    options: Mapped[str]  # JSON simulator options, see `jobs.build_simulator`
+    iterations: Mapped[int]
+    cycles: Mapped[int] = mapped_column(default=0)
+    started: Mapped[Optional[datetime]]
+    finished: Mapped[Optional[datetime]]
+    run_id: Mapped[Optional[int]] = mapped_column(ForeignKey("run.id"))
+    result: Mapped[Optional[str]]  # JSON final cycle
+    error: Mapped[Optional[str]]
+
+    def header(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = ((self.finished or datetime.now()) - self.started).total_seconds()
+        return {
+            "id": self.id,
+            "created": self.created.isoformat(),
+            "status": self.status,
+            "iterations": self.iterations,
+            "cycles": self.cycles,
+            "progress": self.cycles / self.iterations if self.iterations else 1.0,
+            "elapsed": elapsed,
+            "throughput": self.cycles / elapsed if elapsed else None,  # cycles per second
+            "run": self.run_id,
+            "result": None if self.result is None else json.loads(self.result),
+            "error": self.error,
+        }
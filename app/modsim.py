@@ -1,9 +1,12 @@
 # MODELING & SIMULATION
 
+from functools import partial, update_wrapper
 from random import random
 
 import numpy as np
 
+import gravity
+
 def propagate_velocity(timeStep, position, velocity, other_position, m_other):
     """Propagate the velocity of the agent from `time` to `time + timeStep`."""
     # Use law of gravitation to update velocity
@@ -17,6 +20,17 @@ def propagate_velocity(timeStep, position, velocity, other_position, m_other):
 
     return {'x': v_self[0], 'y': v_self[1], 'z': v_self[2]}
 
+def gravity_velocity(timeStep, state, agents, *, agentId, theta=gravity.THETA):
+    """
+    Propagate the velocity of `agentId`, whose previous state is `state`, under the gravity of every agent in
+    `agents`, from `time` to `time + timeStep`. All agents stepped from the same universe share one
+    Barnes-Hut octree with opening angle `theta` (or direct sum, for few agents); see `gravity.py`.
+    """
+    (rows, acc) = gravity.universe_accelerations(agents, theta)
+    velocity = state['velocity']
+    v_self = np.array([velocity['x'], velocity['y'], velocity['z']]) + acc[rows[agentId]] * timeStep
+    return dict(zip('xyz', v_self.tolist()))
+
 def propagate_position(timeStep, position, velocity):
     """Propagate the position of the agent from `time` to `time + timeStep`."""
     # Apply velocity to position
@@ -37,6 +51,20 @@ def timestep_manager(velocity):
     """Compute the length of the next simulation timeStep for the agent"""
     return 0.1  # Increased from 0.01 for faster simulation
 
+ADAPTIVE_ETA = 0.002
+
+def adaptive_timestep(separation, total_mass, eta=ADAPTIVE_ETA, dt_min=1e-4, dt_max=10.0):
+    """
+    A timeStep of `eta` times the free-fall time `sqrt(r**3 / (m1 + m2))` of a pair of bodies, so steps
+    grow while bodies are far apart and shrink near periapsis. Works elementwise on NumPy arrays.
+    """
+    return np.clip(eta * np.sqrt(separation**3 / total_mass), dt_min, dt_max)
+
+def adaptive_timestep_manager(position, other_position, mass, m_other):
+    """Compute the next timeStep from the previous state of this agent and the other one (see `adaptive_timestep`)"""
+    r = np.array([position[k] - other_position[k] for k in ('x', 'y', 'z')])
+    return float(adaptive_timestep(np.linalg.norm(r), mass + m_other))
+
 def time_manager(time, timeStep):
     """Compute the time for the next simulation step for the agent"""
     return time + timeStep
@@ -50,7 +78,20 @@ Query syntax:
    the query is running for.
 - prev!(<query>)` will get the value of `query` from the previous step of simulation.
 - `agent!(<agentId>)` will get the most recent state produced by `agentId`.
+- `agents!` will get the most recent state of every agent, keyed by agentId.
 - `<query>.<name>` will evaluate `query` and then look up `name` in the resulting dictionary.
+- `history!(<query>, <n>)` will get a list of the values of `query` over the agent's last `n` steps,
+   oldest first, ending with the previous step (fewer early in a run). `query` may only read the
+   agent's own state, e.g. `history!(position.x, 5)` for a finite difference or a filter.
+- `at!(<query>, <dt>)` will get the value of `query` as of `dt` before the previous step's time, e.g.
+   `at!(agent!(Body2).position, 0.5)` for a delayed coupling. Before the run started, that is the
+   initial state.
+
+To use an adaptive timeStep, bind `adaptive_timestep_manager` in place of `timestep_manager` with
+    'consumed': '(prev!(position), agent!(Body2).position, prev!(mass), agent!(Body2).mass,)'
+Both bodies then compute the same step from the same previous universe, so they stay in lockstep.
+`time_manager` adds the step produced this cycle, the one the propagators use next; to stamp each
+cycle with the step that produced it instead, bind it to '(prev!(time), prev!(timeStep),)'.
 '''
 
 '''''HAVE TO EDIT THIS FOR GRAVITY'''
@@ -148,6 +189,23 @@ agents = {
     ]
 }
 
+def gravity_model(agentIds, theta=gravity.THETA):
+    """
+    The `agents` model for any number of bodies, each attracted by all the others through `agents!`, with
+    Barnes-Hut opening angle `theta`.
+    """
+    return {
+        agentId: [
+            {
+                'consumed': '(prev!(timeStep), prev!(root!), agents!,)',
+                'produced': 'velocity',
+                'function': update_wrapper(partial(gravity_velocity, agentId=agentId, theta=theta), gravity_velocity),
+            },
+            *agents['Body1'][1:],
+        ]
+        for agentId in agentIds
+    }
+
 # NOTE: initial values are set here. we intentionally separate the data from the functions operating on it.
 data = {
     'Body1': {
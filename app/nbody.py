@@ -0,0 +1,422 @@
+# VECTORIZED ENGINE
+
+from time import perf_counter
+
+import numpy as np
+
+from metrics import AGENT_STEPS, ITERATIONS, PHASE_SECONDS, Sampler
+from modsim import ADAPTIVE_ETA, adaptive_timestep
+
+AXES = ('x', 'y', 'z')
+
+
+def pack(vectors):
+    """Pack a list of `{'x', 'y', 'z'}` dicts into an (N, 3) array."""
+    return np.array([[v[k] for k in AXES] for v in vectors], dtype=float)
+
+
+def unpack(row):
+    """Unpack one row of an (N, 3) array into a `{'x', 'y', 'z'}` dict."""
+    (x, y, z) = row
+    return {'x': x, 'y': y, 'z': z}
+
+
+def accelerations(position, mass):
+    """
+    Gravitational acceleration on every body from every other body (G = 1), as in
+    `modsim.propagate_velocity`, computed for all pairs at once.
+
+    Args:
+        position (np.ndarray): (..., N, 3) positions. Leading axes are treated as a batch.
+        mass (np.ndarray): (..., N) masses.
+    """
+    return gravity(position, mass)[0]
+
+
+def gravity(position, mass):
+    """Like `accelerations`, but also return the (..., N, N) squared pairwise distances (inf on the diagonal)."""
+    # NOTE: working per axis on (N, N) planes is about twice as fast as one (N, N, 3) difference tensor
+    (x, y, z) = np.moveaxis(position, -1, 0)
+    dx = x[..., :, None] - x[..., None, :]  # dx[i, j] = x_i - x_j
+    dy = y[..., :, None] - y[..., None, :]
+    dz = z[..., :, None] - z[..., None, :]
+    r2 = dx * dx + dy * dy + dz * dz
+    n = position.shape[-2]
+    r2[..., np.arange(n), np.arange(n)] = np.inf  # no self-interaction
+    weight = mass[..., None, :] / (r2 * np.sqrt(r2))
+    acc = -np.stack([(weight * dx).sum(-1), (weight * dy).sum(-1), (weight * dz).sum(-1)], axis=-1)
+    return (acc, r2)
+
+
+# Dormand-Prince 5(4) tableau: stage nodes, stage weights, 5th-order weights and their difference from 4th-order
+DOPRI_C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+DOPRI_A = (
+    (),
+    (1 / 5,),
+    (3 / 40, 9 / 40),
+    (44 / 45, -56 / 15, 32 / 9),
+    (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+    (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+    (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84),
+)
+DOPRI_B = DOPRI_A[6] + (0,)
+DOPRI_E = tuple(b - b4 for (b, b4) in zip(DOPRI_B, (5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40)))
+
+INTEGRATORS = ('euler', 'leapfrog', 'rk45')
+
+
+class NBodyEngine:
+    """
+    A vectorized alternative to `Simulator` for the gravitational N-body model in `modsim`. All agents'
+    state is held in packed arrays, and each step updates every body with one batched NumPy operation.
+
+    The default `euler` integrator is the update used by the `propagate_velocity`/`propagate_position`
+    statemanagers: velocities from the previous positions of all bodies, then positions from the new
+    velocities. `leapfrog` is the symplectic kick-drift-kick scheme, which keeps energy error bounded
+    for the same single force evaluation per step. `rk45` is the Dormand-Prince 5(4) embedded pair,
+    which picks its own step size to hold the local error under `tolerance`.
+
+    By default each agent keeps the `timeStep` it was initialised with, matching the constant
+    `timestep_manager`. With `adaptive`, every step instead uses the shared step from
+    `modsim.adaptive_timestep`, which grows when bodies are far apart and shrinks near periapsis.
+
+    Args:
+        init (dict): The initial state of the universe, in the same form `Simulator` takes.
+        store: Optionally, a Q-Range store to record each agent's state in, as `Simulator` does.
+        integrator (str): One of `euler`, `leapfrog` or `rk45`.
+        adaptive (bool): Use `modsim.adaptive_timestep` instead of each agent's fixed timeStep.
+        eta (float): The adaptive step as a fraction of the shortest pairwise free-fall time.
+        tolerance (float): The `rk45` local error tolerance, relative to the state's magnitude.
+
+    The default `euler` engine steps the `modsim` model as `Simulator` does, to rounding:
+
+    >>> from modsim import data
+    >>> from simulator import Simulator
+    >>> from store import QRangeStore
+    >>> def rows(cycles):
+    ...     return np.array([[[s['time'], *s['position'].values(), *s['velocity'].values()] for s in cycle.values()] for cycle in cycles])
+    >>> (reference, vectorized) = (rows(Simulator(QRangeStore(), data).simulate(300)), rows(NBodyEngine(data).simulate(300)))
+    >>> (reference.shape, np.allclose(vectorized, reference, rtol=1e-12, atol=1e-15))
+    ((300, 2, 7), True)
+
+    Over 300 time units of the `modsim` orbit, leapfrog holds the energy far better than euler in the same
+    steps, and rk45 better still in a few of its own:
+
+    >>> def drift(integrator):
+    ...     engine = NBodyEngine(data, integrator=integrator)
+    ...     (energy, worst, steps) = (engine.energy(), 0.0, 0)
+    ...     while engine.time[0] < 300:
+    ...         engine.step()
+    ...         (worst, steps) = (max(worst, abs(engine.energy() / energy - 1)), steps + 1)
+    ...     return (worst, steps)
+    >>> (euler, leapfrog, rk45) = (drift('euler'), drift('leapfrog'), drift('rk45'))
+    >>> (euler[0] > 1e-6, leapfrog[0] < 1e-9, rk45[0] < 1e-10)
+    (True, True, True)
+    >>> (euler[1], leapfrog[1], rk45[1] < 30)
+    (3001, 3001, True)
+
+    Each state carries the `timeStep` that produced it, also under rk45, which picks a new one every step:
+
+    >>> engine = NBodyEngine(data, integrator='rk45')
+    >>> for _ in range(3):
+    ...     before = engine.time
+    ...     engine.step()
+    ...     print(np.allclose(engine.time - before, engine.states()['Body1']['timeStep']), engine.nextStep != engine.timeStep[0])
+    True True
+    True True
+    True True
+
+    With `adaptive`, steps shrink as the bodies close in, here on an eccentric orbit, until just past periapsis:
+
+    >>> eccentric = {**data, 'Body2': {**data['Body2'], 'velocity': {'x': 0, 'y': 0.03, 'z': 0}}}
+    >>> engine = NBodyEngine(eccentric, integrator='leapfrog', adaptive=True)
+    >>> orbit = []
+    >>> while len(orbit) < 2 or not orbit[-1][0] > orbit[-2][0]:
+    ...     engine.step()
+    ...     orbit.append((float(np.linalg.norm(engine.position[0] - engine.position[1])), float(engine.timeStep[0])))
+    >>> (separation, step) = zip(*orbit)
+    >>> (round(separation[0], 1), round(min(separation), 2), round(step[0], 2), round(min(step), 4))
+    (61.1, 1.69, 0.9, 0.0042)
+    """
+
+    def __init__(self, init: dict, store=None, integrator: str = 'euler', adaptive: bool = False,
+                 eta: float = ADAPTIVE_ETA, tolerance: float = 1e-9):
+        if integrator not in INTEGRATORS:
+            raise ValueError(f"Unknown integrator {integrator!r}: expected one of {INTEGRATORS}")
+        self.ids = list(init)
+        states = [init[agentId] for agentId in self.ids]
+        self.position = pack([s['position'] for s in states])
+        self.velocity = pack([s['velocity'] for s in states])
+        self.mass = np.array([s['mass'] for s in states], dtype=float)
+        self.time = np.array([s['time'] for s in states], dtype=float)
+        self.timeStep = np.array([s['timeStep'] for s in states], dtype=float)
+        self.integrator = integrator
+        self.adaptive = adaptive
+        self.eta = eta
+        self.tolerance = tolerance
+        self.acc = None  # acceleration at the current position, reused by leapfrog
+        self.fsal = None  # rk45's last stage, (velocity, acceleration) at the current state, reused as the next first
+        self.nextStep = None  # the step rk45's error control proposes next; `timeStep` is the one last taken
+        self.store = store
+        self.sample = Sampler()
+        if store is not None:
+            store[-999999999, 0] = init
+
+    def step(self):
+        """Advance every body by one step of the selected integrator."""
+        if self.integrator == 'rk45':
+            return self.step_rk45()
+        if self.adaptive:
+            (_, r2) = gravity(self.position, self.mass)
+            self.timeStep = np.full_like(self.timeStep, self.adaptive_timestep(r2))
+        dt = self.timeStep[:, None]
+        if self.integrator == 'euler':
+            self.velocity = self.velocity + accelerations(self.position, self.mass) * dt
+            self.position = self.position + self.velocity * dt
+        else:
+            if self.acc is None:
+                self.acc = accelerations(self.position, self.mass)
+            half = self.velocity + self.acc * (dt / 2)
+            self.position = self.position + half * dt
+            self.acc = accelerations(self.position, self.mass)
+            self.velocity = half + self.acc * (dt / 2)
+        self.time = self.time + self.timeStep
+
+    def adaptive_timestep(self, r2):
+        """The shared adaptive step for squared pairwise distances `r2` (inf on the diagonal)."""
+        total = self.mass[:, None] + self.mass[None, :]
+        return float(np.min(adaptive_timestep(np.sqrt(r2), total, self.eta)))
+
+    def derivative(self, position, velocity):
+        return (velocity, accelerations(position, self.mass))
+
+    def step_rk45(self):
+        """Take one accepted Dormand-Prince step, shrinking and retrying while the error estimate is too large."""
+        h = float(self.timeStep[0]) if self.nextStep is None else self.nextStep
+        if self.adaptive and self.nextStep is None:
+            # NOTE: seed the first step from the adaptive manager; error control takes over afterwards
+            (_, r2) = gravity(self.position, self.mass)
+            h = self.adaptive_timestep(r2)
+        y = (self.position, self.velocity)
+        k = [self.fsal if self.fsal is not None else self.derivative(*y)]
+        while True:
+            for stage in range(1, 7):
+                a = DOPRI_A[stage]
+                ys = tuple(y[i] + h * sum(a[j] * k[j][i] for j in range(stage) if a[j]) for i in range(2))
+                if len(k) > stage:
+                    k[stage] = self.derivative(*ys)
+                else:
+                    k.append(self.derivative(*ys))
+            y_new = ys  # the 7th stage is evaluated at the 5th-order solution
+            scale = [self.tolerance * (1 + np.maximum(abs(y[i]), abs(y_new[i]))) for i in range(2)]
+            err = max(
+                float(np.max(abs(h * sum(DOPRI_E[j] * k[j][i] for j in range(7) if DOPRI_E[j])) / scale[i]))
+                for i in range(2)
+            )
+            factor = 5.0 if err == 0 else min(5.0, max(0.2, 0.9 * err ** -0.2))
+            if err <= 1:
+                break
+            h *= factor
+        (self.position, self.velocity) = y_new
+        self.fsal = k[6]  # first-same-as-last: the last stage is the next step's first
+        self.time = self.time + h
+        self.timeStep = np.full_like(self.timeStep, h)
+        self.nextStep = h * factor
+
+    def energy(self):
+        """Total kinetic plus gravitational potential energy (G = 1)."""
+        kinetic = 0.5 * np.sum(self.mass * np.sum(self.velocity ** 2, axis=-1))
+        (_, r2) = gravity(self.position, self.mass)
+        potential = -0.5 * np.sum(self.mass[:, None] * self.mass[None, :] / np.sqrt(r2))
+        return float(kinetic + potential)
+
+    def states(self):
+        """Return the current state of every agent in the dict form used by `Simulator`."""
+        position = self.position.tolist()
+        velocity = self.velocity.tolist()
+        mass = self.mass.tolist()
+        time = self.time.tolist()
+        timeStep = self.timeStep.tolist()
+        return {
+            agentId: {
+                'position': unpack(position[i]),
+                'velocity': unpack(velocity[i]),
+                'mass': mass[i],
+                'time': time[i],
+                'timeStep': timeStep[i],
+            }
+            for (i, agentId) in enumerate(self.ids)
+        }
+
+    def simulate(self, iterations: int = 500):
+        """Simulate the universe for a given number of iterations, yielding cycles like `Simulator.simulate`."""
+        done = 0
+        try:
+            for _ in range(iterations):
+                start = self.time.tolist()
+                if self.sample():
+                    began = perf_counter()
+                    self.step()
+                    states = self.states()
+                    stepped = perf_counter()
+                    PHASE_SECONDS.observe(stepped - began, "step")
+                    self.commit(start, states)
+                    PHASE_SECONDS.observe(perf_counter() - stepped, "store_write")
+                    # NOTE: counts are published on sampled iterations rather than taking a lock every iteration
+                    done = self.count(done + 1)
+                else:
+                    self.step()
+                    states = self.states()
+                    self.commit(start, states)
+                    done += 1
+                yield {
+                    agentId: {'time': state['time'], 'position': state['position'], 'velocity': state['velocity']}
+                    for (agentId, state) in states.items()
+                }
+        finally:
+            self.count(done)
+
+    def count(self, iterations):
+        """Add to the iteration and agent step counters, returning the count left to publish."""
+        ITERATIONS.inc("vectorized", amount=iterations)
+        AGENT_STEPS.inc("vectorized", amount=iterations * len(self.ids))
+        return 0
+
+    def commit(self, start, states):
+        if self.store is not None:
+            for (agentId, t) in zip(self.ids, start):
+                self.store[t, states[agentId]['time']] = {agentId: states[agentId]}
+
+
+def pair_gravity(position, mass):
+    """
+    Like `gravity`, but loops over the N(N-1)/2 body pairs in Python and returns (..., P) squared pair
+    distances. With few bodies and a large batch axis this does far less work than the (N, N) planes.
+    """
+    n = position.shape[-2]
+    (first, second) = np.triu_indices(n, 1)
+    d = position[..., first, :] - position[..., second, :]
+    r2 = np.einsum('...pk,...pk->...p', d, d)
+    force = d / (r2 * np.sqrt(r2))[..., None]
+    acc = np.zeros_like(position)
+    for (p, (i, j)) in enumerate(zip(first.tolist(), second.tolist())):
+        acc[..., i, :] -= mass[..., j, None] * force[..., p, :]
+        acc[..., j, :] += mass[..., i, None] * force[..., p, :]
+    return (acc, r2)
+
+
+def parse_path(ids, path):
+    """Split an initial-condition path such as `Body1.position.x` into (agent index, field, axis index)."""
+    (agentId, field, *axis) = path.split('.')
+    if agentId not in ids or field not in ('position', 'velocity', 'mass') or (field == 'mass') != (not axis):
+        raise ValueError(f"Invalid initial-condition path {path!r}")
+    return (ids.index(agentId), field, AXES.index(axis[0]) if axis else None)
+
+
+def sample_members(base: dict, samples: int, perturb: dict, seed: int = 0):
+    """
+    Draw `samples` ensemble members around a `base` initial state. `perturb` maps paths like
+    `Body1.position.x` or `Body2.mass` to either a standard deviation (added Gaussian noise) or
+    `{'uniform': [low, high]}` (added uniform noise). Returns packed arrays, as `pack_members` does.
+    """
+    (ids, arrays) = pack_members([base])
+    arrays = {field: np.repeat(array, samples, axis=0) for (field, array) in arrays.items()}
+    rng = np.random.default_rng(seed)
+    for (path, spec) in perturb.items():
+        (i, field, axis) = parse_path(ids, path)
+        if isinstance(spec, dict):
+            (low, high) = spec['uniform']
+            noise = rng.uniform(low, high, samples)
+        else:
+            noise = rng.normal(0, spec, samples)
+        if axis is None:
+            arrays[field][:, i] += noise
+        else:
+            arrays[field][:, i, axis] += noise
+    return (ids, arrays)
+
+
+def pack_members(members: list):
+    """Pack a list of initial states (all with the same agents) into (K, N, ...) arrays."""
+    ids = list(members[0])
+    if any(list(member) != ids for member in members):
+        raise ValueError("Every ensemble member must have the same agents, in the same order")
+    rows = [[member[agentId] for agentId in ids] for member in members]
+    arrays = {
+        'position': np.array([[[s['position'][k] for k in AXES] for s in row] for row in rows], dtype=float),
+        'velocity': np.array([[[s['velocity'][k] for k in AXES] for s in row] for row in rows], dtype=float),
+        'mass': np.array([[s['mass'] for s in row] for row in rows], dtype=float),
+        'time': np.array([[s.get('time', 0.0) for s in row] for row in rows], dtype=float),
+        'timeStep': np.array([[s.get('timeStep', 0.1) for s in row] for row in rows], dtype=float),
+    }
+    return (ids, arrays)
+
+
+def simulate_ensemble(ids, arrays, iterations: int = 500, stride: int = 1):
+    """
+    Propagate K ensemble members together, with every state array batched along a leading ensemble axis,
+    using the same update as `NBodyEngine.step`.
+
+    Args:
+        ids (list): The agent ids, in array order.
+        arrays (dict): (K, N, 3) `position`/`velocity` and (K, N) `mass`/`time`/`timeStep`, e.g. from
+            `pack_members` or `sample_members`.
+        iterations (int): The number of steps to propagate.
+        stride (int): Record trajectories every `stride` steps, plus the final step.
+
+    Returns a dict of NumPy arrays: `time` (K, T, N), `position`/`velocity` (K, T, N, 3) trajectories,
+    `minSeparation` (K,) over the whole run, and a `summary` of member mean and standard deviation.
+
+    Each member follows the path of a single `NBodyEngine` run from its initial state, to rounding (the
+    ensemble sums forces pair by pair, in a different order):
+
+    >>> from modsim import data
+    >>> (ids, arrays) = sample_members(data, 4, {'Body2.velocity.y': 0.01, 'Body2.mass': {'uniform': [0, 0.05]}}, seed=1)
+    >>> result = simulate_ensemble(ids, arrays, iterations=300)
+    >>> (result['time'].shape, result['position'].shape)
+    ((4, 300, 2), (4, 300, 2, 3))
+    >>> member = {agentId: {'position': unpack(arrays['position'][2, i]), 'velocity': unpack(arrays['velocity'][2, i]),
+    ...                     'mass': arrays['mass'][2, i], 'time': 0.0, 'timeStep': 0.1} for (i, agentId) in enumerate(ids)}
+    >>> single = list(NBodyEngine(member).simulate(300))
+    >>> np.array_equal(result['time'][2], [[state['time'] for state in cycle.values()] for cycle in single])
+    True
+    >>> [np.allclose(result[field][2], [[list(state[field].values()) for state in cycle.values()] for cycle in single],
+    ...              rtol=1e-12, atol=1e-15) for field in ('position', 'velocity')]
+    [True, True]
+    """
+    position = arrays['position'].copy()
+    velocity = arrays['velocity'].copy()
+    mass = arrays['mass']
+    time = arrays['time'].copy()
+    timeStep = arrays['timeStep']
+    dt = timeStep[..., None]
+    (k, n) = mass.shape
+    # NOTE: ensembles are usually many members of few bodies, where looping over pairs is cheapest
+    pairwise = pair_gravity if n <= 16 else gravity
+    min_r2 = np.full(k, np.inf)
+    recorded = {'time': [], 'position': [], 'velocity': []}
+    for i in range(1, iterations + 1):
+        (acc, r2) = pairwise(position, mass)
+        min_r2 = np.minimum(min_r2, r2.reshape(k, -1).min(-1))
+        velocity = velocity + acc * dt
+        position = position + velocity * dt
+        time = time + timeStep
+        if i % stride == 0 or i == iterations:
+            recorded['time'].append(time)
+            recorded['position'].append(position)
+            recorded['velocity'].append(velocity)
+    (_, r2) = pairwise(position, mass)
+    min_r2 = np.minimum(min_r2, r2.reshape(k, -1).min(-1))
+    result = {field: np.stack(values, axis=1) for (field, values) in recorded.items()}
+    result['minSeparation'] = np.sqrt(min_r2)
+    result['summary'] = {
+        'position': {'mean': result['position'].mean(0), 'std': result['position'].std(0)},
+        'velocity': {'mean': result['velocity'].mean(0), 'std': result['velocity'].std(0)},
+        'minSeparation': {
+            'mean': float(result['minSeparation'].mean()),
+            'std': float(result['minSeparation'].std()),
+            'min': float(result['minSeparation'].min()),
+        },
+    }
+    result['agents'] = ids
+    return result
@@ -0,0 +1,204 @@
+# RUN PERSISTENCE
+
+import io
+import json
+
+import numpy as np
+
+from models import Run, RunChunk
+from nbody import AXES, unpack
+
+CHUNK_CYCLES = 256
+
+
+def encode_chunk(columns: dict) -> bytes:
+    """
+    Encode per-agent columns as an uncompressed `.npz`. For each agent it holds `cycle` (the index of
+    each row's cycle within the chunk), `time`, and (n, 3) `position` and `velocity` arrays.
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, **{f"{agentId}/{field}": array for (agentId, agent) in columns.items() for (field, array) in agent.items()})
+    return buffer.getvalue()
+
+
+def decode_chunk(data: bytes) -> dict:
+    """Decode a chunk written by `encode_chunk` back into `{agentId: {field: array}}`."""
+    columns = {}
+    with np.load(io.BytesIO(data)) as npz:
+        for name in npz.files:
+            (agentId, field) = name.rsplit("/", 1)
+            columns.setdefault(agentId, {})[field] = npz[name]
+    return columns
+
+
+def iter_cycles(columns: dict, t0=None, t1=None):
+    """
+    Rebuild the cycles of a decoded chunk, in order, in the form the simulator yields them. With `t0`/`t1`,
+    only agents' rows with `t0 <= time < t1` are kept, and cycles left empty are skipped.
+    """
+    rows = {}
+    for (agentId, agent) in columns.items():
+        keep = np.ones(len(agent["time"]), dtype=bool)
+        if t0 is not None:
+            keep &= agent["time"] >= t0
+        if t1 is not None:
+            keep &= agent["time"] < t1
+        time = agent["time"][keep].tolist()
+        position = agent["position"][keep].tolist()
+        velocity = agent["velocity"][keep].tolist()
+        for (i, cycle) in enumerate(agent["cycle"][keep].tolist()):
+            rows.setdefault(cycle, {})[agentId] = {
+                "time": time[i],
+                "position": unpack(position[i]),
+                "velocity": unpack(velocity[i]),
+            }
+    for cycle in sorted(rows):
+        yield rows[cycle]
+
+
+def cycle_columns(cycles) -> dict:
+    """Gather consecutive cycles into the per-agent columns `encode_chunk` takes."""
+    columns = {}
+    for (i, cycle) in enumerate(cycles):
+        for (agentId, state) in cycle.items():
+            agent = columns.setdefault(agentId, {"cycle": [], "time": [], "position": [], "velocity": []})
+            agent["cycle"].append(i)
+            agent["time"].append(state["time"])
+            agent["position"].append([state["position"][k] for k in AXES])
+            agent["velocity"].append([state["velocity"][k] for k in AXES])
+    return {
+        agentId: {
+            "cycle": np.array(agent["cycle"], dtype=np.int32),
+            "time": np.array(agent["time"], dtype=float),
+            "position": np.array(agent["position"], dtype=float).reshape(-1, 3),
+            "velocity": np.array(agent["velocity"], dtype=float).reshape(-1, 3),
+        }
+        for (agentId, agent) in columns.items()
+    }
+
+
+class ChunkWriter:
+    """
+    Buffers cycles as they are produced and hands them to `flush(seq, t0, t1, cycles, data)` in encoded
+    chunks of `chunk_cycles`, so a run of any length is persisted with bounded memory.
+    """
+
+    def __init__(self, flush, chunk_cycles: int = CHUNK_CYCLES):
+        self.on_flush = flush
+        self.chunk_cycles = chunk_cycles
+        self.seq = 0
+        self.rows = []
+
+    def append(self, cycle: dict):
+        self.rows.append(cycle)
+        if len(self.rows) >= self.chunk_cycles:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = cycle_columns(self.rows)
+        times = np.concatenate([agent["time"] for agent in columns.values()])
+        self.on_flush(self.seq, float(times.min()), float(times.max()), len(self.rows), encode_chunk(columns))
+        self.seq += 1
+        self.rows = []
+
+
+def create_run(session, init):
+    """Insert the header row for a new persisted run."""
+    run = Run(agents=json.dumps(list(init)), init=json.dumps(init))
+    session.add(run)
+    session.commit()
+    return run
+
+
+def run_writer(session, run):
+    """A ChunkWriter that stores each chunk of `run` and updates its header, one commit per chunk."""
+    def flush(seq, t0, t1, cycles, data):
+        session.add(RunChunk(run_id=run.id, seq=seq, t0=t0, t1=t1, cycles=cycles, data=data))
+        run.cycles += cycles
+        run.chunks += 1
+        run.t0 = t0 if run.t0 is None else min(run.t0, t0)
+        run.t1 = t1 if run.t1 is None else max(run.t1, t1)
+        session.commit()
+    return ChunkWriter(flush)
+
+
+def field_columns(agent: dict, fields) -> dict:
+    """Flatten an agent's decoded columns into 1-D arrays named `time`, `position.x`, `velocity.z`, etc."""
+    out = {}
+    for name in fields:
+        (base, _, axis) = name.partition(".")
+        if base == "time" and not axis:
+            out["time"] = agent["time"]
+        elif base in ("position", "velocity") and axis in ("", *AXES):
+            for k in ([axis] if axis else AXES):
+                out[f"{base}.{k}"] = agent[base][:, AXES.index(k)]
+        else:
+            raise ValueError(f"Unknown field {name!r}")
+    return out
+
+
+class Downsampler:
+    """
+    Collects the samples of a run that fall in [t0, t1) one decoded chunk at a time, keeping only the
+    requested agents and fields, and optionally decimating them on the way:
+    - `stride`: keep every `stride`-th sample of each agent.
+    - `buckets`: split the window into equal time buckets and keep each field's min and max per bucket.
+    Only the decimated output is held in memory, however many chunks the window spans.
+    """
+
+    def __init__(self, t0: float, t1: float, fields, agents=None, stride: int = 1, buckets: int = None):
+        if not t0 < t1:
+            raise ValueError("Invalid time window: t0 must be less than t1")
+        if stride < 1 or (buckets is not None and buckets < 1):
+            raise ValueError("stride and buckets must be positive")
+        field_columns({"time": np.empty(0), "position": np.empty((0, 3)), "velocity": np.empty((0, 3))}, fields)
+        self.t0 = t0
+        self.t1 = t1
+        self.fields = fields
+        self.agents = agents
+        self.stride = stride
+        self.buckets = buckets
+        self.seen = {}  # agentId -> samples in the window so far, for striding across chunks
+        self.samples = {}  # agentId -> field -> list of arrays
+        self.extrema = {}  # agentId -> field -> (count, min, max) arrays over buckets
+
+    def add(self, columns: dict):
+        for (agentId, agent) in columns.items():
+            if self.agents is not None and agentId not in self.agents:
+                continue
+            keep = (agent["time"] >= self.t0) & (agent["time"] < self.t1)
+            time = agent["time"][keep]
+            selected = {name: column[keep] for (name, column) in field_columns(agent, self.fields).items()}
+            if self.buckets is None:
+                offset = self.seen.get(agentId, 0)
+                self.seen[agentId] = offset + len(time)
+                picks = np.arange(-offset % self.stride, len(time), self.stride)
+                agentSamples = self.samples.setdefault(agentId, {})
+                for (name, column) in selected.items():
+                    agentSamples.setdefault(name, []).append(column[picks])
+            else:
+                bucket = ((time - self.t0) / (self.t1 - self.t0) * self.buckets).astype(int).clip(0, self.buckets - 1)
+                agentExtrema = self.extrema.setdefault(agentId, {})
+                for (name, column) in selected.items():
+                    if name not in agentExtrema:
+                        agentExtrema[name] = (np.zeros(self.buckets, dtype=int), np.full(self.buckets, np.inf), np.full(self.buckets, -np.inf))
+                    (count, low, high) = agentExtrema[name]
+                    np.add.at(count, bucket, 1)
+                    np.minimum.at(low, bucket, column)
+                    np.maximum.at(high, bucket, column)
+
+    def result(self) -> dict:
+        agents = {}
+        if self.buckets is None:
+            for (agentId, agentSamples) in self.samples.items():
+                agents[agentId] = {name: np.concatenate(parts).tolist() for (name, parts) in agentSamples.items()}
+        else:
+            width = (self.t1 - self.t0) / self.buckets
+            for (agentId, agentExtrema) in self.extrema.items():
+                filled = next(iter(agentExtrema.values()))[0] > 0
+                out = agents[agentId] = {"bucket": (self.t0 + width * np.flatnonzero(filled)).tolist()}
+                for (name, (_, low, high)) in agentExtrema.items():
+                    out[name] = {"min": low[filled].tolist(), "max": high[filled].tolist()}
+        return {"t0": self.t0, "t1": self.t1, "stride": self.stride, "buckets": self.buckets, "agents": agents}
@@ -1,21 +1,213 @@
 # SIMULATOR
 
-from functools import reduce
-from operator import __or__
-import subprocess
+from bisect import bisect_right
+from heapq import heapify, heappop, heappush
+import hashlib
+import itertools
 import json
 import logging
+import os
+import subprocess
+import threading
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
 
+from checkpoint import load_checkpoint
+from compiler import compile_inputs, compile_setter, consumed_fields, past_reads, produced_field
+from metrics import AGENT_STEPS, INVALID_STATES, ITERATIONS, PHASE_SECONDS, STATE_MANAGER_SECONDS, Sampler, debug
 from modsim import agents
 from store import QRangeStore
 
+PARSER = '../queries/target/release/sedaro-nano-queries'
+GRAMMAR = '../queries/src/grammar.lalrpop'
+QUERY_CACHE = os.environ.get("SEDARO_QUERY_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "query_cache.json"))
+
+
+class QueryCache:
+    """
+    A content-hashed cache of parsed queries, shared by every Simulator in the process and persisted to
+    `path` as JSON so later processes can build simulators without running the parser at all.
+    Entries are keyed by a hash of the query text and the parser binary's size and mtime, so a rebuilt
+    parser never serves stale parses. Misses are parsed together in a single `--batch` invocation.
+    """
+
+    def __init__(self, path=QUERY_CACHE, parser=PARSER):
+        self.path = path
+        self.parser = parser
+        self.entries = None
+        self.lock = threading.Lock()
+
+    def fingerprint(self):
+        try:
+            stat = os.stat(self.parser)
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            return "missing"
+
+    def parse(self, queries):
+        """Parse a list of query strings, returning their parsed JSON in the same order."""
+        with self.lock:
+            if self.entries is None:
+                self.entries = self.load()
+            fingerprint = self.fingerprint()
+            keys = [hashlib.sha256(f"{fingerprint}\0{q}".encode()).hexdigest() for q in queries]
+            missing = {k: q for (k, q) in zip(keys, queries) if k not in self.entries}
+            if missing:
+                self.entries |= dict(zip(missing, self.parse_batch(list(missing.values()))))
+                self.save()
+            return [self.entries[k] for k in keys]
+
+    def parse_batch(self, queries):
+        # NOTE: The query parser is invoked via a subprocess call to the Rust binary, once per batch
+        popen = subprocess.Popen([self.parser, '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        (stdout, stderr) = popen.communicate("".join(json.dumps(q) + "\n" for q in queries))
+        if popen.returncode:
+            raise Exception(f"Parsing query failed: {stderr}")
+        results = [json.loads(line) for line in stdout.splitlines() if line]
+        for (query, result) in zip(queries, results):
+            if "Err" in result:
+                raise Exception(f"Parsing query failed: {result['Err']}\n{query}{self.stale()}")
+        return [result["Ok"] for result in results]
+
+    def stale(self):
+        """A hint to rebuild the parser if the grammar has changed since it was built, else ''."""
+        try:
+            if os.stat(GRAMMAR).st_mtime_ns > os.stat(self.parser).st_mtime_ns:
+                return f"\n{self.parser} is older than {GRAMMAR}; rebuild it with `cargo build --release`"
+        except OSError:
+            pass
+        return ""
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            entries = self.load() | self.entries  # merge entries saved by other processes
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning(f"Could not persist query cache to {self.path}: {e}")
+
+
+query_cache = QueryCache()
+
+
 def parse_query(query):
-    # NOTE: The query parser is invoked via a subprocess call to the Rust binary
-    popen = subprocess.Popen('../queries/target/release/sedaro-nano-queries', stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    (stdout, stderr) = popen.communicate(query)
-    if popen.returncode:
-        raise Exception(f"Parsing query failed: {stderr}")
-    return json.loads(stdout)
+    return query_cache.parse([query])[0]
+
+
+_versions = itertools.count()
+TIME_TOLERANCE = 1e-6  # NOTE: times are sums of float steps, so `at!` reads count a state this close after `t` as at `t`
+
+
+class Universe(dict):
+    """
+    The read-only universe handed to State Managers: every agent's state, keyed by agentId. Only the
+    Simulator changes it, and `version` changes each time it does, so derived data such as an octree of
+    every agent can be kept, with `cached`, until the next change. `tails` are the Simulator's per-agent
+    deques of recent committed `(low, high, newState)` records, which `history!` and `at!` read.
+    """
+
+    __slots__ = ("version", "tails", "derived")
+
+    def __init__(self, tails=None):
+        super().__init__()
+        self.version = next(_versions)
+        self.tails = tails
+        self.derived = (self.version, {})
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("The universe is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def cached(self, key, compute):
+        """
+        `compute()`, computed once per `version` of the universe under `key` and shared by every step that
+        reads this version. Concurrent steps may both compute it, which is harmless as they get equal results.
+        """
+        (version, derived) = self.derived
+        if version != self.version:
+            derived = {}
+            self.derived = (self.version, derived)
+        if key not in derived:
+            derived[key] = compute()
+        return derived[key]
+
+    def history(self, agentId, n):
+        """Up to the last `n` committed states of `agentId`, oldest first, each as a universe of that agent alone."""
+        tail = self.tails[agentId]
+        return [newState for (_, _, newState) in itertools.islice(tail, max(len(tail) - n, 0), None)]
+
+    def past(self, t):
+        """The universe as it was at time `t`."""
+        return PastUniverse(self.tails, t)
+
+
+def _record_time(record):
+    return record[1]
+
+
+class PastUniverse(Mapping):
+    """
+    A read-only view of the universe at an earlier time `t`: each agent's latest committed state at or
+    before `t` (within `TIME_TOLERANCE`), found by bisecting its tail, or its earliest kept state if `t`
+    is before that (e.g. the initial state, for times before the run started).
+
+    >>> from compiler import compile_getter
+    >>> tails = {'A': deque(), 'B': deque()}
+    >>> t = 0.0
+    >>> for step in range(10):
+    ...     for agentId in tails:
+    ...         tails[agentId].append((t - 0.1, t, {agentId: {'time': t, 'step': step}}))
+    ...     t += 0.1
+    >>> universe = Universe(tails)
+    >>> dict.update(universe, {agentId: tail[-1][2][agentId] for (agentId, tail) in tails.items()})
+    >>> history = {'kind': 'History', 'content': {'query': {'kind': 'Base', 'content': 'step'}, 'n': 3}}
+    >>> compile_getter('A', history)(universe, {})
+    [7, 8, 9]
+
+    Whole numbers of steps back land on the state that many steps earlier, though its time was summed
+    differently (here 0.8999999999999999 - 0.5 is just below B's 0.4):
+
+    >>> at = lambda dt: {'kind': 'At', 'content': {'query': {'kind': 'Access', 'content': {
+    ...     'base': {'kind': 'Agent', 'content': 'B'}, 'field': 'step'}}, 'dt': dt}}
+    >>> (universe['A']['time'], tails['B'][4][1])
+    (0.8999999999999999, 0.4)
+    >>> [compile_getter('A', at(dt))(universe, {}) for dt in (0, 0.5, 0.55, 5)]
+    [9, 4, 3, 0]
+    >>> find = Simulator.__new__(Simulator).find
+    >>> [find('A', query, universe, {}) for query in (history, at(0.5), at(5))]
+    [[7, 8, 9], 4, 0]
+    """
+
+    __slots__ = ("tails", "time")
+
+    def __init__(self, tails, t):
+        self.tails = tails
+        self.time = t
+
+    def __getitem__(self, agentId):
+        tail = self.tails[agentId]
+        i = bisect_right(tail, self.time + TIME_TOLERANCE, key=_record_time)
+        return tail[max(i - 1, 0)][2][agentId]
+
+    def __iter__(self):
+        return iter(self.tails)
+
+    def __len__(self):
+        return len(self.tails)
+
 
 class Simulator:
     """
@@ -37,62 +229,180 @@ class Simulator:
     Args:
         store (QRangeStore): The data store in which to save the simulation results.
         init (dict): The initial state of the universe.
+        model (dict): The agents and their statemanagers, defaulting to `modsim.agents`.
     """
 
-    def __init__(self, store: QRangeStore, init: dict):
+    def __init__(self, store: QRangeStore, init: dict, model: dict = agents):
         # NOTE: Creating a Simulator object does all the simulation "building"
-        self.store = store
         store[-999999999, 0] = init
+        self.setup(store, init, model)
+        for agentId in init:
+            self.publish(agentId, init[agentId])
+            self.tail[agentId].append((-999999999, 0, {agentId: init[agentId]}))
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint, store: QRangeStore = None, model: dict = agents):
+        """
+        Rebuild a Simulator from a `checkpoint()` snapshot (or the path of one written by a `Checkpointer`).
+        The store only receives the records later steps can read, and simulating on from the checkpoint
+        produces the same cycles, bit for bit, as the original Simulator would have.
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = load_checkpoint(checkpoint)
+        sim = cls.__new__(cls)
+        sim.setup(QRangeStore() if store is None else store, checkpoint["init"], model)
+        for (agentId, low, high, value) in checkpoint["records"]:
+            sim.store[low, high] = value
+            sim.publish(agentId, value[agentId])
+            sim.tail[agentId].append((low, high, value))
+        sim.times = dict(checkpoint["times"])
+        sim.iteration = checkpoint["iteration"]
+        return sim
+
+    def setup(self, store, init, model):
+        self.store = store
         self.init = init
         self.times = {agentId: state["time"] for agentId, state in init.items()}
+        self.iteration = 0
+        # NOTE: each agent's committed records that a later read could still see, for checkpoints
+        self.tail = {agentId: deque() for agentId in init}
+        # NOTE: the universe as of `clock`, kept up to date from committed states rather than read from the store
+        self.universe = Universe(self.tail)
+        self.pending = []  # heap of (time, seq, agentId, state) committed states not yet in the universe
+        self.published = 0
+        self.clock = -float("inf")
+        self.model = model
+        self.sample = Sampler()
         self.sim_graph = {}
-        for (agentId, sms) in agents.items():
+        # NOTE: tails keep at least `depth` records per agent for `history!`, and `lookback` more time for `at!`
+        self.depth = {agentId: 1 for agentId in init}
+        self.lookback = 0.0
+        self.reads_past = False
+        queries = [q for sms in model.values() for sm in sms for q in (sm["consumed"], sm["produced"])]
+        parsed = iter(query_cache.parse(queries))
+        for (agentId, sms) in model.items():
             agent = []
             for sm in sms:
-                consumed = parse_query(sm["consumed"])["content"]
-                produced = parse_query(sm["produced"])
+                consumed = next(parsed)["content"]
+                produced = next(parsed)
                 func = sm["function"]
-                agent.append({"func": func, "consumed": consumed, "produced": produced})
-            self.sim_graph[agentId] = agent
+                reads = past_reads({"kind": "Tuple", "content": consumed})
+                if reads is not None:
+                    self.depth[agentId] = max(self.depth.get(agentId, 1), reads[0])
+                    self.lookback = max(self.lookback, reads[1])
+                    self.reads_past = True
+                agent.append({
+                    "func": func,
+                    "consumed": consumed,
+                    "produced": produced,
+                    "inputs": compile_inputs(agentId, consumed),
+                    "output": compile_setter(agentId, produced),
+                })
+            self.sim_graph[agentId] = self.schedule(agentId, agent)
+
+    @staticmethod
+    def schedule(agentId, sms):
+        """
+        Order an agent's State Managers so each runs after every State Manager producing a field it
+        consumes from the current step. Raises if an input is never produced or the dependencies form
+        a cycle, so neither can surface mid-simulation.
+
+        >>> def sm(func, consumed, produced):
+        ...     return {'func': func, 'consumed': consumed, 'produced': {'kind': 'Base', 'content': produced}}
+        >>> B = lambda name: {'kind': 'Base', 'content': name}
+        >>> P = lambda name: {'kind': 'Prev', 'content': B(name)}
+        >>> def position(): pass
+        >>> def velocity(): pass
+        >>> def time(): pass
+        >>> order = Simulator.schedule('A', [sm(position, [B('velocity')], 'position'), sm(time, [P('time')], 'time'),
+        ...                                  sm(velocity, [P('position'), P('velocity')], 'velocity')])
+        >>> [s['func'].__name__ for s in order]
+        ['velocity', 'position', 'time']
+        >>> Simulator.schedule('A', [sm(position, [B('velocity')], 'position'), sm(velocity, [B('position')], 'velocity')])
+        Traceback (most recent call last):
+        Exception: Dependency cycle between statemanagers for agent A: position -> velocity -> position
+        >>> Simulator.schedule('A', [sm(position, [B('velocity')], 'position')])
+        Traceback (most recent call last):
+        Exception: State manager position for agent A consumes `velocity`, which no state manager produces
+        """
+        producers = {}
+        for (i, sm) in enumerate(sms):
+            field = produced_field(sm["produced"])
+            if field is not None:
+                producers.setdefault(field, []).append(i)
+        deps = []
+        for (i, sm) in enumerate(sms):
+            needs = set()
+            for field in consumed_fields({"kind": "Tuple", "content": sm["consumed"]}):
+                if field is None:
+                    needs.update(j for j in range(len(sms)) if j != i)
+                elif field in producers:
+                    needs.update(producers[field])
+                else:
+                    raise Exception(f"State manager {sm['func'].__name__} for agent {agentId} consumes `{field}`, which no state manager produces")
+            deps.append(needs)
+
+        order = []
+        state = [0] * len(sms)  # 0: unvisited, 1: on the current path, 2: scheduled
+        def visit(i, path):
+            if state[i] == 2:
+                return
+            if state[i] == 1:
+                cycle = path[path.index(i):] + [i]
+                raise Exception(f"Dependency cycle between statemanagers for agent {agentId}: {' -> '.join(sms[j]['func'].__name__ for j in cycle)}")
+            state[i] = 1
+            for j in sorted(deps[i]):
+                visit(j, path + [i])
+            state[i] = 2
+            order.append(sms[i])
+        for i in range(len(sms)):
+            visit(i, [])
+        return order
+
+    def publish(self, agentId, state):
+        """Queue a committed state for the universe, which takes it in once reads reach its time."""
+        heappush(self.pending, (state["time"], self.published, agentId, state))
+        self.published += 1
 
     def read(self, t):
-        try:
-            data = self.store[t]
-        except IndexError:
-            data = []
-        return reduce(__or__, data, {}) # combine all data into one dictionary
+        """
+        The universe at time `t`: each agent's most recent state at or before `t`. Reads only move forward
+        in time, so the universe is advanced in place by the states committed since the last read, and
+        steps share it, read-only, rather than each getting a copy.
+        """
+        if t < self.clock:
+            raise ValueError(f"Cannot read the universe at {t}, before the last read at {self.clock}")
+        self.clock = t
+        pending = self.pending
+        if pending and pending[0][0] <= t:
+            while pending and pending[0][0] <= t:
+                (_, _, agentId, state) = heappop(pending)
+                dict.__setitem__(self.universe, agentId, state)
+            self.universe.version = next(_versions)
+        return self.universe
 
     def step(self, agentId, universe):
-        """Run an Agent for a single step."""
+        """Run an Agent for a single step, evaluating each State Manager once in dependency order."""
         state = dict()
-        sms = []
         for sm in self.sim_graph[agentId]:
-            sms.append((agentId, sm))
-        while sms:
-            next_sms = []
-            for (agentId, sm) in sms:
-                if self.run_sm(agentId, sm, universe, state) is None:
-                    next_sms.append((agentId, sm))
-            if len(sms) == len(next_sms):
-                raise Exception(f"No progress made while evaluating statemanagers for agent {agentId}. Remaining statemanagers: {[sm['func'].__name__ for (agentId, sm) in sms]}")
-            sms = next_sms
+            self.run_sm(agentId, sm, universe, state)
         return state
 
     def run_sm(self, agentId, sm, universe, newState):
         """Run a State Manager for a single step."""
-        inputs = []
-        for q in sm["consumed"]:
-            found = self.find(agentId, q, universe, newState)
-            if found is None:
-                return None
-            inputs.append(found)
+        inputs = sm["inputs"](universe, newState)
+        if inputs is None:
+            raise Exception(f"Missing inputs for statemanager {sm['func'].__name__} of agent {agentId}")
         res = sm["func"](*inputs)
-        self.put(agentId, sm["produced"], universe, newState, res)
+        sm["output"](universe, newState, res)
         return res
 
     def find(self, agentId, query, universe, newState: dict, prev=False):
-        """Find consumed data to pass to a State Manager."""
-        # NOTE: queries are interpreted at runtime here
+        """
+        Find consumed data to pass to a State Manager.
+        This is the reference interpreter for queries; `run_sm` uses the equivalent closures built by
+        `compiler.py` when the Simulator is created.
+        """
         match query["kind"]:
             case "Base":
                 if prev:
@@ -110,6 +420,8 @@ class Simulator:
             case "Agent":
                 # agent always gets the previous state
                 return universe[query["content"]]
+            case "Agents":
+                return universe
             case "Access":
                 base = self.find(agentId, query["content"]["base"], universe, newState, prev)
                 if base is None:
@@ -123,11 +435,22 @@ class Simulator:
                         return None
                     res.append(found)
                 return res
+            case "History":
+                res = []
+                for past in universe.history(agentId, query["content"]["n"]):
+                    found = self.find(agentId, query["content"]["query"], past, newState, prev=True)
+                    if found is None:
+                        return None
+                    res.append(found)
+                return res
+            case "At":
+                past = universe.past(universe[agentId]["time"] - query["content"]["dt"])
+                return self.find(agentId, query["content"]["query"], past, newState, prev=True)
             case _:
                 return None
 
     def put(self, agentId, query, universe, newState: dict, data):
-        """Put produced data into the universe."""
+        """Put produced data into the universe. Reference interpreter for `compiler.compile_setter`."""
         match query["kind"]:
             case "Base":
                 agentState = newState.get(agentId)
@@ -135,7 +458,7 @@ class Simulator:
                     agentState = {}
                     newState[agentId] = agentState
                 agentState[query["content"]] = data
-            case "Prev":
+            case "Prev" | "History" | "At":
                 raise Exception(f"Cannot produce prev query {query}")
             case "Root":
                 pass
@@ -155,52 +478,191 @@ class Simulator:
             case "Tuple":
                 raise Exception(f"Tuple production not yet implemented")
 
+    def trim(self, agents, horizon):
+        """
+        Drop records from the tails of `agents` that no read can reach: every read is at or after `horizon`,
+        and sees only the latest of an agent's states at or before it. `at!` reads up to `lookback` earlier,
+        and `history!` an agent's last `depth` states, so tails stay bounded however long the run.
+        """
+        horizon -= self.lookback
+        for agentId in agents:
+            tail = self.tail[agentId]
+            depth = self.depth[agentId]
+            while len(tail) > depth and tail[1][1] <= horizon:
+                tail.popleft()
+
+    def checkpoint(self):
+        """
+        A snapshot of everything later iterations depend on: the agents' times, the number of iterations
+        run, and the committed records later reads can still see, which is usually each agent's latest state.
+        States are not copied, as they are never modified once committed.
+        """
+        return {
+            "iteration": self.iteration,
+            "init": self.init,
+            "times": dict(self.times),
+            "records": [(agentId, low, high, value) for (agentId, tail) in self.tail.items() for (low, high, value) in tail],
+        }
+
+    def due(self, queue):
+        """
+        Pop the agents due next from `queue`, a heap of `(time, order, agentId)`: every agent whose next
+        time is the earliest, in the order they appear in the initial state.
+        """
+        (t, _, agentId) = heappop(queue)
+        batch = [agentId]
+        while queue and queue[0][0] == t:
+            batch.append(heappop(queue)[2])
+        return (t, batch)
+
+    def step_timed(self, agentId, universe):
+        """`step`, recording the time taken by each State Manager."""
+        state = dict()
+        for sm in self.sim_graph[agentId]:
+            start = perf_counter()
+            self.run_sm(agentId, sm, universe, state)
+            STATE_MANAGER_SECONDS.observe(perf_counter() - start, agentId, sm["func"].__name__)
+        return state
+
+    def step_batch(self, batch, executor, sampled=False):
+        """
+        Step a batch of agents, on `executor` if given, and return `(agentId, t, newState)` in batch order.
+        When `sampled`, the read and (serial) step phases are timed.
+        """
+        jobs = []
+        for agentId in batch:
+            t = self.times[agentId]
+            if sampled:
+                start = perf_counter()
+                universe = self.read(t)
+                PHASE_SECONDS.observe(perf_counter() - start, "read")
+            else:
+                universe = self.read(t)
+            if executor is None:
+                if sampled:
+                    start = perf_counter()
+                    jobs.append((agentId, t, self.step_timed(agentId, universe)))
+                    PHASE_SECONDS.observe(perf_counter() - start, "step")
+                else:
+                    jobs.append((agentId, t, self.step(agentId, universe)))
+            elif isinstance(executor, ProcessPoolExecutor):
+                # NOTE: store views are materialised so only plain dicts are pickled to the workers
+                universe = {k: {f: v for (f, v) in state.items()} for (k, state) in universe.items()}
+                jobs.append((agentId, t, executor.submit(_step_in_worker, agentId, universe)))
+            else:
+                jobs.append((agentId, t, executor.submit(self.step, agentId, universe)))
+        if executor is None:
+            return jobs
+        return [(agentId, t, future.result()) for (agentId, t, future) in jobs]
+
     #MC: Changed simulate function to work in yielding agent/state data in cycles instead of all at once
-    def simulate(self, iterations: int = 500):
-        """Simulate the universe for a given number of iterations."""
-        for iteration in range(iterations):
-            cycle = dict()  # Reset cycle data for each iteration
-            logging.info(f"Starting iteration {iteration}")
-            
-            for agentId in self.init:
-                t = self.times[agentId]
-                universe = self.read(t - 0.001)
-                if set(universe) == set(self.init):
-                    newState = self.step(agentId, universe)
-                    logging.info(f"Raw state for {agentId} at time {t}: {newState}")
-                    
+    def simulate(self, iterations: int = 500, parallel: str = None, workers: int = None, checkpointer=None):
+        """
+        Simulate the universe for a given number of iterations. Agents are kept in a priority queue of
+        their next times, and each iteration steps only the agents due next, so an agent with a longer
+        `timeStep` is stepped proportionally less often. Agents due at the same time are stepped in the
+        order of the initial state, and each reads the universe as of that time, without the others' new states.
+
+        Args:
+            iterations (int): The number of cycles to simulate.
+            parallel (str): Opt in to stepping the agents due at the same time concurrently on a `"thread"`
+                or `"process"` pool. Results are committed in agent order, so output matches a serial run.
+            workers (int): The pool size, defaulting to the executor's own default.
+            checkpointer (Checkpointer): Hand a `checkpoint()` to this every `checkpointer.every` iterations.
+                It is taken once the consumer has taken the iteration's cycle, so whatever the consumer
+                persisted for that cycle is covered by the checkpoint.
+        """
+        if parallel == "thread":
+            executor = ThreadPoolExecutor(workers)
+        elif parallel == "process":
+            if self.reads_past:
+                raise ValueError("history! and at! read the Simulator's recent states, so they can't be stepped on a process pool")
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.init, self.model))
+        elif parallel is None:
+            executor = None
+        else:
+            raise ValueError(f"Unknown parallel executor {parallel!r}: expected 'thread' or 'process'")
+        order = {agentId: i for (i, agentId) in enumerate(self.init)}
+        queue = [(self.times[agentId], i, agentId) for (agentId, i) in order.items()]
+        heapify(queue)
+        (done, steps) = (0, 0)
+        try:
+            for iteration in range(iterations):
+                cycle = dict()  # Reset cycle data for each iteration
+                sampled = self.sample()
+
+                (_, due) = self.due(queue)
+                for (agentId, t, newState) in self.step_batch(due, executor, sampled):
+                    debug("Raw state for %s at time %s: %s", agentId, t, newState)
+
                     if not newState or agentId not in newState:
                         logging.error(f"Invalid state for {agentId}: {newState}")
+                        INVALID_STATES.inc()
                         continue
-                        
-                    self.store[t, newState[agentId]["time"]] = newState
+
+                    if sampled:
+                        start = perf_counter()
+                        self.store[t, newState[agentId]["time"]] = newState
+                        PHASE_SECONDS.observe(perf_counter() - start, "store_write")
+                    else:
+                        self.store[t, newState[agentId]["time"]] = newState
+                    self.publish(agentId, newState[agentId])
                     self.times[agentId] = newState[agentId]["time"]
+                    self.tail[agentId].append((t, newState[agentId]["time"], newState))
 
                     # Transform the state to match frontend's expected format
                     # The position and velocity are nested objects in the state
                     position = newState[agentId].get("position")
                     velocity = newState[agentId].get("velocity")
-                    
+
                     if not position or not velocity:
                         logging.error(f"Missing position or velocity for {agentId}: pos={position}, vel={velocity}")
+                        INVALID_STATES.inc()
                         continue
-                        
+
                     cycle[agentId] = {
+                        "time": newState[agentId]["time"],
                         "position": position,
                         "velocity": velocity
                     }
-                    
-                    # Verify the data structure
-                    logging.info(f"Processed data for {agentId}:")
-                    logging.info(f"  Position: x={position['x']}, y={position['y']}, z={position['z']}")
-                    logging.info(f"  Velocity: x={velocity['x']}, y={velocity['y']}, z={velocity['z']}")
+                # NOTE: an agent whose step failed is queued again at the same time
+                for agentId in due:
+                    heappush(queue, (self.times[agentId], order[agentId], agentId))
+                self.trim(due, queue[0][0])
+
+                # NOTE: counts are published on sampled iterations rather than taking a lock every iteration
+                done += 1
+                steps += len(cycle)
+                if sampled:
+                    (done, steps) = self.count(done, steps)
+                self.iteration += 1
+                if not cycle:
+                    logging.error("No data in cycle!")
                 else:
-                    logging.error(f"Universe state mismatch. Expected: {set(self.init)}, Got: {set(universe)}")
-            
-            if not cycle:
-                logging.error("No data in cycle!")
-            else:
-                logging.info(f"Yielding cycle with {len(cycle)} agents: {list(cycle.keys())}")
-                yield cycle
+                    yield cycle
+                if checkpointer is not None and self.iteration % checkpointer.every == 0:
+                    checkpointer.submit(self.checkpoint())
+        finally:
+            self.count(done, steps)
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    @staticmethod
+    def count(iterations, steps):
+        """Add to the iteration and agent step counters, returning the counts left to publish."""
+        ITERATIONS.inc("statemanagers", amount=iterations)
+        AGENT_STEPS.inc("statemanagers", amount=steps)
+        return (0, 0)
+
+
+# NOTE: each process-pool worker builds its own Simulator once, since compiled queries cannot be pickled
+_worker = None
+
+
+def _init_worker(init, model):
+    global _worker
+    _worker = Simulator(QRangeStore(), init, model)
+
 
-            
\ No newline at end of file
+def _step_in_worker(agentId, universe):
+    return _worker.step(agentId, universe)
@@ -1,6 +1,94 @@
 # DATA STRUCTURE
 
 import doctest
+import pickle
+import tempfile
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Mapping
+from random import Random
+
+import numpy as np
+
+
+class _Node:
+    """A node of the interval treap: one stored range, ordered by (low, seq)."""
+
+    __slots__ = ("low", "high", "seq", "value", "priority", "left", "right", "max_high")
+
+    def __init__(self, low, high, seq, value, priority):
+        self.low = low
+        self.high = high
+        self.seq = seq
+        self.value = value
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.max_high = high
+
+    def update(self):
+        m = self.high
+        if self.left is not None and self.left.max_high > m:
+            m = self.left.max_high
+        if self.right is not None and self.right.max_high > m:
+            m = self.right.max_high
+        self.max_high = m
+
+
+class _Spill:
+    """
+    Records moved out of a QRangeStore's tree, appended to a file in pickled segments of `segment` records.
+    Only each segment's offset and time bounds stay in memory; the last segment read is kept for reuse.
+    """
+
+    def __init__(self, path, segment: int = 4096):
+        self.file = tempfile.TemporaryFile() if path is True else open(path, "w+b")
+        self.segment = segment
+        self.buffer = []  # (seq, low, high, value) not yet written
+        self.index = []  # (offset, length, min low, max high) per written segment
+        self.count = 0
+        self.cached = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, node):
+        self.buffer.append((node.seq, node.low, node.high, node.value))
+        self.count += 1
+        if len(self.buffer) >= self.segment:
+            self.write()
+
+    def write(self):
+        data = pickle.dumps(self.buffer, pickle.HIGHEST_PROTOCOL)
+        offset = self.file.seek(0, 2)
+        self.file.write(data)
+        self.index.append((offset, len(data), min(r[1] for r in self.buffer), max(r[2] for r in self.buffer)))
+        self.buffer = []
+
+    def read(self, offset, length):
+        if self.cached[0] != offset:
+            self.file.seek(offset)
+            self.cached = (offset, pickle.loads(self.file.read(length)))
+        return self.cached[1]
+
+    def search(self, t0, t1, inclusive):
+        """
+        Yield `(seq, value)` for spilled records overlapping the query, in insertion order. Segments are
+        read one at a time, so only one is unpickled at once however many the query reaches.
+        """
+        for (offset, length, low, high) in self.index:
+            if high > t0 and (low < t1 or (inclusive and low == t1)):
+                yield from self._matching(self.read(offset, length), t0, t1, inclusive)
+        yield from self._matching(self.buffer, t0, t1, inclusive)
+
+    @staticmethod
+    def _matching(records, t0, t1, inclusive):
+        for (seq, low, high, value) in records:
+            if high > t0 and (low < t1 or (inclusive and low == t1)):
+                yield (seq, value)
+
+    def close(self):
+        self.file.close()
 
 
 class QRangeStore:
@@ -32,10 +120,47 @@ class QRangeStore:
     >>> store[9]
     Traceback (most recent call last):
     IndexError: Not found.
+
+    Records are indexed in an interval treap (a randomized BST keyed on `low` and augmented with
+    the largest `high` of each subtree), so both point and window lookups visit O(log n + k) nodes
+    rather than scanning every record. Results are returned in insertion order.
+
+    >>> store.overlapping(1, 3)
+    ['Record A', 'Record C', 'Record D']
+    >>> store.overlapping(4, 8)
+    []
+
+    By default every record stays in memory. A retention policy keeps only the newest `keep` records, or
+    those ending within `window` of the latest end written, in the tree; older records are moved to a
+    `spill` file (a path, or `True` for a temporary file) or, without one, dropped. Reads that reach
+    before the retained records also search the spilled ones, so results are unchanged, while reads
+    within the window cost the same as before. With `compact`, a record whose value equals that of a
+    record still in the tree ending where it starts extends that record instead of adding one. It is off
+    by default, since it compares values on every write, and simulator states never repeat.
+
+    >>> store = QRangeStore(keep=2, spill=True, compact=True)
+    >>> for (t, value) in enumerate('AABCD'):
+    ...     store[t, t + 1] = value
+    >>> (len(store), store.hot, store[0.5], store[4])
+    (4, 2, ['A'], ['D'])
+    >>> store.overlapping(1, 4)
+    ['A', 'B', 'C']
     """
 
-    def __init__(self):
-        self.store = []
+    def __init__(self, keep: int = None, window: float = None, spill=None, compact: bool = False):
+        self.root = None
+        self.count = 0
+        self.random = Random(0)  # NOTE: seeded so the tree shape is reproducible between runs
+        self.keep = keep
+        self.window = window
+        self.compact = compact
+        self.retaining = keep is not None or window is not None
+        self.order = deque()  # the tree's nodes in insertion order, when retaining
+        self.ends = {}  # high -> nodes ending there, when compacting
+        self.newest = -np.inf  # the largest high written
+        self.horizon = -np.inf  # the largest high of any record moved out of the tree
+        self.spilled = _Spill(spill) if spill else None
+        self.dropped = 0
 
     def __setitem__(self, rng, value):
         try:
@@ -44,16 +169,336 @@ class QRangeStore:
             raise IndexError("Invalid Range: must provide a low and high value.")
         if not low < high:
             raise IndexError("Invalid Range.")
-        self.store.append((low, high, value))
+        if self.compact:
+            for node in self.ends.get(low, ()):
+                # NOTE: identity first, as re-storing the very same value is the common case worth merging
+                if node.value is value or node.value == value:
+                    self._extend(node, high)
+                    break
+            else:
+                self._add(low, high, value)
+        else:
+            self._add(low, high, value)
+        if self.retaining:
+            if high > self.newest:
+                self.newest = high
+            self._retain()
 
     def __getitem__(self, key):
-        ret = [v for (l, h, v) in self.store if l <= key < h]
+        ret = self._search(key, key, inclusive=True)
         if not ret:
             raise IndexError("Not found.")
         return ret
-    
+
     def __len__(self):
-        return len(self.store)
+        return self.count - self.dropped
+
+    @property
+    def hot(self):
+        """The number of records held in memory, in the tree."""
+        return len(self.order) if self.retaining else self.count
+
+    def _add(self, low, high, value):
+        node = _Node(low, high, self.count, value, self.random.random())
+        self.root = self._insert(self.root, node)
+        self.count += 1
+        if self.retaining:
+            self.order.append(node)
+        if self.compact:
+            self.ends.setdefault(high, []).append(node)
+
+    def _extend(self, node, high):
+        """Move the end of a record in the tree to `high`, updating `max_high` on the path to it."""
+        path = []
+        root = self.root
+        while root is not node:
+            path.append(root)
+            root = root.left if (node.low, node.seq) < (root.low, root.seq) else root.right
+        self._unend(node)
+        node.high = high
+        self.ends.setdefault(high, []).append(node)
+        node.update()
+        for parent in reversed(path):
+            parent.update()
+
+    def _unend(self, node):
+        nodes = self.ends[node.high]
+        nodes.remove(node)
+        if not nodes:
+            del self.ends[node.high]
+
+    def _retain(self):
+        """Move the oldest records out of the tree until the retention policy holds."""
+        order = self.order
+        while order and ((self.keep is not None and len(order) > self.keep)
+                         or (self.window is not None and order[0].high <= self.newest - self.window)):
+            node = order.popleft()
+            self.root = self._delete(self.root, node)
+            if self.compact:
+                self._unend(node)
+            if node.high > self.horizon:
+                self.horizon = node.high
+            if self.spilled is not None:
+                self.spilled.append(node)
+            else:
+                self.dropped += 1
+
+    def overlapping(self, t0, t1):
+        """Return the values of every record whose range intersects the window [t0, t1)."""
+        if not t0 < t1:
+            raise IndexError("Invalid Range.")
+        return self._search(t0, t1, inclusive=False)
+
+    def _insert(self, root, node):
+        if root is None:
+            return node
+        # NOTE: (low, seq) is unique, and seq only grows, so equal lows always go right
+        if node.low < root.low:
+            root.left = self._insert(root.left, node)
+            if root.left.priority > root.priority:
+                root = self._rotate_right(root)
+        else:
+            root.right = self._insert(root.right, node)
+            if root.right.priority > root.priority:
+                root = self._rotate_left(root)
+        root.update()
+        return root
+
+    def _delete(self, root, node):
+        if root is node:
+            return self._merge(root.left, root.right)
+        if (node.low, node.seq) < (root.low, root.seq):
+            root.left = self._delete(root.left, node)
+        else:
+            root.right = self._delete(root.right, node)
+        root.update()
+        return root
+
+    @classmethod
+    def _merge(cls, left, right):
+        """Join two treaps where every node of `left` orders before every node of `right`."""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = cls._merge(left.right, right)
+            left.update()
+            return left
+        right.left = cls._merge(left, right.left)
+        right.update()
+        return right
+
+    @staticmethod
+    def _rotate_right(node):
+        pivot = node.left
+        node.left = pivot.right
+        pivot.right = node
+        node.update()
+        pivot.update()
+        return pivot
+
+    @staticmethod
+    def _rotate_left(node):
+        pivot = node.right
+        node.right = pivot.left
+        pivot.left = node
+        node.update()
+        pivot.update()
+        return pivot
+
+    def _search(self, t0, t1, inclusive):
+        """
+        Collect values for records with `low < t1` (or `<=` when `inclusive`) and `high > t0`.
+        Subtrees whose `max_high` cannot reach past `t0` are pruned, as are right subtrees once
+        `low` has passed `t1`.
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.max_high <= t0:
+                continue
+            if node.left is not None:
+                stack.append(node.left)
+            if node.low < t1 or (inclusive and node.low == t1):
+                if node.high > t0:
+                    found.append((node.seq, node.value))
+                if node.right is not None:
+                    stack.append(node.right)
+        found.sort(key=lambda item: item[0])
+        if t0 < self.horizon and self.spilled is not None:
+            # NOTE: records leave the tree in insertion order, so every spilled record is older
+            found = [*self.spilled.search(t0, t1, inclusive), *found]
+        return [value for (_, value) in found]
+
+
+class _AgentColumns:
+    """Growable column arrays holding one agent's consecutive records."""
+
+    def __init__(self, state, capacity):
+        self.size = 0
+        self.lows = np.empty(capacity)
+        self.highs = np.empty(capacity)
+        self.columns = {}
+        self.keys = {}  # field -> component names, for fields stored as an [N, k] column
+        for (field, value) in state.items():
+            if isinstance(value, Mapping):
+                self.keys[field] = tuple(value)
+                self.columns[field] = np.empty((capacity, len(value)))
+            else:
+                self.columns[field] = np.empty(capacity)
+
+    def append(self, low, high, state):
+        if self.size and low < self.highs[self.size - 1]:
+            raise IndexError("Invalid Range: records for an agent must not overlap or go backwards.")
+        if state.keys() != self.columns.keys():
+            raise ValueError(f"Record fields {sorted(state)} do not match the store schema {sorted(self.columns)}.")
+        if self.size == len(self.lows):
+            self.grow()
+        i = self.size
+        self.lows[i] = low
+        self.highs[i] = high
+        for (field, column) in self.columns.items():
+            keys = self.keys.get(field)
+            if keys is None:
+                column[i] = state[field]
+            else:
+                value = state[field]
+                column[i] = [value[k] for k in keys]
+        self.size += 1
+
+    def grow(self):
+        capacity = 2 * len(self.lows)
+        self.lows = np.resize(self.lows, capacity)
+        self.highs = np.resize(self.highs, capacity)
+        for (field, column) in self.columns.items():
+            self.columns[field] = np.resize(column, (capacity, *column.shape[1:]))
+
+    def find(self, key):
+        """Return the row whose range contains `key`, or None."""
+        i = bisect_right(self.lows, key, 0, self.size) - 1
+        if i >= 0 and key < self.highs[i]:
+            return i
+        return None
+
+    def window(self, t0, t1):
+        """Return the row slice of records intersecting [t0, t1)."""
+        start = max(int(np.searchsorted(self.highs[:self.size], t0, side="right")), 0)
+        stop = int(np.searchsorted(self.lows[:self.size], t1, side="left"))
+        return slice(start, max(start, stop))
+
+
+class _RowView(Mapping):
+    """A read-only dict view of one stored row. Vector fields are returned as `{'x': .., ...}` dicts."""
+
+    __slots__ = ("agent", "row")
+
+    def __init__(self, agent, row):
+        self.agent = agent
+        self.row = row
+
+    def __getitem__(self, field):
+        value = self.agent.columns[field][self.row]
+        keys = self.agent.keys.get(field)
+        if keys is None:
+            return value.item()
+        return dict(zip(keys, value.tolist()))
+
+    def __iter__(self):
+        return iter(self.agent.columns)
+
+    def __len__(self):
+        return len(self.agent.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ColumnarStore:
+    """
+    A Q-Range KV Store for simulator output that keeps each agent's fields in contiguous NumPy columns.
+    Values written to the store must be `{agentId: state}` dicts where each state has the same fields
+    (numbers, or dicts of numbers such as `{'x', 'y', 'z'}`) on every write, and each agent's ranges
+    must be written in increasing, non-overlapping order. Reads return `{agentId: view}` dicts in the
+    same shape as `QRangeStore`, and `columns` exposes the underlying arrays without copying.
+
+    >>> store = ColumnarStore()
+    >>> store[-1, 0] = {'A': {'time': 0, 'position': {'x': 0, 'y': 1}}, 'B': {'time': 0, 'position': {'x': 5, 'y': 5}}}
+    >>> store[0, 1] = {'A': {'time': 1, 'position': {'x': 1, 'y': 1}}}
+    >>> store[-0.5]
+    [{'A': {'time': 0.0, 'position': {'x': 0.0, 'y': 1.0}}}, {'B': {'time': 0.0, 'position': {'x': 5.0, 'y': 5.0}}}]
+    >>> store[0.5]
+    [{'A': {'time': 1.0, 'position': {'x': 1.0, 'y': 1.0}}}]
+    >>> store[0, 2] = {'A': {'time': 2, 'position': {'x': 2, 'y': 1}}}
+    Traceback (most recent call last):
+    IndexError: Invalid Range: records for an agent must not overlap or go backwards.
+    >>> store.columns('A')['position'][:, 0]
+    array([0., 1.])
+    >>> store[1]
+    Traceback (most recent call last):
+    IndexError: Not found.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.agents = {}
+        self.count = 0
+
+    def __setitem__(self, rng, value):
+        try:
+            (low, high) = rng
+        except (TypeError, ValueError):
+            raise IndexError("Invalid Range: must provide a low and high value.")
+        if not low < high:
+            raise IndexError("Invalid Range.")
+        for (agentId, state) in value.items():
+            agent = self.agents.get(agentId)
+            if agent is None:
+                agent = self.agents[agentId] = _AgentColumns(state, self.capacity)
+            agent.append(low, high, state)
+        self.count += 1
+
+    def __getitem__(self, key):
+        ret = []
+        for (agentId, agent) in self.agents.items():
+            row = agent.find(key)
+            if row is not None:
+                ret.append({agentId: _RowView(agent, row)})
+        if not ret:
+            raise IndexError("Not found.")
+        return ret
+
+    def __len__(self):
+        return self.count
+
+    def overlapping(self, t0, t1):
+        """Return `{agentId: view}` records intersecting the window [t0, t1), ordered by range start."""
+        if not t0 < t1:
+            raise IndexError("Invalid Range.")
+        found = []
+        for (order, (agentId, agent)) in enumerate(self.agents.items()):
+            rows = agent.window(t0, t1)
+            for row in range(rows.start, rows.stop):
+                found.append((agent.lows[row], order, {agentId: _RowView(agent, row)}))
+        found.sort(key=lambda item: item[:2])
+        return [value for (_, _, value) in found]
+
+    def columns(self, agentId, t0=None, t1=None):
+        """
+        Return zero-copy array views of an agent's columns, keyed by field, plus `low`/`high` for the
+        record ranges. With `t0`/`t1`, only rows intersecting [t0, t1) are included.
+        """
+        agent = self.agents[agentId]
+        rows = slice(0, agent.size) if t0 is None and t1 is None else agent.window(
+            -np.inf if t0 is None else t0, np.inf if t1 is None else t1)
+        ret = {field: column[rows] for (field, column) in agent.columns.items()}
+        ret["low"] = agent.lows[rows]
+        ret["high"] = agent.highs[rows]
+        return ret
+
+
+STORES = {"records": QRangeStore, "columnar": ColumnarStore}
 
 
 doctest.testmod()
@@ -2,13 +2,40 @@
 
 """
 NOTE: Test the simulator locally. First build the `queries` binary with `cargo build --release` and then run this script.
+It also runs the doctests of the modules below (`store` runs its own when it is imported) and exits non-zero if any fail.
 """
 
+import doctest
+import sys
+
+import asgi
+import broadcast
+import cache
+import checkpoint
+import compiler
+import export
+import frames
+import gravity
+import jobs
+import metrics
+import nbody
+import simulator
 from modsim import data
 from simulator import Simulator
 from store import QRangeStore
 
 store = QRangeStore()
 sim = Simulator(store, data)
-sim.simulate()
+# NOTE: simulate is a generator, so it only steps as it is consumed
+for _ in sim.simulate():
+    pass
 print(f"{len(store)=}")
+
+DOCTESTED = [compiler, simulator, broadcast, frames, export, asgi, jobs, metrics, gravity, cache, nbody, checkpoint]
+
+failed = 0
+for module in DOCTESTED:
+    result = doctest.testmod(module)
+    print(f"{module.__name__}: {result.attempted - result.failed}/{result.attempted} doctests passed")
+    failed += result.failed
+sys.exit(1 if failed else 0)
@@ -1,17 +1,40 @@
 use lalrpop_util::lalrpop_mod;
 use serde::{Deserialize, Serialize};
+use std::io::{self, BufRead, Write};
 
 lalrpop_mod!(pub grammar);
 
-#[derive(Debug, Clone, PartialEq, Eq, Hash, PartialOrd, Ord, Serialize, Deserialize)]
+#[derive(Debug, Clone, PartialEq, PartialOrd, Serialize, Deserialize)]
 #[serde(tag = "kind", content = "content")]
 pub enum Query {
     Prev(Box<Query>),
     Root,
     Agent(String),
+    Agents,
     Access { base: Box<Query>, field: String },
     Base(String),
     Tuple(Vec<Query>),
+    History { query: Box<Query>, n: usize },
+    At { query: Box<Query>, dt: f64 },
+}
+
+/// Parse newline-delimited queries, where each input line is a JSON string holding the query source.
+/// Writes one line per query: `{"Ok": <query>}` on success or `{"Err": "<message>"}` on failure,
+/// so a single bad query does not abort the rest of the batch.
+pub fn parse_batch<R: BufRead, W: Write>(input: R, mut output: W) -> io::Result<()> {
+    let parser = grammar::QueryParser::new();
+    for line in input.lines() {
+        let line = line?;
+        if line.trim().is_empty() {
+            continue;
+        }
+        let result: Result<Query, String> = serde_json::from_str::<String>(&line)
+            .map_err(|err| format!("Invalid batch line! {err}"))
+            .and_then(|source| parser.parse(&source).map_err(|err| err.to_string()));
+        serde_json::to_writer(&mut output, &result)?;
+        output.write_all(b"\n")?;
+    }
+    output.flush()
 }
 
 #[cfg(test)]
@@ -32,4 +55,69 @@ mod tests {
 
         assert_eq!(output, expected_output);
     }
+
+    #[test]
+    fn test_agents() {
+        let parser = grammar::QueryParser::new();
+        let query = parser.parse("(prev!(root!), agents!,)").unwrap();
+        let output = serde_json::to_string(&query).unwrap();
+
+        assert_eq!(
+            output,
+            r#"{"kind":"Tuple","content":[{"kind":"Prev","content":{"kind":"Root"}},{"kind":"Agents"}]}"#
+        );
+    }
+
+    #[test]
+    fn test_history_at() {
+        let parser = grammar::QueryParser::new();
+        let query = parser.parse("(history!(position.x, 3), at!(agent!(Body2).position, 0.5),)").unwrap();
+        let output = serde_json::to_string(&query).unwrap();
+
+        assert_eq!(
+            output,
+            r#"{"kind":"Tuple","content":[{"kind":"History","content":{"query":{"kind":"Access","content":{"base":{"kind":"Base","content":"position"},"field":"x"}},"n":3}},{"kind":"At","content":{"query":{"kind":"Access","content":{"base":{"kind":"Agent","content":"Body2"},"field":"position"}},"dt":0.5}}]}"#
+        );
+        assert!(parser.parse("history!(position, 1.5)").is_err());
+        assert_eq!(
+            serde_json::to_string(&parser.parse("at!(time, 2)").unwrap()).unwrap(),
+            r#"{"kind":"At","content":{"query":{"kind":"Base","content":"time"},"dt":2.0}}"#
+        );
+        assert!(parser.parse("at!(time, 1e999)").is_err());
+    }
+
+    #[test]
+    fn test_batch_overflow() {
+        // NOTE: an out of range count is an error for its query alone, not a panic that ends the batch
+        let input = "\"history!(time, 99999999999999999999999)\"\n\"prev!(time)\"\n";
+        let mut output = Vec::new();
+        parse_batch(input.as_bytes(), &mut output).unwrap();
+        let output = String::from_utf8(output).unwrap();
+        let lines: Vec<&str> = output.lines().collect();
+
+        assert_eq!(lines.len(), 2);
+        assert!(lines[0].starts_with(r#"{"Err":"#));
+        assert!(lines[0].contains("history! count is too large"));
+        assert!(lines[1].starts_with(r#"{"Ok":"#));
+    }
+
+    #[test]
+    fn test_batch() {
+        let input = "\"prev!(time)\"\n\n\"(\"\n\"agent!(Body1).mass\"\n";
+        let mut output = Vec::new();
+        parse_batch(input.as_bytes(), &mut output).unwrap();
+        let output = String::from_utf8(output).unwrap();
+        let lines: Vec<&str> = output.lines().collect();
+
+        assert_eq!(lines.len(), 3);
+        assert_eq!(
+            lines[0],
+            r#"{"Ok":{"kind":"Prev","content":{"kind":"Base","content":"time"}}}"#
+        );
+        assert!(lines[1].starts_with(r#"{"Err":"#));
+        assert_eq!(
+            lines[2],
+            r#"{"Ok":{"kind":"Access","content":{"base":{"kind":"Agent","content":"Body1"},"field":"mass"}}}"#
+        );
+    }
 }
@@ -1,7 +1,15 @@
-use sedaro_nano_queries::grammar;
-use std::io::{read_to_string, stdin};
+use sedaro_nano_queries::{grammar, parse_batch};
+use std::env;
+use std::io::{read_to_string, stdin, stdout};
 
 fn main() {
+    // NOTE: `--batch` parses many queries in one process: one JSON string per input line,
+    // one JSON `{"Ok": query}` or `{"Err": message}` per output line.
+    if env::args().skip(1).any(|arg| arg == "--batch") {
+        parse_batch(stdin().lock(), stdout().lock())
+            .unwrap_or_else(|err| panic!("Could not process batch! {err}"));
+        return;
+    }
     let input =
         read_to_string(stdin()).unwrap_or_else(|err| panic!("Could not read input stream! {err}"));
     let parser = grammar::QueryParser::new();